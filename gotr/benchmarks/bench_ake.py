@@ -0,0 +1,122 @@
+""" Measure OTR AKE handshakes and SMP runs per second.
+
+    Both sides run in the same process without any network, run from the
+    gotr directory with ``python benchmarks/bench_ake.py``. --no-table
+    disables the fixed base table for the DH generator, to compare with
+    plain pow(). --pool DEPTH keeps DH keypairs ready in a background
+    thread and also reports the latency of DH() when there is idle time
+    between key rotations, like between chat messages.
+"""
+from __future__ import print_function
+
+import argparse
+import time
+
+from potr import crypt
+from potr.compatcrypto import generateDefaultKey
+
+
+def handshake(alice_key, bob_key):
+    done = []
+    alice = crypt.AuthKeyExchange(alice_key, done.append)
+    bob = crypt.AuthKeyExchange(bob_key, done.append)
+
+    dhkey = bob.handleDHCommit(alice.startAKE())
+    revealsig = alice.handleDHKey(dhkey)
+    signature = bob.handleRevealSig(revealsig)
+    alice.handleSignature(signature)
+    assert len(done) == 2
+    return alice, bob
+
+
+class FakeUser(object):
+    def __init__(self, key):
+        self.key = key
+
+    def getPrivkey(self):
+        return self.key
+
+
+class FakeContext(object):
+    """ Delivers SMP TLVs straight to the SMPHandler of the peer. """
+
+    def __init__(self, key):
+        self.user = FakeUser(key)
+        self.peer = None
+        self.trust = None
+
+    def sendInternal(self, msg, tlvs=None, appdata=None):
+        for tlv in tlvs:
+            self.peer.smp.handle(tlv)
+
+    def setCurrentTrust(self, trust):
+        self.trust = trust
+
+
+class FakeCrypto(object):
+    def __init__(self, ake, key):
+        self.ctx = FakeContext(key)
+        self.theirPubkey = ake.theirPubkey
+        self.sessionId = ake.sessionId
+        self.smp = crypt.SMPHandler(self)
+
+
+def smp(alice_ake, bob_ake, alice_key, bob_key):
+    alice = FakeCrypto(alice_ake, alice_key)
+    bob = FakeCrypto(bob_ake, bob_key)
+    alice.ctx.peer, bob.ctx.peer = bob, alice
+
+    alice.smp.gotSecret(b'secret')
+    bob.smp.gotSecret(b'secret')
+    assert alice.ctx.trust == bob.ctx.trust == 'smp'
+
+
+def rate(func, seconds):
+    count = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        func()
+        count += 1
+    return count / (time.time() - start)
+
+
+def dh_latency(count, pause):
+    total = 0
+    for _ in range(count):
+        time.sleep(pause)
+        start = time.time()
+        crypt.DH()
+        total += time.time() - start
+    return total / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--no-table', action='store_true')
+    parser.add_argument('--pool', type=int, metavar='DEPTH')
+    args = parser.parse_args()
+
+    if args.no_table:
+        crypt.GENERATOR.maxbits = 0
+    # Build the table before measuring
+    crypt.GENERATOR.pow(2)
+
+    print('DH() latency:     %.2f ms' % (1000 * dh_latency(20, 0.05)))
+    if args.pool:
+        pool = crypt.startKeyPool(args.pool)
+        print('DH() latency, pool: %.2f ms' % (1000 * dh_latency(20, 0.05)))
+
+    alice_key, bob_key = generateDefaultKey(), generateDefaultKey()
+    print('AKE handshakes/s: %.2f' % rate(
+        lambda: handshake(alice_key, bob_key), args.seconds))
+
+    alice_ake, bob_ake = handshake(alice_key, bob_key)
+    print('SMP runs/s:       %.2f' % rate(
+        lambda: smp(alice_ake, bob_ake, alice_key, bob_key), args.seconds))
+    if args.pool:
+        print('Pool: %r' % pool.stats())
+
+
+if __name__ == '__main__':
+    main()
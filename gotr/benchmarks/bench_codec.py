@@ -0,0 +1,100 @@
+""" Measure encoding and parsing of all OTR message and TLV types.
+
+    Every message is encoded with bytes() and parsed again the way
+    Context.parse() does it, the results are checked to round-trip. Run from
+    the gotr directory with ``python benchmarks/bench_codec.py``. Data
+    messages are measured with several payload sizes, --sizes changes them.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import time
+
+from potr import proto
+
+
+def mpis(count, rng):
+    return [rng.getrandbits(1536) for _ in range(count)]
+
+
+def messages(sizes, rng):
+    """ (name, message) of every type, data messages once per size. """
+    result = [
+        ('DHCommit', proto.DHCommit(os.urandom(196), os.urandom(32))),
+        ('DHKey', proto.DHKey(os.urandom(196))),
+        ('RevealSig', proto.RevealSig(os.urandom(16), os.urandom(490),
+                                      os.urandom(20))),
+        ('Signature', proto.Signature(os.urandom(490), os.urandom(20))),
+    ]
+    for size in sizes:
+        result.append(('DataMessage %d B' % size, proto.DataMessage(
+            0, 2, 3, os.urandom(192), os.urandom(8), os.urandom(size),
+            os.urandom(20), os.urandom(40))))
+    return result
+
+
+def tlvs(rng):
+    """ (name, encoded TLVs) of every TLV type. """
+    return [
+        ('PaddingTLV', [proto.PaddingTLV(os.urandom(64))]),
+        ('DisconnectTLV', [proto.DisconnectTLV()]),
+        ('SMP1TLV', [proto.SMP1TLV(mpis(6, rng))]),
+        ('SMP1QTLV', [proto.SMP1QTLV(b'question?', mpis(6, rng))]),
+        ('SMP2TLV', [proto.SMP2TLV(mpis(11, rng))]),
+        ('SMP3TLV', [proto.SMP3TLV(mpis(8, rng))]),
+        ('SMP4TLV', [proto.SMP4TLV(mpis(3, rng))]),
+        ('SMPABORTTLV', [proto.SMPABORTTLV()]),
+        ('ExtraKeyTLV', [proto.ExtraKeyTLV(b'\0\0\0\1', os.urandom(32))]),
+        ('SMP2TLV + padding', [proto.SMP2TLV(mpis(11, rng)),
+                               proto.PaddingTLV(os.urandom(256))]),
+        ('500 PaddingTLVs', [proto.PaddingTLV(os.urandom(16))
+                             for _ in range(500)]),
+    ]
+
+
+def rate(func, seconds):
+    count = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        func()
+        count += 1
+    return count / (time.time() - start)
+
+
+def parse_message(cls, data):
+    # Context.parse() skips '?OTR:' and the 4 base64 characters of the
+    # version and type
+    return cls.parsePayload(data[9:])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--seconds', type=float, default=1)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 10000, 50000])
+    args = parser.parse_args()
+    rng = random.Random(0)
+
+    print('%-24s %12s %12s' % ('', 'encode/s', 'parse/s'))
+    for name, msg in messages(args.sizes, rng):
+        data = bytes(msg)
+        assert parse_message(msg.__class__, data) == msg
+        assert bytes(parse_message(msg.__class__, data)) == data
+        print('%-24s %12.0f %12.0f' % (
+            name, rate(lambda: bytes(msg), args.seconds),
+            rate(lambda: parse_message(msg.__class__, data), args.seconds)))
+
+    for name, values in tlvs(rng):
+        data = b''.join([bytes(tlv) for tlv in values])
+        assert proto.TLV.parse(data) == values
+        print('%-24s %12.0f %12.0f' % (
+            name,
+            rate(lambda: b''.join([bytes(tlv) for tlv in values]),
+                 args.seconds),
+            rate(lambda: proto.TLV.parse(data), args.seconds)))
+
+
+if __name__ == '__main__':
+    main()
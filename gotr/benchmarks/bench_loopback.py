@@ -0,0 +1,252 @@
+""" Run whole OTR conversations between two accounts in one process.
+
+    Two potr Accounts talk through an in-memory transport instead of two
+    Gajim instances, no GTK is needed. The conversation runs AKE
+    handshakes, data messages sent with sendFragmented() for every
+    --mms value (0 does not fragment) and SMP runs, every received message
+    is checked. Timings, stanzas and bytes on the wire and allocations are
+    reported per phase: the peak of traced memory where tracemalloc exists
+    and the net number of objects tracked by the gc everywhere. Run from
+    the gotr directory with ``python benchmarks/bench_loopback.py``,
+    --json prints the results for comparing runs.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import gc
+import json
+import resource
+import string
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2
+    tracemalloc = None
+
+from potr import context, crypt
+from potr.compatcrypto import generateDefaultKey
+
+POLICY = {
+    'ALLOW_V1': False,
+    'ALLOW_V2': True,
+    'REQUIRE_ENCRYPTION': True,
+    'SEND_TAG': False,
+    'WHITESPACE_START_AKE': False,
+    'ERROR_START_AKE': False,
+}
+
+
+class LoopbackContext(context.Context):
+    def getPolicy(self, key):
+        return POLICY[key]
+
+    def inject(self, msg, appdata=None):
+        self.user.wire.send(self, msg)
+
+
+class LoopbackAccount(context.Account):
+    contextclass = LoopbackContext
+
+    def __init__(self, name, privkey, wire):
+        super(LoopbackAccount, self).__init__(name, 'xmpp', 0, privkey)
+        self.wire = wire
+
+    def loadPrivkey(self):
+        return None
+
+    def savePrivkey(self):
+        pass
+
+    def saveTrusts(self):
+        pass
+
+
+class Wire(object):
+    """ Queues injected messages and delivers them to the other context.
+
+    Delivering from a queue instead of calling receiveMessage() from
+    inject() keeps the replies of a context from running inside its own
+    receiveMessage().
+    """
+
+    def __init__(self):
+        self.peers = {}
+        self.queue = collections.deque()
+        self.stanzas = 0
+        self.bytes = 0
+
+    def connect(self, alice, bob):
+        self.peers[alice] = bob
+        self.peers[bob] = alice
+
+    def send(self, ctx, msg):
+        self.stanzas += 1
+        self.bytes += len(msg)
+        self.queue.append((self.peers[ctx], msg))
+
+    def pump(self):
+        """ Deliver until both sides are quiet, return the plaintexts as
+        (receiving context, message) tuples. """
+        received = []
+        while self.queue:
+            ctx, msg = self.queue.popleft()
+            plaintext, tlvs = ctx.receiveMessage(msg)
+            if plaintext:
+                received.append((ctx, plaintext))
+        return received
+
+
+class Session(object):
+    def __init__(self, alice_key, bob_key, wire=None):
+        self.wire = Wire() if wire is None else wire
+        self.alice = LoopbackAccount('alice@example.com', alice_key,
+                                     self.wire).getContext('bob@example.com')
+        self.bob = LoopbackAccount('bob@example.com', bob_key,
+                                   self.wire).getContext('alice@example.com')
+        self.wire.connect(self.alice, self.bob)
+
+    def set_mms(self, mms):
+        self.alice.user.maxMessageSize = mms
+        self.bob.user.maxMessageSize = mms
+
+    def ake(self):
+        # a query is returned instead of injected, it is never fragmented
+        self.wire.send(self.alice, self.alice.sendMessage(
+            context.FRAGMENT_SEND_ALL, b'?OTRv2?'))
+        self.wire.pump()
+        assert self.alice.state == self.bob.state == context.STATE_ENCRYPTED
+
+    def send(self, msg):
+        self.alice.sendMessage(context.FRAGMENT_SEND_ALL, msg)
+        received = self.wire.pump()
+        assert received == [(self.bob, msg)], 'message did not round-trip'
+
+    def smp(self, secret=b'secret'):
+        self.alice.smpInit(secret)
+        self.wire.pump()
+        self.bob.smpGotSecret(secret)
+        self.wire.pump()
+        assert self.alice.smpIsSuccess() and self.bob.smpIsSuccess()
+
+
+class Phase(object):
+    """ Measures the time, the traffic and the allocations of a phase. """
+
+    def __init__(self, name, wire, ops):
+        self.name = name
+        self.wire = wire
+        self.ops = ops
+
+    def __enter__(self):
+        gc.collect()
+        self.objects = len(gc.get_objects())
+        self.maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.stanzas, self.bytes = self.wire.stanzas, self.wire.bytes
+        if tracemalloc is not None:
+            tracemalloc.start()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.time() - self.start
+        self.peak = None
+        if tracemalloc is not None:
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        gc.collect()
+        self.objects = len(gc.get_objects()) - self.objects
+        self.maxrss = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss - self.maxrss
+        self.stanzas = self.wire.stanzas - self.stanzas
+        self.bytes = self.wire.bytes - self.bytes
+
+    def result(self):
+        return {
+            'phase': self.name,
+            'ops': self.ops,
+            'seconds': self.seconds,
+            'ops_per_second': self.ops / self.seconds,
+            'stanzas': self.stanzas,
+            'bytes': self.bytes,
+            'peak_alloc_bytes': self.peak,
+            'net_objects': self.objects,
+            'maxrss_growth_kib': self.maxrss,
+        }
+
+
+def payload(size):
+    # no NUL bytes, they end the plaintext before the TLVs
+    letters = string.ascii_letters.encode('ascii')
+    return (letters * (size // len(letters) + 1))[:size]
+
+
+def run(alice_key, bob_key, handshakes=10, count=100, size=1000,
+        mms_values=(0, 1024, 400), smp_runs=5):
+    """ Run all phases, return the result dict of each phase. """
+    results = []
+    wire = Wire()
+    # Build the table of the DH generator before measuring
+    crypt.GENERATOR.pow(2)
+    with Phase('ake', wire, handshakes) as phase:
+        for _ in range(handshakes):
+            session = Session(alice_key, bob_key, wire)
+            session.ake()
+    results.append(phase.result())
+
+    msg = payload(size)
+    for mms in mms_values:
+        session.set_mms(mms)
+        with Phase('data mms=%d' % mms, wire, count) as phase:
+            for _ in range(count):
+                session.send(msg)
+        results.append(phase.result())
+
+    with Phase('smp', wire, smp_runs) as phase:
+        for _ in range(smp_runs):
+            session.smp()
+    results.append(phase.result())
+    return results
+
+
+def print_table(results):
+    print('%-16s %8s %10s %10s %8s %10s %10s %10s' % (
+        '', 'ops', 'ms/op', 'ops/s', 'stanzas', 'wire KiB', 'peak KiB',
+        'objects'))
+    for result in results:
+        peak = result['peak_alloc_bytes']
+        print('%-16s %8d %10.3f %10.1f %8d %10.1f %10s %10d' % (
+            result['phase'], result['ops'],
+            1000 * result['seconds'] / result['ops'],
+            result['ops_per_second'], result['stanzas'],
+            result['bytes'] / 1024.0,
+            '-' if peak is None else '%.1f' % (peak / 1024.0),
+            result['net_objects']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--handshakes', type=int, default=10)
+    parser.add_argument('--count', type=int, default=100,
+                        help='data messages per --mms value')
+    parser.add_argument('--size', type=int, default=1000,
+                        help='bytes of plaintext per data message')
+    parser.add_argument('--mms', type=int, nargs='+', default=[0, 1024, 400],
+                        help='maximum message sizes, 0 does not fragment')
+    parser.add_argument('--smp', type=int, default=5)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    alice_key, bob_key = generateDefaultKey(), generateDefaultKey()
+    results = run(alice_key, bob_key, args.handshakes, args.count, args.size,
+                  args.mms, args.smp)
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print_table(results)
+
+
+if __name__ == '__main__':
+    main()
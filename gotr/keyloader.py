@@ -0,0 +1,111 @@
+'''
+Loads or generates the private key of an OTR account in the background.
+
+:copyright: Copyright 2008-2012 Kjell Braden <afflux@pentabarf.de>
+:license: GPL
+'''
+
+import logging
+import threading
+
+from potr import compatcrypto
+
+log = logging.getLogger('gajim.plugin_system.otr')
+
+STATE_IDLE = 'idle'
+STATE_LOADING = 'loading'
+STATE_GENERATING = 'generating'
+STATE_READY = 'ready'
+STATE_FAILED = 'failed'
+
+
+class PrivkeyLoader(object):
+    '''
+    Reads the private key of an account in a thread and generates a new one
+    if there is none, which takes seconds.
+
+    Account.getPrivkey() has to hold lock, so a key needed right away waits
+    for the thread instead of generating a second key. Changes of the state
+    are passed to on_state and the callbacks queued with when_ready() run
+    once the key is ready, both from the main loop through idle_add.
+    '''
+
+    def __init__(self, account, idle_add, on_state=None):
+        self.account = account
+        self.idle_add = idle_add
+        self.on_state = on_state
+        self.lock = threading.RLock()
+        self.state = STATE_IDLE
+        # a new key was generated, not loaded
+        self.generated = False
+        self.waiting = []
+
+    def start(self):
+        ''' Start loading the key, unless it is loaded or being loaded. '''
+        if self.busy():
+            return
+        if self.account.privkey is not None:
+            self.set_state(STATE_READY)
+            return
+        self.state = STATE_LOADING
+        thread = threading.Thread(target=self.run,
+                name='otr-privkey-' + self.account.accountname)
+        thread.daemon = True
+        thread.start()
+
+    def ready(self):
+        ''' The main loop saw the key ready and the queued callbacks ran.
+        The thread sets account.privkey earlier, checking that would let
+        a callback overtake the queued ones. '''
+        return self.state == STATE_READY and not self.waiting
+
+    def pending(self):
+        ''' Callbacks have to be queued to keep their order: the main loop
+        did not see the key ready or failed yet, or queued callbacks did
+        not run. '''
+        return self.state not in (STATE_READY, STATE_FAILED) \
+                or bool(self.waiting)
+
+    def busy(self):
+        return self.state in (STATE_LOADING, STATE_GENERATING)
+
+    def when_ready(self, callback, *args):
+        ''' Call callback with args once the key is ready, right away if it
+        already is. The key is loaded if that did not start yet. '''
+        if self.ready():
+            callback(*args)
+            return
+        self.waiting.append((callback, args))
+        self.start()
+
+    def run(self):
+        try:
+            with self.lock:
+                if self.account.privkey is None:
+                    self.account.privkey = self.account.loadPrivkey()
+                if self.account.privkey is None:
+                    self.idle_add(self.set_state, STATE_GENERATING)
+                    log.info('Generating a private key for %s',
+                            self.account.name)
+                    self.account.privkey = compatcrypto.generateDefaultKey()
+                    self.account.savePrivkey()
+                    self.generated = True
+            state = STATE_READY
+        except Exception:
+            log.exception('Loading the private key for %s failed',
+                    self.account.name)
+            state = STATE_FAILED
+        self.idle_add(self.set_state, state)
+
+    def set_state(self, state):
+        self.state = state
+        if self.on_state is not None:
+            self.on_state(self, state)
+        if state in (STATE_READY, STATE_FAILED):
+            # after a failure getPrivkey() generates the key when the
+            # callbacks need it
+            waiting, self.waiting = self.waiting, []
+            for callback, args in waiting:
+                callback(*args)
+        # do not repeat the idle callback
+        return False
@@ -45,6 +45,14 @@ DEFAULTFLAGS = {
 
 MMS = 1024
 PROTOCOL = 'xmpp'
+# DH keypairs generated ahead of the key rotations
+DH_POOL_DEPTH = 8
+# seconds after which unencrypted contexts without a chat window are dropped
+CONTEXT_TTL = 3600
+# contexts kept per account at most
+MAX_CONTEXTS = 200
+# seconds between two checks for idle contexts
+CONTEXT_EVICT_INTERVAL = 300
 
 MINVERSION_OUTGOING_MSG_STAZA = "0.16.4"
 
@@ -57,8 +65,12 @@ inactive_tip = 'Communication to this contact is currently ' \
         '<i>unencrypted</i>'
 msg_not_send = _('Your message was not send. Either end '
                  'your private conversation, or restart it')
+key_generating_msg = _('Generating your private key. This can take a while, '
+                       'OTR messages are processed once it is ready.')
 
 
+import atexit
+import gobject
 import logging
 import nbxmpp
 import os
@@ -77,6 +89,7 @@ from plugins.helpers import log_calls, log
 from plugins.plugin import GajimPluginException
 
 import ui
+from truststore import TrustStore
 
 sys.path.insert(0, os.path.dirname(ui.__file__))
 
@@ -99,6 +112,7 @@ try:
     import potr
     import potr.crypt
     import potr.context
+    from keyloader import PrivkeyLoader, STATE_GENERATING, STATE_READY
     if not hasattr(potr, 'VERSION') or potr.VERSION < MINVERSION:
         raise ImportError('old / unsupported python-otr version')
 
@@ -123,6 +137,18 @@ try:
             self.trustName = self.jid
             self.smpWindow = ui.ContactOtrSmpWindow(self)
 
+        def mayEvict(self):
+            # keep contexts the user is looking at
+            if not super(GajimContext, self).mayEvict():
+                return False
+            if self.smpWindow.window.get_property('visible'):
+                return False
+            return OtrPlugin.get_control(self.peer,
+                    self.user.accountname) is None
+
+        def teardown(self):
+            self.smpWindow.window.destroy()
+
         def inject(self, msg, appdata=None):
             log.debug('inject(appdata=%s)', appdata)
             msg = unicode(msg)
@@ -189,7 +215,17 @@ try:
             self.accountname = accountname
             name = gajim.get_jid_from_account(accountname)
             super(GajimOtrAccount, self).__init__(name, PROTOCOL, MMS)
+            self.contextTTL = CONTEXT_TTL
+            self.maxContexts = MAX_CONTEXTS
             self.keyFilePath = os.path.join(gajim.gajimpaths.data_root, accountname)
+            self.trustStore = TrustStore(self.keyFilePath + '.trusts.db')
+            self.keyLoader = PrivkeyLoader(self, gobject.idle_add,
+                    plugin.privkey_state_changed)
+
+        def getPrivkey(self, autogen=True):
+            # wait for the key loader instead of generating a second key
+            with self.keyLoader.lock:
+                return super(GajimOtrAccount, self).getPrivkey(autogen)
 
         def dropPrivkey(self):
             try:
@@ -219,35 +255,43 @@ try:
                         self.name)
 
         def loadTrusts(self, newCtxCb=None):
-            ''' load the fingerprint trustdb '''
-            # it has the same format as libotr, therefore the
-            # redundant account / proto field
+            ''' open the fingerprint trustdb, the trusts of a contact are
+            read when they are first needed '''
+            if not self.trustStore.open():
+                return
+            # the fpr file of earlier versions is imported until that
+            # succeeded once. it has the same format as libotr, therefore
+            # the redundant account / proto field
             try:
-                with open(self.keyFilePath + '.fpr', 'r') as fprFile:
-                    for line in fprFile:
-                        ctx, acc, proto, fpr, trust = line[:-1].split('\t')
-
-                        if acc != self.name or proto != PROTOCOL:
-                            continue
-
-                        jid = get_jid_from_fjid(ctx)
-                        self.setTrust(jid, fpr, trust)
-            except IOError, e:
-                if e.errno != 2:
-                    log.exception('IOError occurred when loading fpr file for %s',
-                            self.name)
+                count = self.trustStore.import_fpr(self.keyFilePath + '.fpr',
+                        self.name, PROTOCOL, get_jid_from_fjid)
+                log.info('Imported %d fingerprints for %s', count, self.name)
+            except (IOError, ValueError), e:
+                log.exception('Error occurred when importing fpr file for %s',
+                        self.name)
 
         def saveTrusts(self):
+            ''' every trust change is written to the trustdb right away,
+            this only exports it to the libotr compatible fpr file. a file
+            that could not be imported yet is kept for the next start '''
+            if self.trustStore.conn is None or not self.trustStore.changed \
+            or not self.trustStore.imported:
+                return
             try:
-                with open(self.keyFilePath + '.fpr', 'w') as fprFile:
-                    for uid, trusts in self.trusts.iteritems():
-                        for fpr, trustVal in trusts.iteritems():
-                            fprFile.write('\t'.join(
-                                    (uid, self.name, PROTOCOL, fpr, trustVal)))
-                            fprFile.write('\n')
-            except IOError, e:
-                log.exception('IOError occurred when loading fpr file for %s',
+                self.trustStore.export_fpr(self.keyFilePath + '.fpr',
+                        self.name, PROTOCOL)
+            except (IOError, OSError), e:
+                log.exception('IOError occurred when saving fpr file for %s',
                         self.name)
+
+        def setTrust(self, key, fingerprint, trustLevel):
+            self.trustStore.set(key, fingerprint, trustLevel)
+
+        def getTrust(self, key, fingerprint, default=None):
+            return self.trustStore.get(key, fingerprint, default)
+
+        def removeFingerprint(self, key, fingerprint):
+            self.trustStore.remove(key, fingerprint)
 except ImportError:
     HAS_POTR = False
 
@@ -259,6 +303,7 @@ class OtrPlugin(GajimPlugin):
     def init(self):
 
         self.us = {}
+        self.evict_timeout_id = None
 
 
         if not HAS_POTR:
@@ -279,6 +324,8 @@ class OtrPlugin(GajimPlugin):
                 self.handle_incoming_msg)
         self.events_handlers['before-change-show'] = (ged.PRECORE,
                 self.handle_change_show)
+        self.events_handlers['signed-in'] = (ged.PRECORE,
+                self.handle_signed_in)
         if LooseVersion(gajim.config.get('version')) < LooseVersion(MINVERSION_OUTGOING_MSG_STAZA):
             self.events_handlers['message-outgoing'] = (ged.OUT_PRECORE,
                     self.handle_outgoing_msg)
@@ -293,6 +340,7 @@ class OtrPlugin(GajimPlugin):
         for acc in gajim.contacts.get_accounts():
             self.us[acc] = GajimOtrAccount(self, acc)
             self.us[acc].loadTrusts()
+            atexit.register(self.us[acc].saveTrusts)
 
             acc = str(acc)
             if acc not in self.config or None not in self.config[acc]:
@@ -304,6 +352,27 @@ class OtrPlugin(GajimPlugin):
         if not HAS_CRYPTO or not HAS_POTR or not hasattr(potr, 'VERSION') \
         or potr.VERSION < MINVERSION:
             raise GajimPluginException(self.available_text)
+        potr.crypt.startKeyPool(DH_POOL_DEPTH)
+        self.evict_timeout_id = gobject.timeout_add_seconds(
+                CONTEXT_EVICT_INTERVAL, self.evict_contexts)
+        for account, us in self.us.iteritems():
+            if us.trustStore.conn is None:
+                # closed by an earlier deactivate
+                us.loadTrusts()
+            if gajim.account_is_connected(account):
+                us.keyLoader.start()
+
+    @log_calls('OtrPlugin')
+    def deactivate(self):
+        if self.evict_timeout_id is not None:
+            gobject.source_remove(self.evict_timeout_id)
+            self.evict_timeout_id = None
+        if potr.crypt.DH.pool is not None:
+            log.debug('DH keypair pool: %s', potr.crypt.DH.pool.stats())
+        potr.crypt.stopKeyPool()
+        for us in self.us.itervalues():
+            us.saveTrusts()
+            us.trustStore.close()
 
     def get_otr_status(self, account, contact):
         ctx = self.us[account].getContext(contact.get_full_jid())
@@ -313,6 +382,42 @@ class OtrPlugin(GajimPlugin):
         trusted = encrypted and bool(ctx.getCurrentTrust())
         return (encrypted, trusted, finished)
 
+    def evict_contexts(self):
+        ''' drop the idle contexts of all accounts '''
+        evicted = sum(us.evictContexts() for us in self.us.itervalues())
+        if evicted:
+            log.debug('Dropped %d idle OTR contexts', evicted)
+            self.update_context_list()
+        # keep the timeout running
+        return True
+
+    def handle_signed_in(self, event):
+        # load or generate the private key before the first OTR message
+        if event.conn.name in self.us:
+            self.us[event.conn.name].keyLoader.start()
+
+    def privkey_state_changed(self, loader, state):
+        ''' show the private key generation in the chat windows of the
+        account '''
+        if state == STATE_GENERATING:
+            text = key_generating_msg
+        elif state == STATE_READY and loader.generated:
+            text = _('Your private key is ready.')
+        else:
+            return
+        for ctrl in gajim.interface.msg_win_mgr.get_controls(
+                acct=loader.account.accountname):
+            if ctrl.TYPE_ID == TYPE_CHAT:
+                ctrl.print_conversation_line(u'[OTR] %s' % text, 'status',
+                        '', None)
+
+    @staticmethod
+    def raise_incoming_event(event):
+        ''' raise an incoming event again that was held back until the
+        private key was ready '''
+        if not gajim.ged.raise_event(event.name, event):
+            gajim.nec._generate_events_based_on_incoming_event(event)
+
     def cc_connect(self, cc):
         def update_otr(print_status=False):
             enc_status, authenticated, finished = \
@@ -333,6 +438,9 @@ class OtrPlugin(GajimPlugin):
                         'status', '', None)
         cc.update_otr = update_otr
         cc.update_otr(True)
+        if self.us[cc.account].keyLoader.state == STATE_GENERATING:
+            cc.print_conversation_line(u'[OTR] %s' % key_generating_msg,
+                    'status', '', None)
 
         # hijack authentication button with our submenu
         def authbutton_cb(widget):
@@ -429,6 +537,11 @@ class OtrPlugin(GajimPlugin):
 
     def update_context_list(self):
         self.config_dialog.fpr_model.clear()
+        self.config_dialog.context_label.set_text(_('%(live)d open private '
+                'conversation contexts, %(evicted)d idle ones dropped') % {
+                'live': sum(len(us.ctxs) for us in self.us.itervalues()),
+                'evicted': sum(us.evictedContexts
+                        for us in self.us.itervalues())})
         for us in self.us.itervalues():
             usedFpr = set()
             for fjid, ctx in us.ctxs.iteritems():
@@ -455,18 +568,17 @@ class OtrPlugin(GajimPlugin):
                 self.config_dialog.fpr_model.append((fjid, state, trust,
                         '<tt>%s</tt>' % human_hash, us.name, tip, fpr))
 
-            for uid, trusts in us.trusts.iteritems():
-                for fpr, trust in trusts.iteritems():
-                    if fpr in usedFpr:
-                        continue
+            for uid, fpr, trust in us.trustStore.items():
+                if fpr in usedFpr:
+                    continue
 
-                    state = 'inactive'
-                    tip = inactive_tip
+                state = 'inactive'
+                tip = inactive_tip
 
-                    human_hash = potr.human_hash(fpr)
+                human_hash = potr.human_hash(fpr)
 
-                    self.config_dialog.fpr_model.append((uid, state, bool(trust),
-                            '<tt>%s</tt>' % human_hash, us.name, tip, fpr))
+                self.config_dialog.fpr_model.append((uid, state, bool(trust),
+                        '<tt>%s</tt>' % human_hash, us.name, tip, fpr))
 
     @classmethod
     def gajim_log(cls, msg, account, fjid, no_print=False,
@@ -554,6 +666,15 @@ class OtrPlugin(GajimPlugin):
         or not isinstance(event.stanza.getBody(), unicode):
             return PASS
 
+        loader = self.us[account].keyLoader
+        if loader.pending() and is_otr_message(event.msgtxt):
+            # hold OTR messages back until the private key is loaded,
+            # instead of generating it here
+            log.debug('queueing OTR message from %s until the private key '
+                    'is ready', event.fjid)
+            loader.when_ready(self.raise_incoming_event, event)
+            return IGNORE
+
         try:
             ctx = self.us[account].getContext(event.fjid)
             msgtxt, tlvs = ctx.receiveMessage(event.msgtxt.encode('utf8'),
@@ -730,6 +851,11 @@ def escape(s):
     s = s.replace("\n", "<br/>")
     return s
 
+def is_otr_message(text):
+    ''' whether text is an OTR message or starts OTR with a whitespace tag '''
+    return u'?OTR' in text or \
+            potr.proto.MESSAGE_TAG_BASE.decode('ascii') in text
+
 def add_message_processing_hints(stanza):
     stanza.addChild(name='private', namespace=nbxmpp.NS_CARBONS)
     stanza.addChild(name='no-permanent-store', namespace=nbxmpp.NS_MSG_HINTS)
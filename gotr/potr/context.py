@@ -74,6 +74,7 @@ class Context(object):
         self.lastMessage = None
         self.state = STATE_PLAINTEXT
         self.trustName = self.peer
+        self.lastUsed = time()
 
         self.fragmentInfo = None
         self.fragment = None
@@ -92,6 +93,21 @@ class Context(object):
         self.fragmentInfo = (0, 0)
         self.fragment = []
 
+    def mayEvict(self):
+        ''' whether the account may drop this context when it is idle.
+        encrypted contexts, running AKEs and partly received fragmented
+        messages are kept. '''
+        if self.state == STATE_ENCRYPTED:
+            return False
+        ake = self.crypto.ake
+        if ake is not None and ake.state != crypt.STATE_NONE:
+            return False
+        return self.fragmentInfo == (0, 0)
+
+    def teardown(self):
+        ''' called after the account dropped this context '''
+        pass
+
     def fragmentAccumulate(self, message):
         '''Accumulate a fragmented message. Returns None if the fragment is
         to be ignored, returns a string if the message is ready for further
@@ -501,6 +517,11 @@ class Account(object):
         self.protocol = protocol
         self.ctxs = {}
         self.trusts = {}
+        # seconds after which idle contexts are dropped by evictContexts()
+        self.contextTTL = None
+        # contexts kept at most, least recently used ones are dropped first
+        self.maxContexts = None
+        self.evictedContexts = 0
         self.maxMessageSize = maxMessageSize
         self.defaultQuery = '?OTRv{versions}?\n{accountname} has requested ' \
                 'an Off-the-Record private conversation.  However, you ' \
@@ -536,7 +557,39 @@ class Account(object):
             self.ctxs[uid] = self.contextclass(self, uid)
             if callable(newCtxCb):
                 newCtxCb(self.ctxs[uid])
-        return self.ctxs[uid]
+            if self.maxContexts is not None \
+                    and len(self.ctxs) > self.maxContexts:
+                self.evictContexts(keep=uid)
+        ctx = self.ctxs[uid]
+        ctx.lastUsed = time()
+        return ctx
+
+    def evictContexts(self, now=None, keep=None):
+        ''' drop the contexts that were not used for contextTTL seconds, then
+        the least recently used ones above maxContexts. only contexts whose
+        mayEvict() returns True are dropped, a new context is created for
+        them when they are needed again. returns the number of dropped
+        contexts '''
+        if now is None:
+            now = time()
+        candidates = sorted((ctx.lastUsed, uid)
+                for uid, ctx in self.ctxs.items()
+                if uid != keep and ctx.mayEvict())
+
+        drop = []
+        if self.contextTTL is not None:
+            drop = [ uid for lastUsed, uid in candidates
+                    if now - lastUsed > self.contextTTL ]
+        if self.maxContexts is not None:
+            excess = len(self.ctxs) - len(drop) - self.maxContexts
+            if excess > 0:
+                drop += [ uid for _, uid in
+                        candidates[len(drop):len(drop) + excess] ]
+
+        for uid in drop:
+            self.ctxs.pop(uid).teardown()
+        self.evictedContexts += len(drop)
+        return len(drop)
 
     def getDefaultQueryMessage(self, policy):
         v  = '2' if policy('ALLOW_V2') else ''
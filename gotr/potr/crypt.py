@@ -25,6 +25,8 @@ import struct
 from potr.compatcrypto import SHA256, SHA1, SHA1HMAC, SHA256HMAC, \
         SHA256HMAC160, Counter, AESCTR, PK, random
 from potr.utils import bytes_to_long, long_to_bytes, pack_mpi, read_mpi
+from potr.modexp import FixedBase, powmod
+from potr.dhpool import KeyPool, DEFAULT_DEPTH
 from potr import proto
 
 logger = logging.getLogger(__name__)
@@ -43,23 +45,61 @@ DH_BITS = 1536
 DH_MAX = 2**DH_BITS
 SM_ORDER = (DH_MODULUS - 1) // 2
 
+# exponents are at most DH_MAX, see SMPHandler
+GENERATOR = FixedBase(DH_GENERATOR, DH_MODULUS, DH_BITS)
+
+def powMod(base, exp):
+    if base == DH_GENERATOR:
+        return GENERATOR.pow(exp)
+    return powmod(base, exp, DH_MODULUS)
+
 def check_group(n):
     return 2 <= n <= DH_MODULUS_2
 def check_exp(n):
     return 1 <= n < SM_ORDER
 
 class DH(object):
+    # KeyPool with ready keypairs for the OTR group, see startKeyPool()
+    pool = None
+
     @classmethod
     def set_params(cls, prime, gen):
         cls.prime = prime
         cls.gen = gen
 
+    @staticmethod
+    def generate(gen, prime):
+        priv = random.randrange(2, 2**320)
+        if (gen, prime) == (DH_GENERATOR, DH_MODULUS):
+            return priv, GENERATOR.pow(priv)
+        return priv, powmod(gen, priv, prime)
+
     def __init__(self):
-        self.priv = random.randrange(2, 2**320)
-        self.pub = pow(self.gen, self.priv, self.prime)
+        keypair = None
+        if self.pool is not None \
+                and (self.gen, self.prime) == (DH_GENERATOR, DH_MODULUS):
+            keypair = self.pool.get()
+        if keypair is None:
+            keypair = self.generate(self.gen, self.prime)
+        self.priv, self.pub = keypair
 
 DH.set_params(DH_MODULUS, DH_GENERATOR)
 
+def startKeyPool(depth=DEFAULT_DEPTH):
+    ''' keep depth DH keypairs ready in a background thread. DH() takes
+    them from the pool and only generates inline if it is empty. '''
+    if DH.pool is None:
+        DH.pool = KeyPool(lambda: DH.generate(DH_GENERATOR, DH_MODULUS),
+                depth)
+    DH.pool.resize(depth)
+    DH.pool.start()
+    return DH.pool
+
+def stopKeyPool():
+    if DH.pool is not None:
+        DH.pool.stop()
+        DH.pool = None
+
 class DHSession(object):
     def __init__(self, sendenc, sendmac, rcvenc, rcvmac):
         self.sendenc = sendenc
@@ -78,7 +118,7 @@ class DHSession(object):
 
     @classmethod
     def create(cls, dh, y):
-        s = pow(y, dh.priv, DH_MODULUS)
+        s = powMod(y, dh.priv)
         sb = pack_mpi(s)
 
         if dh.pub > y:
@@ -344,7 +384,7 @@ class AuthKeyExchange(object):
         self.lastmsg = None
 
     def startAKE(self):
-        self.r = long_to_bytes(random.getrandbits(128))
+        self.r = long_to_bytes(random.getrandbits(128), 16)
 
         gxmpi = pack_mpi(self.dh.pub)
 
@@ -445,7 +485,7 @@ class AuthKeyExchange(object):
         self.state = STATE_NONE
 
     def createAuthKeys(self):
-        s = pow(self.gy, self.dh.priv, DH_MODULUS)
+        s = powMod(self.gy, self.dh.priv)
         sbyte = pack_mpi(s)
         self.sessionId = SHA256(b'\x00' + sbyte)[:8]
         enc = SHA256(b'\x01' + sbyte)
@@ -546,8 +586,8 @@ class SMPHandler:
             self.x2 = random.randrange(2, DH_MAX)
             self.x3 = random.randrange(2, DH_MAX)
 
-            self.g2 = pow(msg[0], self.x2, DH_MODULUS)
-            self.g3 = pow(msg[3], self.x3, DH_MODULUS)
+            self.g2 = powMod(msg[0], self.x2)
+            self.g3 = powMod(msg[3], self.x3)
 
             self.prog = SMPPROG_OK
             self.state = 0
@@ -572,8 +612,8 @@ class SMPHandler:
                 return
 
             self.g3o = msg[3]
-            self.g2 = pow(msg[0], self.x2, DH_MODULUS)
-            self.g3 = pow(msg[3], self.x3, DH_MODULUS)
+            self.g2 = powMod(msg[0], self.x2)
+            self.g3 = powMod(msg[3], self.x3)
 
             if not self.check_equal_coords(msg[6:11], 5):
                 logger.error('invalid SMP2TLV received')
@@ -581,10 +621,10 @@ class SMPHandler:
                 return
 
             r = random.randrange(2, DH_MAX)
-            self.p = pow(self.g3, r, DH_MODULUS)
+            self.p = powMod(self.g3, r)
             msg = [self.p]
-            qa1 = pow(self.g1, r, DH_MODULUS)
-            qa2 = pow(self.g2, self.secret, DH_MODULUS)
+            qa1 = powMod(self.g1, r)
+            qa2 = powMod(self.g2, self.secret)
             self.q = qa1*qa2 % DH_MODULUS
             msg.append(self.q)
             msg += self.proof_equal_coords(r, 6)
@@ -594,7 +634,7 @@ class SMPHandler:
             inv = invMod(mq)
             self.qab = self.q * inv % DH_MODULUS
 
-            msg.append(pow(self.qab, self.x3, DH_MODULUS))
+            msg.append(powMod(self.qab, self.x3))
             msg += self.proof_equal_logs(7)
 
             self.state = 4
@@ -627,10 +667,10 @@ class SMPHandler:
                 return
 
             md = msg[5]
-            msg = [pow(self.qab, self.x3, DH_MODULUS)]
+            msg = [powMod(self.qab, self.x3)]
             msg += self.proof_equal_logs(8)
 
-            rab = pow(md, self.x3, DH_MODULUS)
+            rab = powMod(md, self.x3)
             self.prog = SMPPROG_SUCCEEDED if self.pab == rab else SMPPROG_FAILED
 
             if self.prog != SMPPROG_SUCCEEDED:
@@ -658,7 +698,7 @@ class SMPHandler:
                 self.abort(appdata=appdata)
                 return
 
-            rab = pow(msg[0], self.x3, DH_MODULUS)
+            rab = powMod(msg[0], self.x3)
 
             self.prog = SMPPROG_SUCCEEDED if self.pab == rab else SMPPROG_FAILED
 
@@ -686,9 +726,9 @@ class SMPHandler:
             self.x2 = random.randrange(2, DH_MAX)
             self.x3 = random.randrange(2, DH_MAX)
 
-            msg = [pow(self.g1, self.x2, DH_MODULUS)]
+            msg = [powMod(self.g1, self.x2)]
             msg += proof_known_log(self.g1, self.x2, 1)
-            msg.append(pow(self.g1, self.x3, DH_MODULUS))
+            msg.append(powMod(self.g1, self.x3))
             msg += proof_known_log(self.g1, self.x3, 2)
 
             self.prog = SMPPROG_OK
@@ -704,18 +744,18 @@ class SMPHandler:
 
             self.secret = bytes_to_long(combSecret)
 
-            msg = [pow(self.g1, self.x2, DH_MODULUS)]
+            msg = [powMod(self.g1, self.x2)]
             msg += proof_known_log(self.g1, self.x2, 3)
-            msg.append(pow(self.g1, self.x3, DH_MODULUS))
+            msg.append(powMod(self.g1, self.x3))
             msg += proof_known_log(self.g1, self.x3, 4)
 
             r = random.randrange(2, DH_MAX)
 
-            self.p = pow(self.g3, r, DH_MODULUS)
+            self.p = powMod(self.g3, r)
             msg.append(self.p)
 
-            qb1 = pow(self.g1, r, DH_MODULUS)
-            qb2 = pow(self.g2, self.secret, DH_MODULUS)
+            qb1 = powMod(self.g1, r)
+            qb2 = powMod(self.g2, self.secret)
             self.q = qb1 * qb2 % DH_MODULUS
             msg.append(self.q)
 
@@ -727,9 +767,9 @@ class SMPHandler:
     def proof_equal_coords(self, r, v):
         r1 = random.randrange(2, DH_MAX)
         r2 = random.randrange(2, DH_MAX)
-        temp2 = pow(self.g1, r1, DH_MODULUS) \
-                * pow(self.g2, r2, DH_MODULUS) % DH_MODULUS
-        temp1 = pow(self.g3, r1, DH_MODULUS)
+        temp2 = powMod(self.g1, r1) \
+                * powMod(self.g2, r2) % DH_MODULUS
+        temp1 = powMod(self.g3, r1)
 
         cb = SHA256(struct.pack(b'B', v) + pack_mpi(temp1) + pack_mpi(temp2))
         c = bytes_to_long(cb)
@@ -743,12 +783,12 @@ class SMPHandler:
 
     def check_equal_coords(self, coords, v):
         (p, q, c, d1, d2) = coords
-        temp1 = pow(self.g3, d1, DH_MODULUS) * pow(p, c, DH_MODULUS) \
+        temp1 = powMod(self.g3, d1) * powMod(p, c) \
                 % DH_MODULUS
 
-        temp2 = pow(self.g1, d1, DH_MODULUS) \
-                * pow(self.g2, d2, DH_MODULUS) \
-                * pow(q, c, DH_MODULUS) % DH_MODULUS
+        temp2 = powMod(self.g1, d1) \
+                * powMod(self.g2, d2) \
+                * powMod(q, c) % DH_MODULUS
 
         cprime = SHA256(struct.pack(b'B', v) + pack_mpi(temp1) + pack_mpi(temp2))
 
@@ -756,8 +796,8 @@ class SMPHandler:
 
     def proof_equal_logs(self, v):
         r = random.randrange(2, DH_MAX)
-        temp1 = pow(self.g1, r, DH_MODULUS)
-        temp2 = pow(self.qab, r, DH_MODULUS)
+        temp1 = powMod(self.g1, r)
+        temp2 = powMod(self.qab, r)
 
         cb = SHA256(struct.pack(b'B', v) + pack_mpi(temp1) + pack_mpi(temp2))
         c = bytes_to_long(cb)
@@ -767,29 +807,29 @@ class SMPHandler:
 
     def check_equal_logs(self, logs, v):
         (r, c, d) = logs
-        temp1 = pow(self.g1, d, DH_MODULUS) \
-                * pow(self.g3o, c, DH_MODULUS) % DH_MODULUS
+        temp1 = powMod(self.g1, d) \
+                * powMod(self.g3o, c) % DH_MODULUS
 
-        temp2 = pow(self.qab, d, DH_MODULUS) \
-                * pow(r, c, DH_MODULUS) % DH_MODULUS
+        temp2 = powMod(self.qab, d) \
+                * powMod(r, c) % DH_MODULUS
 
         cprime = SHA256(struct.pack(b'B', v) + pack_mpi(temp1) + pack_mpi(temp2))
         return long_to_bytes(c, 32) == cprime
 
 def proof_known_log(g, x, v):
     r = random.randrange(2, DH_MAX)
-    c = bytes_to_long(SHA256(struct.pack(b'B', v) + pack_mpi(pow(g, r, DH_MODULUS))))
+    c = bytes_to_long(SHA256(struct.pack(b'B', v) + pack_mpi(powMod(g, r))))
     temp = x * c % SM_ORDER
     return c, (r-temp) % SM_ORDER
 
 def check_known_log(c, d, g, x, v):
-    gd = pow(g, d, DH_MODULUS)
-    xc = pow(x, c, DH_MODULUS)
+    gd = powMod(g, d)
+    xc = powMod(x, c)
     gdxc = gd * xc % DH_MODULUS
     return SHA256(struct.pack(b'B', v) + pack_mpi(gdxc)) == long_to_bytes(c, 32)
 
 def invMod(n):
-    return pow(n, DH_MODULUS_2, DH_MODULUS)
+    return powMod(n, DH_MODULUS_2)
 
 class InvalidParameterError(RuntimeError):
     pass
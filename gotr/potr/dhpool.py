@@ -0,0 +1,130 @@
+#    This file is part of the python-potr library.
+#
+#    python-potr is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    any later version.
+#
+#    python-potr is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+# some python3 compatibilty
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DEPTH = 8
+
+class KeyPool(object):
+    '''
+    Keeps generated DH keypairs ready, so key rotations do not have to wait
+    for a modular exponentiation.
+
+    A daemon thread refills the pool to depth whenever a keypair is taken.
+    The thread only runs while the pool is not full and yields after every
+    keypair, so it does not compete with the main thread for long. get()
+    returns None when the pool is empty, the caller generates the keypair
+    itself then.
+    '''
+
+    def __init__(self, generate, depth=DEFAULT_DEPTH):
+        '''
+        generate is called without arguments in the pool thread and returns
+        a (priv, pub) tuple
+        '''
+        self.generate = generate
+        self.depth = depth
+        self.keys = []
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refillTime = 0.0
+        self.refillMax = 0.0
+
+    def start(self):
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self.run, name='potr-dh-pool')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def resize(self, depth):
+        with self.cond:
+            self.depth = depth
+            self.cond.notify()
+
+    def get(self):
+        ''' a (priv, pub) keypair from the pool, None if it is empty '''
+        with self.cond:
+            if not self.keys:
+                self.misses += 1
+                self.cond.notify()
+                return None
+            self.hits += 1
+            keypair = self.keys.pop(0)
+            self.cond.notify()
+            return keypair
+
+    def stats(self):
+        with self.cond:
+            taken = self.hits + self.misses
+            return {
+                'depth': self.depth,
+                'size': len(self.keys),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / float(taken) if taken else None,
+                'refills': self.refills,
+                'refill_avg': self.refillTime / self.refills
+                        if self.refills else None,
+                'refill_max': self.refillMax,
+            }
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and len(self.keys) >= self.depth:
+                    self.cond.wait()
+                if not self.running:
+                    return
+
+            start = time.time()
+            try:
+                keypair = self.generate()
+            except Exception:
+                logger.exception('generating a DH keypair failed')
+                with self.cond:
+                    self.running = False
+                return
+            duration = time.time() - start
+
+            with self.cond:
+                self.keys.append(keypair)
+                self.refills += 1
+                self.refillTime += duration
+                self.refillMax = max(self.refillMax, duration)
+            # let the main thread run before the next keypair
+            time.sleep(0)
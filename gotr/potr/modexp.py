@@ -0,0 +1,82 @@
+#    This file is part of the python-potr library.
+#
+#    python-potr is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    any later version.
+#
+#    python-potr is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this library.  If not, see <http://www.gnu.org/licenses/>.
+
+# some python3 compatibilty
+from __future__ import unicode_literals
+
+try:
+    import gmpy2
+except ImportError:
+    gmpy2 = None
+
+# bits of the exponent handled per table row
+WINDOW = 6
+
+
+def powmod(base, exp, mod):
+    ''' pow(base, exp, mod), computed with gmpy2 if it is available '''
+    if gmpy2 is not None:
+        return int(gmpy2.powmod(base, exp, mod))
+    return pow(base, exp, mod)
+
+
+class FixedBase(object):
+    '''
+    Modular exponentiation with a fixed base and modulus.
+
+    Keeps a table of base**(digit * 2**(WINDOW*row)) for every WINDOW bit
+    digit of exponents up to maxbits bits, so an exponentiation only needs
+    one multiplication per non-zero digit and no squarings. The table is
+    built on first use. If gmpy2 is available, its powmod is faster than
+    the table and used instead.
+    '''
+
+    def __init__(self, base, mod, maxbits, window=WINDOW):
+        self.base = base
+        self.mod = mod
+        self.maxbits = maxbits
+        self.window = window
+        self.table = None
+
+    def buildTable(self):
+        mask = (1 << self.window) - 1
+        rows = (self.maxbits + self.window - 1) // self.window
+        table = []
+        rowbase = self.base % self.mod
+        for _ in range(rows):
+            row = [1, rowbase]
+            for _ in range(mask - 1):
+                row.append(row[-1] * rowbase % self.mod)
+            table.append(row)
+            rowbase = row[-1] * rowbase % self.mod
+        self.table = table
+
+    def pow(self, exp):
+        if gmpy2 is not None or exp < 0 or exp >> self.maxbits:
+            return powmod(self.base, exp, self.mod)
+        if self.table is None:
+            self.buildTable()
+
+        mod = self.mod
+        mask = (1 << self.window) - 1
+        result = 1
+        for row in self.table:
+            if not exp:
+                break
+            digit = exp & mask
+            if digit:
+                result = result * row[digit] % mod
+            exp >>= self.window
+        return result
@@ -20,7 +20,8 @@ from __future__ import unicode_literals
 
 import base64
 import struct
-from potr.utils import pack_mpi, read_mpi, pack_data, read_data, unpack
+from potr.utils import pack_mpi, get_struct, unpack_from, \
+        read_data_from, read_mpi_from
 
 OTRTAG = b'?OTR'
 MESSAGE_TAG_BASE = b' \t  \t\t\t\t \t \t \t  '
@@ -44,6 +45,9 @@ MSGTYPE_UNKNOWN = -1
 
 MSGFLAGS_IGNORE_UNREADABLE = 1
 
+HEADER = struct.Struct(b'!HB')
+LENGTH = struct.Struct(b'!I')
+
 tlvClasses = {}
 messageClasses = {}
 
@@ -208,9 +212,9 @@ class GenericOTRMessage(OTRMessage):
             self.data[attr] = val
 
     def __bytes__(self):
-        data = struct.pack(b'!HB', self.version, self.msgtype) \
-                + self.getPayload()
-        return b'?OTR:' + base64.b64encode(data) + b'.'
+        parts = self.getPayloadParts()
+        parts.insert(0, HEADER.pack(self.version, self.msgtype))
+        return b'?OTR:' + base64.b64encode(b''.join(parts)) + b'.'
 
     def __repr__(self):
         name = self.__class__.__name__
@@ -222,30 +226,37 @@ class GenericOTRMessage(OTRMessage):
     @classmethod
     def parsePayload(cls, data):
         data = base64.b64decode(data)
+        offset = 0
         args = []
         for _, ftype in cls.fields:
             if ftype == 'data':
-                value, data = read_data(data)
+                value, offset = read_data_from(data, offset)
             elif isinstance(ftype, bytes):
-                value, data = unpack(ftype, data)
+                value, offset = unpack_from(ftype, data, offset)
             elif isinstance(ftype, int):
-                value, data = data[:ftype], data[ftype:]
+                value = data[offset:offset+ftype]
+                offset += ftype
             args.append(value)
         return cls(*args)
 
-    def getPayload(self, *ffilter):
-        payload = b''
+    def getPayloadParts(self, *ffilter):
+        ''' the encoded fields as a list of byte strings, to be joined once '''
+        parts = []
         for k, ftype in self.fields:
             if k in ffilter:
                 continue
 
             if ftype == 'data':
-                payload += pack_data(self.data[k])
+                parts.append(LENGTH.pack(len(self.data[k])))
+                parts.append(self.data[k])
             elif isinstance(ftype, bytes):
-                payload += struct.pack(ftype, self.data[k])
+                parts.append(get_struct(ftype).pack(self.data[k]))
             else:
-                payload += self.data[k]
-        return payload
+                parts.append(self.data[k])
+        return parts
+
+    def getPayload(self, *ffilter):
+        return b''.join(self.getPayloadParts(*ffilter))
 
 class AKEMessage(GenericOTRMessage):
     __slots__ = []
@@ -291,8 +302,9 @@ class DataMessage(GenericOTRMessage):
             ('oldmacs', 'data'), ]
 
     def getMacedData(self):
-        return struct.pack(b'!HB', self.version, self.msgtype) + \
-                self.getPayload('mac', 'oldmacs')
+        parts = self.getPayloadParts('mac', 'oldmacs')
+        parts.insert(0, HEADER.pack(self.version, self.msgtype))
+        return b''.join(parts)
 
 @bytesAndStrings
 class TLV(object):
@@ -313,11 +325,14 @@ class TLV(object):
 
     @classmethod
     def parse(cls, data):
-        if not data:
-            return []
-        typ, length, data = unpack(b'!HH', data)
-        return [tlvClasses[typ].parsePayload(data[:length])] \
-                + cls.parse(data[length:])
+        tlvs = []
+        offset = 0
+        while offset < len(data):
+            typ, length, offset = unpack_from(b'!HH', data, offset)
+            tlvs.append(tlvClasses[typ].parsePayload(
+                    data[offset:offset+length]))
+            offset += length
+        return tlvs
 
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
@@ -380,20 +395,19 @@ class SMPTLV(TLV):
         self.mpis = mpis
 
     def getPayload(self):
-        d = struct.pack(b'!I', len(self.mpis))
-        for n in self.mpis:
-            d += pack_mpi(n)
-        return d
+        return LENGTH.pack(len(self.mpis)) \
+                + b''.join([ pack_mpi(n) for n in self.mpis ])
 
     @classmethod
     def parsePayload(cls, data):
+        offset = 0
         mpis = []
         if cls.dlen > 0:
-            count, data = unpack(b'!I', data)
+            count, offset = unpack_from(b'!I', data, offset)
             for _ in range(count):
-                n, data = read_mpi(data)
+                n, offset = read_mpi_from(data, offset)
                 mpis.append(n)
-        if len(data) > 0:
+        if len(data) > offset:
             raise TypeError('too much data for {0} mpis'.format(cls.dlen))
         return cls(mpis)
 
@@ -19,6 +19,7 @@
 from __future__ import unicode_literals
 
 
+import binascii
 import struct
 
 def pack_mpi(n):
@@ -35,20 +36,39 @@ def unpack(fmt, buf):
     s = struct.Struct(fmt)
     return s.unpack(buf[:s.size]) + (buf[s.size:],)
 
+# offset based variants of the readers above. They return the new offset
+# instead of the remaining data, so reading a field only copies the field
+# and not the rest of the message.
+_structs = {}
+def get_struct(fmt):
+    s = _structs.get(fmt)
+    if s is None:
+        s = _structs[fmt] = struct.Struct(fmt)
+    return s
+def unpack_from(fmt, data, offset):
+    s = get_struct(fmt)
+    return s.unpack_from(data, offset) + (offset + s.size,)
+def read_data_from(data, offset):
+    datalen, offset = unpack_from(b'!I', data, offset)
+    return data[offset:offset+datalen], offset + datalen
+def read_mpi_from(data, offset):
+    n, offset = read_data_from(data, offset)
+    return bytes_to_long(n), offset
+
 
 def bytes_to_long(b):
-    l = len(b)
-    s = 0
-    for i in range(l):
-        s += byte_to_long(b[i:i+1]) << 8*(l-i-1)
-    return s
+    if not b:
+        return 0
+    return int(binascii.hexlify(b), 16)
 
 def long_to_bytes(l, n=0):
-    b = b''
-    while l != 0 or n > 0:
-        b = long_to_byte(l & 0xff) + b
-        l >>= 8
-        n -= 1
+    ''' big endian bytes of l, padded with zero bytes to at least n bytes '''
+    if l == 0:
+        return b'\0' * n
+    h = '%x' % l
+    b = binascii.unhexlify(('0' + h) if len(h) % 2 else h)
+    if len(b) < n:
+        b = b'\0' * (n - len(b)) + b
     return b
 
 def byte_to_long(b):
@@ -0,0 +1,93 @@
+from potr import context, crypt
+
+
+class TrackedContext(context.Context):
+    def __init__(self, account, peer):
+        super(TrackedContext, self).__init__(account, peer)
+        self.tornDown = False
+
+    def teardown(self):
+        self.tornDown = True
+
+
+class FakeAccount(context.Account):
+    contextclass = TrackedContext
+
+    def __init__(self):
+        super(FakeAccount, self).__init__('me@example.com', 'xmpp', 1024)
+
+
+def peer(i):
+    return 'peer%d@example.com/res' % i
+
+
+def test_idle_contexts_are_dropped_after_ttl():
+    account = FakeAccount()
+    account.contextTTL = 100
+    old = account.getContext(peer(1))
+    account.getContext(peer(2))
+    old.lastUsed -= 200
+
+    assert account.evictContexts() == 1
+    assert list(account.ctxs) == [peer(2)]
+    assert old.tornDown
+    assert account.evictedContexts == 1
+    # A dropped context is created again when it is needed
+    assert account.getContext(peer(1)) is not old
+
+
+def test_encrypted_contexts_are_kept():
+    account = FakeAccount()
+    account.contextTTL = 100
+    encrypted = account.getContext(peer(1))
+    encrypted.state = context.STATE_ENCRYPTED
+    finished = account.getContext(peer(2))
+    finished.state = context.STATE_FINISHED
+    for ctx in account.ctxs.values():
+        ctx.lastUsed -= 200
+
+    assert account.evictContexts() == 1
+    assert list(account.ctxs) == [peer(1)]
+    assert not encrypted.tornDown
+
+
+def test_running_ake_and_fragments_are_kept():
+    account = FakeAccount()
+    account.contextTTL = 100
+    ake = account.getContext(peer(1))
+    ake.crypto.ake = crypt.AuthKeyExchange(None, None)
+    ake.crypto.ake.state = crypt.STATE_AWAITING_DHKEY
+    fragmented = account.getContext(peer(2))
+    fragmented.fragmentInfo = (1, 3)
+    for ctx in account.ctxs.values():
+        ctx.lastUsed -= 200
+
+    assert account.evictContexts() == 0
+    assert len(account.ctxs) == 2
+
+
+def test_least_recently_used_contexts_are_dropped_above_maximum():
+    account = FakeAccount()
+    account.maxContexts = 3
+    contexts = [account.getContext(peer(i)) for i in range(3)]
+    for i, ctx in enumerate(contexts):
+        ctx.lastUsed = 1000 + i
+    contexts[1].state = context.STATE_ENCRYPTED
+    # Using a context makes it the most recent one
+    account.getContext(peer(0))
+
+    account.getContext(peer(3))
+    assert sorted(account.ctxs) == [peer(0), peer(1), peer(3)]
+    assert contexts[2].tornDown
+
+    account.getContext(peer(4))
+    assert sorted(account.ctxs) == [peer(1), peer(3), peer(4)]
+    assert account.evictedContexts == 2
+
+
+def test_nothing_is_dropped_without_limits():
+    account = FakeAccount()
+    for i in range(10):
+        account.getContext(peer(i)).lastUsed = 0
+    assert account.evictContexts() == 0
+    assert len(account.ctxs) == 10
@@ -0,0 +1,82 @@
+import threading
+import time
+
+import pytest
+
+from potr import crypt
+from potr.dhpool import KeyPool
+
+
+def wait_for(condition, timeout=30):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def pool():
+    pool = crypt.startKeyPool(3)
+    yield pool
+    crypt.stopKeyPool()
+
+
+def test_pool_is_filled_to_depth(pool):
+    wait_for(lambda: pool.stats()['size'] == 3)
+    time.sleep(0.05)
+    assert pool.stats()['refills'] == 3
+
+
+def test_dh_takes_keypairs_from_pool(pool):
+    wait_for(lambda: pool.stats()['size'] == 3)
+    keys = [crypt.DH() for _ in range(3)]
+    for key in keys:
+        assert key.pub == pow(crypt.DH_GENERATOR, key.priv, crypt.DH_MODULUS)
+    assert len(set(key.priv for key in keys)) == 3
+
+    stats = pool.stats()
+    assert stats['hits'] == 3
+    assert stats['hit_rate'] == 1.0
+    assert stats['refill_avg'] > 0
+    # Taken keypairs are replaced
+    wait_for(lambda: pool.stats()['size'] == 3)
+
+
+def test_empty_pool_falls_back_to_inline_generation():
+    release = threading.Event()
+
+    def generate():
+        release.wait(10)
+        return 1, 2
+
+    pool = KeyPool(generate, depth=1)
+    pool.start()
+    crypt.DH.pool = pool
+    try:
+        key = crypt.DH()
+        assert key.pub == pow(crypt.DH_GENERATOR, key.priv, crypt.DH_MODULUS)
+        assert pool.stats()['misses'] == 1
+        assert pool.stats()['hit_rate'] == 0.0
+    finally:
+        crypt.DH.pool = None
+        release.set()
+        pool.stop()
+
+
+def test_other_groups_do_not_use_pool(pool):
+    wait_for(lambda: pool.stats()['size'] == 3)
+    crypt.DH.set_params(23, 5)
+    try:
+        key = crypt.DH()
+        assert key.pub == pow(5, key.priv, 23)
+    finally:
+        crypt.DH.set_params(crypt.DH_MODULUS, crypt.DH_GENERATOR)
+    assert pool.stats()['hits'] == 0
+
+
+def test_stop_ends_thread():
+    pool = crypt.startKeyPool(1)
+    thread = pool.thread
+    crypt.stopKeyPool()
+    assert not thread.is_alive()
+    assert crypt.DH.pool is None
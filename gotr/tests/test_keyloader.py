@@ -0,0 +1,150 @@
+import threading
+
+import pytest
+
+import keyloader
+from keyloader import (PrivkeyLoader, STATE_FAILED, STATE_GENERATING,
+                       STATE_LOADING, STATE_READY)
+from potr.context import Account
+
+
+class FakeAccount(Account):
+    def __init__(self, stored=None):
+        super(FakeAccount, self).__init__('me@example.com', 'xmpp', 1024)
+        self.accountname = 'me'
+        self.stored = stored
+        self.loader = PrivkeyLoader(self, self.idle_add, self.state_changed)
+        self.idle = []
+        self.states = []
+
+    def idle_add(self, callback, *args):
+        self.idle.append((callback, args))
+
+    def run_idle(self):
+        idle, self.idle = self.idle, []
+        for callback, args in idle:
+            callback(*args)
+
+    def state_changed(self, loader, state):
+        self.states.append(state)
+
+    def getPrivkey(self, autogen=True):
+        with self.loader.lock:
+            return super(FakeAccount, self).getPrivkey(autogen)
+
+    def loadPrivkey(self):
+        return self.stored
+
+    def savePrivkey(self):
+        self.stored = self.getPrivkey()
+
+
+@pytest.fixture
+def generate(monkeypatch):
+    """ Replace key generation, the test releases the generated key. """
+    release = threading.Event()
+
+    def generate():
+        release.wait(10)
+        return 'new key'
+
+    monkeypatch.setattr(keyloader.compatcrypto, 'generateDefaultKey',
+                        generate)
+    return release
+
+
+def finish(account):
+    for thread in threading.enumerate():
+        if thread.name == 'otr-privkey-me':
+            thread.join(10)
+    account.run_idle()
+
+
+def test_stored_key_is_loaded():
+    account = FakeAccount('stored key')
+    account.loader.start()
+    assert account.loader.state == STATE_LOADING
+    finish(account)
+
+    assert account.privkey == 'stored key'
+    assert account.states == [STATE_READY]
+    assert not account.loader.generated
+
+
+def test_missing_key_is_generated_and_saved(generate):
+    account = FakeAccount()
+    called = []
+    account.loader.when_ready(called.append, 1)
+    account.loader.when_ready(called.append, 2)
+    assert account.loader.busy()
+    generate.set()
+    finish(account)
+
+    assert account.stored == 'new key'
+    assert account.states == [STATE_GENERATING, STATE_READY]
+    assert account.loader.generated
+    assert called == [1, 2]
+    account.loader.when_ready(called.append, 3)
+    assert called == [1, 2, 3]
+
+
+def test_get_privkey_waits_for_loader(generate):
+    account = FakeAccount()
+    account.loader.start()
+    keys = []
+    waiter = threading.Thread(target=lambda: keys.append(
+        account.getPrivkey()))
+    waiter.start()
+    waiter.join(0.1)
+    assert keys == []
+
+    generate.set()
+    waiter.join(10)
+    # No second key was generated
+    assert keys == ['new key']
+    assert account.stored == 'new key'
+    finish(account)
+
+
+def test_failure_runs_queued_callbacks(monkeypatch):
+    def broken():
+        raise ValueError('no entropy')
+
+    monkeypatch.setattr(keyloader.compatcrypto, 'generateDefaultKey', broken)
+    account = FakeAccount()
+    called = []
+    account.loader.when_ready(called.append, 1)
+    finish(account)
+
+    assert account.loader.state == STATE_FAILED
+    assert called == [1]
+    assert account.privkey is None
+
+
+def test_callbacks_wait_for_the_main_loop():
+    account = FakeAccount('stored key')
+    called = []
+    account.loader.when_ready(called.append, 1)
+    for thread in threading.enumerate():
+        if thread.name == 'otr-privkey-me':
+            thread.join(10)
+
+    # the thread set the key, but the main loop did not run the queue yet
+    assert account.privkey == 'stored key'
+    assert account.loader.pending()
+    assert not account.loader.ready()
+    account.loader.when_ready(called.append, 2)
+    assert called == []
+
+    account.run_idle()
+    assert called == [1, 2]
+    assert not account.loader.pending()
+
+
+def test_known_key_runs_queued_callbacks():
+    account = FakeAccount()
+    account.privkey = 'known key'
+    called = []
+    account.loader.when_ready(called.append, 1)
+    assert called == [1]
+    assert account.loader.state == STATE_READY
@@ -0,0 +1,50 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'benchmarks'))
+import bench_loopback
+from potr import context
+from potr.compatcrypto import generateDefaultKey
+
+
+@pytest.fixture(scope='module')
+def keys():
+    return generateDefaultKey(), generateDefaultKey()
+
+
+def test_phases_are_reported(keys):
+    results = bench_loopback.run(keys[0], keys[1], handshakes=1, count=3,
+                                 size=2000, mms_values=(0, 500), smp_runs=1)
+    assert [result['phase'] for result in results] == [
+        'ake', 'data mms=0', 'data mms=500', 'smp']
+    for result in results:
+        assert result['seconds'] > 0
+        assert result['bytes'] > 0
+
+    unfragmented, fragmented = results[1], results[2]
+    assert unfragmented['stanzas'] == 3
+    assert fragmented['stanzas'] > 3 * 2000 // 500
+
+
+def test_fragments_round_trip(keys):
+    session = bench_loopback.Session(*keys)
+    session.ake()
+    session.set_mms(100)
+    for size in (1, 99, 1000):
+        session.send(bench_loopback.payload(size))
+    assert session.alice.fragmentInfo == session.bob.fragmentInfo == (0, 0)
+
+
+def test_smp_with_wrong_secret_fails(keys):
+    session = bench_loopback.Session(*keys)
+    session.ake()
+    session.alice.smpInit(b'secret')
+    session.wire.pump()
+    session.bob.smpGotSecret(b'other')
+    session.wire.pump()
+    assert not session.alice.smpIsSuccess()
+    assert not session.alice.getCurrentTrust()
+    assert session.alice.state == context.STATE_ENCRYPTED
@@ -0,0 +1,130 @@
+import io
+import os
+
+import pytest
+
+from truststore import TrustStore
+
+ALICE = u'alice@example.com'
+BOB = u'bob@example.com'
+FPR1 = u'0123456789abcdef0123456789abcdef01234567'
+FPR2 = u'fedcba9876543210fedcba9876543210fedcba98'
+
+
+@pytest.fixture
+def store(tmpdir):
+    store = TrustStore(os.path.join(str(tmpdir), 'account.trusts.db'))
+    assert store.open()
+    return store
+
+
+def reopen(store):
+    store.close()
+    other = TrustStore(store.path)
+    other.open()
+    return other
+
+
+def write_fpr(path, *lines):
+    with io.open(path, 'w', encoding='utf-8') as fpr_file:
+        for line in lines:
+            fpr_file.write(line + u'\n')
+
+
+def test_trusts_are_persisted(store):
+    store.set(ALICE, FPR1, u'verified')
+    store.set(ALICE, FPR2, u'')
+    store.set(BOB, FPR1, u'smp')
+    store.remove(ALICE, FPR2)
+
+    store = reopen(store)
+    assert store.get(ALICE, FPR1) == u'verified'
+    assert store.get(ALICE, FPR2) is None
+    assert store.get(ALICE, FPR2, u'') == u''
+    assert store.get(BOB, FPR1) == u'smp'
+
+
+def test_contacts_are_read_when_needed(store):
+    store.set(ALICE, FPR1, u'verified')
+    store.set(BOB, FPR1, u'')
+    store = reopen(store)
+    assert store.cache == {}
+
+    store.get(ALICE, FPR1)
+    assert list(store.cache) == [ALICE]
+    # Writes update contacts that were read already
+    store.set(ALICE, FPR2, u'smp')
+    assert store.get(ALICE, FPR2) == u'smp'
+
+
+def test_import_and_export_fpr(store, tmpdir):
+    fpr_path = os.path.join(str(tmpdir), 'account.fpr')
+    with io.open(fpr_path, 'w', encoding='utf-8') as fpr_file:
+        fpr_file.write(u'alice@example.com/home\tme@example.com\txmpp\t%s\t'
+                       u'verified\n' % FPR1)
+        fpr_file.write(u'bob@example.com\tother@example.com\txmpp\t%s\t'
+                       u'verified\n' % FPR1)
+        fpr_file.write(u'b\xf6b@example.com\tme@example.com\txmpp\t%s\t\n'
+                       % FPR2)
+
+    count = store.import_fpr(fpr_path, u'me@example.com', u'xmpp',
+                             lambda ctx: ctx.split(u'/')[0])
+    assert count == 2
+    assert store.get(ALICE, FPR1) == u'verified'
+    assert store.get(u'b\xf6b@example.com', FPR2) == u''
+    assert store.get(BOB, FPR1) is None
+
+    assert store.changed
+    store.export_fpr(fpr_path, u'me@example.com', u'xmpp')
+    assert not store.changed
+    with io.open(fpr_path, encoding='utf-8') as fpr_file:
+        assert fpr_file.read() == (
+            u'alice@example.com\tme@example.com\txmpp\t%s\tverified\n'
+            u'b\xf6b@example.com\tme@example.com\txmpp\t%s\t\n' % (FPR1, FPR2))
+    assert not os.path.exists(fpr_path + '.tmp')
+
+
+def test_items_lists_all_trusts(store):
+    store.set_many([(BOB, FPR2, u''), (ALICE, FPR1, u'verified')])
+    assert store.items() == [(ALICE, FPR1, u'verified'), (BOB, FPR2, u'')]
+
+
+def test_store_can_be_reopened_after_close(store):
+    # the plugin closes the store on deactivate and opens it on activate
+    store.set(ALICE, FPR1, u'verified')
+    store.close()
+    store.close()
+    assert store.conn is None
+
+    store.open()
+    assert store.get(ALICE, FPR1) == u'verified'
+
+
+def test_import_is_retried_until_it_succeeded(store, tmpdir):
+    fpr_path = os.path.join(str(tmpdir), 'account.fpr')
+    write_fpr(fpr_path, u'alice@example.com\tme@example.com\txmpp\t%s\t'
+              u'verified' % FPR1, u'malformed')
+    with pytest.raises(ValueError):
+        store.import_fpr(fpr_path, u'me@example.com', u'xmpp')
+    assert store.items() == []
+    store.set(ALICE, FPR1, u'smp')
+
+    store = reopen(store)
+    assert not store.imported
+    write_fpr(fpr_path, u'alice@example.com\tme@example.com\txmpp\t%s\t'
+              u'verified' % FPR1, u'bob@example.com\tme@example.com\txmpp\t'
+              u'%s\tverified' % FPR2)
+    assert store.import_fpr(fpr_path, u'me@example.com', u'xmpp') == 2
+    # the trust set after the failed import is kept
+    assert store.get(ALICE, FPR1) == u'smp'
+    assert store.get(BOB, FPR2) == u'verified'
+
+    store = reopen(store)
+    assert store.imported
+
+
+def test_missing_fpr_file_is_imported(store, tmpdir):
+    fpr_path = os.path.join(str(tmpdir), 'missing.fpr')
+    assert store.import_fpr(fpr_path, u'me@example.com', u'xmpp') == 0
+    store.close()
+    assert not TrustStore(store.path).open()
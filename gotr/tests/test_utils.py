@@ -0,0 +1,93 @@
+import random
+import struct
+
+import pytest
+
+from potr import proto
+from potr.utils import (bytes_to_long, long_to_bytes, pack_mpi, read_mpi,
+                        read_mpi_from)
+
+SEEDS = range(20)
+
+
+# The byte by byte conversions the fast ones replaced, as reference
+def reference_bytes_to_long(b):
+    l = len(b)
+    s = 0
+    for i in range(l):
+        s += struct.unpack(b'B', b[i:i+1])[0] << 8*(l-i-1)
+    return s
+
+
+def reference_long_to_bytes(l, n=0):
+    b = b''
+    while l != 0 or n > 0:
+        b = struct.pack(b'B', l & 0xff) + b
+        l >>= 8
+        n -= 1
+    return b
+
+
+def random_longs(seed):
+    rng = random.Random(seed)
+    for bits in (1, 7, 8, 9, 15, 16, 17, 63, 64, 65, 160, 1536, 3072):
+        yield rng.getrandbits(bits)
+        yield 2 ** bits - 1
+        yield 2 ** bits
+    for _ in range(50):
+        yield rng.getrandbits(rng.randrange(1, 4000))
+
+
+def random_bytes(seed):
+    rng = random.Random(seed)
+    for length in list(range(10)) + [20, 192, 193, 384, 1000]:
+        yield bytes(bytearray(rng.getrandbits(8) for _ in range(length)))
+        yield b'\0' * length
+        yield b'\0' + b'\xff' * length
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_long_to_bytes_matches_reference(seed):
+    for l in random_longs(seed):
+        for n in (0, 1, 16, 192, 200):
+            assert long_to_bytes(l, n) == reference_long_to_bytes(l, n)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_bytes_to_long_matches_reference(seed):
+    for b in random_bytes(seed):
+        assert bytes_to_long(b) == reference_bytes_to_long(b)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_round_trip(seed):
+    for l in random_longs(seed):
+        assert bytes_to_long(long_to_bytes(l)) == l
+    for b in random_bytes(seed):
+        assert long_to_bytes(bytes_to_long(b), len(b)) == b
+
+
+def test_edge_cases():
+    assert long_to_bytes(0) == b''
+    assert long_to_bytes(0, 3) == b'\0\0\0'
+    assert long_to_bytes(1) == b'\x01'
+    assert long_to_bytes(0x100) == b'\x01\x00'
+    assert long_to_bytes(0x1234, 1) == b'\x12\x34'
+    assert bytes_to_long(b'') == 0
+    assert bytes_to_long(b'\0\0\x01\x00') == 0x100
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_mpi_round_trip(seed):
+    for l in random_longs(seed):
+        data = pack_mpi(l) + b'rest'
+        assert data[:4] == struct.pack(b'!I', len(reference_long_to_bytes(l)))
+        assert read_mpi(data) == (l, b'rest')
+        assert read_mpi_from(data, 0) == (l, len(data) - 4)
+
+
+def test_smp_tlv_round_trip():
+    rng = random.Random(0)
+    mpis = [rng.getrandbits(1536) for _ in range(11)]
+    tlv = proto.SMP2TLV(mpis)
+    assert proto.TLV.parse(bytes(tlv)) == [tlv]
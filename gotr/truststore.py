@@ -0,0 +1,132 @@
+'''
+Fingerprint trust store of an OTR account.
+
+:copyright: Copyright 2008-2012 Kjell Braden <afflux@pentabarf.de>
+:license: GPL
+'''
+
+from __future__ import unicode_literals
+
+import errno
+import io
+import os
+import sqlite3
+
+
+class TrustStore(object):
+    '''
+    Keeps the fingerprint trusts of one account in a sqlite database.
+
+    Changing a trust writes one row, instead of rewriting the whole trust
+    file. The trusts of a contact are read the first time they are needed.
+    The file libotr and older versions of the plugin use is imported on
+    every open until that succeeded once, and can still be written with
+    export_fpr().
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        # uid => {fingerprint: trust} of the contacts read so far
+        self.cache = {}
+        # a trust changed since the last export
+        self.changed = False
+        # the trusts of the fpr file are in the database
+        self.imported = False
+
+    def open(self):
+        ''' Open the database. Returns True if the trusts of the fpr file
+        were not imported yet. '''
+        self.conn = sqlite3.connect(self.path)
+        with self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS trusts (
+                    uid TEXT, fingerprint TEXT, trust TEXT,
+                    PRIMARY KEY (uid, fingerprint))''')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY, value TEXT)''')
+        self.imported = self.conn.execute("SELECT 1 FROM meta "
+                "WHERE key = 'fpr_imported'").fetchone() is not None
+        return not self.imported
+
+    def get(self, uid, fingerprint, default=None):
+        if uid not in self.cache:
+            self.cache[uid] = dict(self.conn.execute(
+                    'SELECT fingerprint, trust FROM trusts WHERE uid = ?',
+                    (uid,)))
+        return self.cache[uid].get(fingerprint, default)
+
+    def set(self, uid, fingerprint, trust):
+        self.set_many([(uid, fingerprint, trust)])
+
+    def set_many(self, trusts):
+        ''' Store (uid, fingerprint, trust) tuples in one transaction. '''
+        self._write(trusts)
+
+    def _write(self, trusts, conflict='REPLACE', statements=()):
+        trusts = list(trusts)
+        with self.conn:
+            self.conn.executemany('INSERT OR ' + conflict + ' INTO trusts '
+                    '(uid, fingerprint, trust) VALUES (?, ?, ?)', trusts)
+            for statement in statements:
+                self.conn.execute(statement)
+        for uid, fingerprint, trust in trusts:
+            if conflict == 'IGNORE':
+                # the row may have kept its trust, read it again
+                self.cache.pop(uid, None)
+            elif uid in self.cache:
+                self.cache[uid][fingerprint] = trust
+        self.changed = True
+
+    def remove(self, uid, fingerprint):
+        with self.conn:
+            self.conn.execute(
+                    'DELETE FROM trusts WHERE uid = ? AND fingerprint = ?',
+                    (uid, fingerprint))
+        if uid in self.cache:
+            self.cache[uid].pop(fingerprint, None)
+        self.changed = True
+
+    def items(self):
+        ''' All (uid, fingerprint, trust) tuples, ordered by uid. '''
+        return self.conn.execute('SELECT uid, fingerprint, trust FROM trusts '
+                'ORDER BY uid, fingerprint').fetchall()
+
+    def import_fpr(self, path, name, protocol, uid_from_ctx=lambda x: x):
+        ''' Import the trusts of account name from a libotr trust file, a
+        missing file has none. The import is recorded in the same
+        transaction, so open() asks for it again until it succeeded. '''
+        trusts = []
+        try:
+            with io.open(path, 'r', encoding='utf-8') as fprFile:
+                for line in fprFile:
+                    ctx, acc, proto, fpr, trust = line[:-1].split('\t')
+
+                    if acc != name or proto != protocol:
+                        continue
+
+                    trusts.append((uid_from_ctx(ctx), fpr, trust))
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        # trusts set after a failed import are newer than the file
+        self._write(trusts, 'IGNORE', ["INSERT OR REPLACE INTO meta "
+                "(key, value) VALUES ('fpr_imported', '1')"])
+        self.imported = True
+        return len(trusts)
+
+    def export_fpr(self, path, name, protocol):
+        ''' Write all trusts in the libotr trust file format. The file is
+        replaced atomically, callers must not replace a file that was not
+        imported yet. '''
+        tmpPath = path + '.tmp'
+        with io.open(tmpPath, 'w', encoding='utf-8') as fprFile:
+            for uid, fpr, trustVal in self.items():
+                fprFile.write('\t'.join((uid, name, protocol, fpr, trustVal)))
+                fprFile.write('\n')
+        os.rename(tmpPath, path)
+        self.changed = False
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
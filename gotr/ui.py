@@ -51,6 +51,7 @@ class OtrPluginConfigDialog(GajimPluginConfigDialog):
         self.fpr_view = self.B.get_object('fingerprint_view')
         self.fpr_view.set_model(self.fpr_model)
         self.fpr_view.get_selection().set_mode(gtk.SELECTION_MULTIPLE)
+        self.context_label = self.B.get_object('context_count_label')
 
         if len(self.otr_account_store) > 0:
             self.B.get_object('account_combobox').set_active(0)
@@ -182,7 +183,6 @@ class OtrPluginConfigDialog(GajimPluginConfigDialog):
                 ctx = self.plugin.us[accounts[a]].getContext(user)
                 ctx.removeFingerprint(fpr)
             dlg.destroy()
-            self.plugin.us[accounts[a]].saveTrusts()
 
         self.plugin.update_context_list()
 
@@ -352,7 +352,6 @@ class ContactOtrSmpWindow:
         self.gw('desclabel1').set_markup(text)
 
         self.plugin.update_otr(self.ctx.peer, self.account, True)
-        self.ctx.user.saveTrusts()
         self.plugin.update_context_list()
 
     def get_tlv(self, tlvs, check):
@@ -525,11 +524,9 @@ class ContactOtrWindow(gtk.Dialog):
         trust_state = self.gw('verified_combobox').get_active()
         if trust_state == 1 and not self.ctx.getTrust(self.fpr):
             self.ctx.setTrust(self.fpr, 'verified')
-            self.ctx.user.saveTrusts()
             self.plugin.update_context_list()
         elif trust_state == 0:
             self.ctx.setTrust(self.fpr, '')
-            self.ctx.user.saveTrusts()
             self.plugin.update_context_list()
 
         self.plugin.update_otr(self.ctx.peer, self.ctx.user.accountname, True)
@@ -18,12 +18,16 @@
 # the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import atexit
 import logging
 import os
 import sqlite3
+import time
 import ui
 import re
 
+import gobject
+
 from common import demandimport
 demandimport.enable()
 demandimport.ignore += ['_imp']
@@ -51,9 +55,20 @@ AXOLOTL_MISSING = 'Please install python-axolotl.'
 
 NS_HINTS = 'urn:xmpp:hints'
 
+# Seconds between writing cached axolotl sessions to the database
+SESSION_FLUSH_INTERVAL = 5
+
 log = logging.getLogger('gajim.plugin_system.omemo')
 try:
+    from omemo.bundlefetch import BundleFetcher, BundlePrefetcher
+    from omemo.db_helpers import tune_connection
+    from omemo.devicelist import DEFAULT_DEVICE_LIST_WINDOW, DeviceListBuffer
+    from omemo.executor import CryptoExecutor
+    from omemo.maintenance import DEFAULT_ARCHIVE_DAYS, DatabaseMaintenance
+    from omemo.mam import MamDecryptionPipeline
+    from omemo.publish import DEFAULT_PUBLISH_WINDOW, PublishScheduler
     from omemo.state import OmemoState
+    from omemo.stateloader import StateLoader
     HAS_AXOLOTL = True
 except ImportError as e:
     log.error(e)
@@ -67,6 +82,11 @@ class OmemoPlugin(GajimPlugin):
 
     omemo_states = {}
     ui_list = {}
+    bundle_fetchers = {}
+    bundle_prefetchers = {}
+    mam_pipelines = {}
+    crypto_executors = {}
+    maintenances = {}
 
     @log_calls('OmemoPlugin')
     def init(self):
@@ -86,30 +106,103 @@ class OmemoPlugin(GajimPlugin):
             'message-outgoing':
             (ged.PRECORE, self.handle_outgoing_event),
         }
+        self.config_default_values = {
+            'bundle_publish_window': (DEFAULT_PUBLISH_WINDOW,
+                                      'Milliseconds to wait for more used '
+                                      'PreKeys before publishing the bundle'),
+            'device_list_window': (DEFAULT_DEVICE_LIST_WINDOW,
+                                   'Milliseconds to gather device lists of '
+                                   'contacts before saving them'),
+            'prefetch_bundles': (False,
+                                 'Build the sessions of contacts with OMEMO '
+                                 'enabled in the background after sign in'),
+            'session_archive_days': (DEFAULT_ARCHIVE_DAYS,
+                                     'Days after which sessions of inactive '
+                                     'devices are archived')
+        }
         self.config_dialog = ui.OMEMOConfigDialog(self)
         self.gui_extension_points = {'chat_control': (self.connect_ui,
                                                       self.disconnect_ui)}
         SUPPORTED_PERSONAL_USER_EVENTS.append(DevicelistPEP)
         self.plugin = self
         self.announced = []
-        self.query_for_bundles = []
+        self.flush_timeout_id = None
+        atexit.register(self.flush_sessions)
+        self.publish_scheduler = PublishScheduler(
+            self.send_bundle, gobject.timeout_add, gobject.source_remove,
+            forget_query=lambda iq_id: iq_ids_to_callbacks.pop(iq_id, None))
+        self.device_list_buffer = DeviceListBuffer(
+            self.apply_device_lists, gobject.timeout_add,
+            gobject.source_remove)
+        self.state_loader = StateLoader(self.create_omemo_state,
+                                        gobject.idle_add, self.omemo_states)
 
     @log_calls('OmemoPlugin')
     def get_omemo_state(self, account):
-        """ Returns the the OmemoState for specified account. Creates the
-            OmemoState if it does not exist yet.
+        """ Returns the the OmemoState for specified account, or None if it
+            is not loaded yet. Code which can run before the OmemoState is
+            loaded uses :py:meth:`when_ready` or
+            :py:meth:`queue_until_loaded` instead.
+        """
+        return self.state_loader.get(account)
+
+    def when_ready(self, account, callback, *args):
+        """ Call callback with args once the OmemoState of account is
+            loaded, immediately if it already is.
+        """
+        self.load_omemo_state(account)
+        self.state_loader.when_ready(account, callback, *args)
+
+    def load_omemo_state(self, account):
+        """ Start creating the OmemoState for specified account in the
+            background, if it does not exist yet.
         """
-        if account not in self.omemo_states:
+        if self.state_loader.start(account,
+                                   gajim.get_jid_from_account(account)):
             self.deactivate_gajim_e2e(account)
-            db_path = os.path.join(DB_DIR, 'omemo_' + account + '.db')
-            conn = sqlite3.connect(db_path, check_same_thread=False)
 
-            my_jid = gajim.get_jid_from_account(account)
+    def create_omemo_state(self, account, my_jid):
+        """ Open the database of account and create its OmemoState. Runs
+            in the worker thread of the StateLoader.
+        """
+        started = time.time()
+        db_path = os.path.join(DB_DIR, 'omemo_' + account + '.db')
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+        tune_connection(conn)
+        connected = time.time() - started
 
-            self.omemo_states[account] = OmemoState(my_jid, conn, account,
-                                                    self.plugin)
+        state = OmemoState(my_jid, conn, account, self.plugin)
+        state.timings['connect'] = connected
+        return state
 
-        return self.omemo_states[account]
+    def queue_until_loaded(self, account, event, resume, handler):
+        """ Queue an event if the OmemoState of account is still being
+            created.
+
+            Parameters
+            ----------
+            account : str
+                the account name
+            event : NetworkIncomingEvent or NetworkOutgoingEvent
+                the event to queue
+            resume : callable
+                resume_incoming_event or resume_outgoing_event, called
+                once the OmemoState is ready
+            handler : callable
+                the handler which blocks the event, it runs again with
+                the ready OmemoState followed by the handlers after it
+
+            Returns
+            -------
+            bool
+                True if the event was queued, the handler has to block it
+        """
+        if self.state_loader.get(account) is not None:
+            return False
+        log.debug(account + ' => Queue ' + event.name +
+                  ' until the OmemoState is loaded')
+        self.when_ready(account, resume, event, handler, True)
+        return True
 
     @log_calls('OmemoPlugin')
     def deactivate_gajim_e2e(self, account):
@@ -129,15 +222,39 @@ class OmemoPlugin(GajimPlugin):
         account = event.conn.name
         log.debug(account +
                   ' => Announce Support after Sign In')
-        self.query_for_bundles = []
         self.announced = []
         self.announced.append(account)
+        self.publish_scheduler.reset(account)
+        self.when_ready(account, self.announce_support, account)
+
+    def announce_support(self, account):
+        """ Publish the bundle and query the own device list once the
+            OmemoState of account is ready.
+        """
+        self.get_bundle_fetcher(account).reset()
+        self.get_bundle_prefetcher(account).reset()
         self.publish_bundle(account)
         self.query_own_devicelist(account)
+        self.get_maintenance(account).start()
+
+    @log_calls('OmemoPlugin')
+    def flush_sessions(self):
+        """ Write the cached axolotl sessions of all accounts to the database
+        """
+        for account, state in self.omemo_states.items():
+            with state.lock:
+                count = state.store.sessionStore.flush()
+            if count:
+                log.debug(account + ' => ' + str(count) + ' sessions flushed')
+        # Keep the timeout running
+        return True
 
     @log_calls('OmemoPlugin')
     def activate(self):
-        self.query_for_bundles = []
+        self.publish_scheduler.window = self.config['bundle_publish_window']
+        self.device_list_buffer.window = self.config['device_list_window']
+        self.flush_timeout_id = gobject.timeout_add_seconds(
+            SESSION_FLUSH_INTERVAL, self.flush_sessions)
         if NS_NOTIFY not in gajim.gajim_common_features:
             gajim.gajim_common_features.append(NS_NOTIFY)
         self._compute_caps_hash()
@@ -148,11 +265,29 @@ class OmemoPlugin(GajimPlugin):
                     log.debug(account +
                               ' => Announce Support after Plugin Activation')
                     self.announced.append(account)
-                    self.publish_bundle(account)
-                    self.query_own_devicelist(account)
+                    self.when_ready(account, self.announce_support, account)
 
     @log_calls('OmemoPlugin')
     def deactivate(self):
+        if self.flush_timeout_id is not None:
+            gobject.source_remove(self.flush_timeout_id)
+            self.flush_timeout_id = None
+        self.flush_sessions()
+        self.publish_scheduler.cancel_all()
+        self.device_list_buffer.cancel_all()
+        for prefetcher in self.bundle_prefetchers.values():
+            prefetcher.reset()
+        for fetcher in self.bundle_fetchers.values():
+            fetcher.reset()
+        for pipeline in self.mam_pipelines.values():
+            pipeline.stop()
+        self.mam_pipelines.clear()
+        for executor in self.crypto_executors.values():
+            executor.stop()
+        self.crypto_executors.clear()
+        for maintenance in self.maintenances.values():
+            maintenance.stop()
+        self.maintenances.clear()
         if NS_NOTIFY in gajim.gajim_common_features:
             gajim.gajim_common_features.remove(NS_NOTIFY)
         self._compute_caps_hash()
@@ -171,36 +306,128 @@ class OmemoPlugin(GajimPlugin):
                 gajim.connections[a].change_status(gajim.SHOW_LIST[connected],
                                                    gajim.connections[a].status)
 
+    def get_mam_pipeline(self, account):
+        """ Returns the MamDecryptionPipeline for specified account. Creates
+            the MamDecryptionPipeline if it does not exist yet.
+        """
+        if account not in self.mam_pipelines:
+            self.mam_pipelines[account] = MamDecryptionPipeline(
+                self.get_omemo_state(account),
+                lambda results: self.mam_messages_decrypted(account, results),
+                gobject.idle_add)
+        return self.mam_pipelines[account]
+
+    def get_crypto_executor(self, account):
+        """ Returns the CryptoExecutor for specified account. Creates the
+            CryptoExecutor if it does not exist yet.
+        """
+        if account not in self.crypto_executors:
+            self.crypto_executors[account] = CryptoExecutor(
+                self.get_omemo_state(account), gobject.idle_add)
+        return self.crypto_executors[account]
+
+    def get_maintenance(self, account):
+        """ Returns the DatabaseMaintenance for specified account. Creates
+            the DatabaseMaintenance if it does not exist yet.
+        """
+        if account not in self.maintenances:
+            self.maintenances[account] = DatabaseMaintenance(
+                self.get_omemo_state(account), gobject.timeout_add,
+                gobject.source_remove, gobject.idle_add,
+                archive_days=self.config['session_archive_days'])
+        return self.maintenances[account]
+
+    @staticmethod
+    def resume_handlers(event, handler, rerun=False):
+        """ Run the handlers of a blocked event which are ranked after
+            handler, like GlobalEventsDispatcher.raise_event() would have.
+
+            Parameters
+            ----------
+            event : NetworkIncomingEvent or NetworkOutgoingEvent
+                the blocked event
+            handler : callable
+                the OMEMO handler which blocked the event
+            rerun : bool
+                True to run handler itself again first
+
+            Returns
+            -------
+            bool
+                True if one of the handlers blocked the event
+        """
+        handlers = list(gajim.ged.handlers.get(event.name, []))
+        for index, (_, registered) in enumerate(handlers):
+            if registered == handler:
+                if not rerun:
+                    index += 1
+                break
+        else:
+            # The plugin was deactivated meanwhile, only the handlers
+            # ranked after the OMEMO handlers are left to run
+            handlers = [(priority, registered)
+                        for priority, registered in handlers
+                        if priority > ged.PRECORE]
+            index = 0
+
+        for _, registered in handlers[index:]:
+            try:
+                if registered(event):
+                    return True
+            except Exception:
+                log.exception('Error while running an event handler: ' +
+                              str(registered))
+        return False
+
+    def resume_incoming_event(self, event, handler, rerun=False):
+        """ Continue a blocked incoming event after handler, e.g. after its
+            message was decrypted.
+        """
+        if not self.resume_handlers(event, handler, rerun):
+            # Continue like NetworkEventsController.push_incoming_event()
+            # does after the handlers ran
+            gajim.nec._generate_events_based_on_incoming_event(event)
+
+    def resume_outgoing_event(self, event, handler, rerun=False):
+        """ Continue a blocked outgoing event after handler, e.g. after its
+            message was encrypted.
+        """
+        if not self.resume_handlers(event, handler, rerun):
+            # Continue like NetworkEventsController.push_outgoing_event()
+            # does after the handlers ran
+            gajim.nec._generate_events_based_on_outgoing_event(event)
+
     @log_calls('OmemoPlugin')
     def mam_message_received(self, msg):
         if msg.msg_.getTag('encrypted', namespace=NS_OMEMO):
             account = msg.conn.name
+            if self.queue_until_loaded(account, msg,
+                                       self.resume_incoming_event,
+                                       self.mam_message_received):
+                return True
             log.debug(account + ' => OMEMO MAM msg received')
             self.print_msg_to_log(msg.msg_)
-            state = self.get_omemo_state(account)
 
             from_jid = str(msg.msg_.getAttr('from'))
             from_jid = gajim.get_jid_without_resource(from_jid)
 
             msg_dict = unpack_encrypted(msg.msg_.getTag
                                         ('encrypted', namespace=NS_OMEMO))
-            msg_dict['sender_jid'] = from_jid
-            plaintext = state.decrypt_msg(msg_dict)
-
-            if not plaintext:
+            if not msg_dict:
                 return
+            msg_dict['sender_jid'] = from_jid
 
-            msg.msgtxt = plaintext
-
-            contact_jid = msg.with_
-
-            if account in self.ui_list and \
-                    contact_jid in self.ui_list[account]:
-                self.ui_list[account][contact_jid].activate_omemo()
-            return False
+            # Block the event, it continues after the message was
+            # decrypted in the background
+            self.get_mam_pipeline(account).put(msg_dict, msg)
+            return True
 
         elif msg.msg_.getTag('body'):
             account = msg.conn.name
+            if self.queue_until_loaded(account, msg,
+                                       self.resume_incoming_event,
+                                       self.mam_message_received):
+                return True
 
             jid = msg.with_
             state = self.get_omemo_state(account)
@@ -217,14 +444,37 @@ class OmemoPlugin(GajimPlugin):
                     log.debug('No Ui present for ' + jid +
                               ', Ui Warning not shown')
 
+    def mam_messages_decrypted(self, account, results):
+        """ Continue the events of decrypted MAM messages.
+
+            Parameters
+            ----------
+            account : str
+                the account name
+            results : list
+                (MamMessageReceivedEvent, plaintext) tuples
+        """
+        for msg, plaintext in results:
+            msg.omemo_decrypted = True
+            if plaintext:
+                msg.msgtxt = plaintext
+                contact_jid = msg.with_
+                if account in self.ui_list and \
+                        contact_jid in self.ui_list[account]:
+                    self.ui_list[account][contact_jid].activate_omemo()
+            self.resume_incoming_event(msg, self.mam_message_received)
+
     @log_calls('OmemoPlugin')
     def message_received(self, msg):
         if msg.stanza.getTag('encrypted', namespace=NS_OMEMO) and \
                 msg.mtype == 'chat':
             account = msg.conn.name
+            if self.queue_until_loaded(account, msg,
+                                       self.resume_incoming_event,
+                                       self.message_received):
+                return True
             log.debug(account + ' => OMEMO msg received')
 
-            state = self.get_omemo_state(account)
             if msg.forwarded and msg.sent:
                 from_jid = str(msg.stanza.getTo())  # why gajim? why?
                 log.debug('message was forwarded doing magic')
@@ -233,24 +483,24 @@ class OmemoPlugin(GajimPlugin):
             self.print_msg_to_log(msg.stanza)
             msg_dict = unpack_encrypted(msg.stanza.getTag
                                         ('encrypted', namespace=NS_OMEMO))
-            msg_dict['sender_jid'] = gajim.get_jid_without_resource(from_jid)
-            plaintext = state.decrypt_msg(msg_dict)
-
-            if not plaintext:
-                return
-
-            msg.msgtxt = plaintext
-            # bug? there must be a body or the message gets dropped from history
-            msg.stanza.setBody(plaintext)
-
             contact_jid = gajim.get_jid_without_resource(from_jid)
-            if account in self.ui_list and \
-                    contact_jid in self.ui_list[account]:
-                self.ui_list[account][contact_jid].activate_omemo()
-            return False
+            msg_dict['sender_jid'] = contact_jid
+
+            # Block the event, it continues after the message was
+            # decrypted by the crypto executor
+            self.get_crypto_executor(account).submit(
+                'decrypt_msg',
+                lambda plaintext: self.message_decrypted(
+                    account, msg, contact_jid, plaintext),
+                msg_dict)
+            return True
 
         elif msg.stanza.getTag('body') and msg.mtype == 'chat':
             account = msg.conn.name
+            if self.queue_until_loaded(account, msg,
+                                       self.resume_incoming_event,
+                                       self.message_received):
+                return True
 
             from_jid = str(msg.stanza.getFrom())
             jid = gajim.get_jid_without_resource(from_jid)
@@ -269,6 +519,32 @@ class OmemoPlugin(GajimPlugin):
                     log.debug('No Ui present for ' + jid +
                               ', Ui Warning not shown')
 
+    def message_decrypted(self, account, msg, contact_jid, plaintext):
+        """ Continue the event of a decrypted message.
+
+            Parameters
+            ----------
+            account : str
+                the account name
+            msg : MessageReceivedEvent
+                the blocked event
+            contact_jid : str
+                the bare jid of the contact
+            plaintext : unicode
+                the decrypted message, None if it could not be decrypted
+        """
+        msg.omemo_decrypted = True
+        if plaintext:
+            msg.msgtxt = plaintext
+            # bug? there must be a body or the message gets dropped from
+            # history
+            msg.stanza.setBody(plaintext)
+
+            if account in self.ui_list and \
+                    contact_jid in self.ui_list[account]:
+                self.ui_list[account][contact_jid].activate_omemo()
+        self.resume_incoming_event(msg, self.message_received)
+
     @log_calls('OmemoPlugin')
     def handle_device_list_update(self, event):
         """ Check if the passed event is a device list update and store the new
@@ -296,6 +572,9 @@ class OmemoPlugin(GajimPlugin):
         if len(devices_list) == 0:
             return False
         account = event.conn.name
+        if self.queue_until_loaded(account, event, self.resume_incoming_event,
+                                   self.handle_device_list_update):
+            return True
         contact_jid = gajim.get_jid_without_resource(event.fjid)
         state = self.get_omemo_state(account)
         my_jid = gajim.get_jid_from_account(account)
@@ -306,10 +585,9 @@ class OmemoPlugin(GajimPlugin):
             state.set_own_devices(devices_list)
             state.store.sessionStore.setActiveState(devices_list, my_jid)
 
-            # remove contact from list, so on send button pressed
-            # we query for bundle and build a session
-            if contact_jid in self.query_for_bundles:
-                self.query_for_bundles.remove(contact_jid)
+            # on send button pressed we query again for bundles of devices
+            # we gave up on and build a session
+            self.get_bundle_fetcher(account).forget(contact_jid)
 
             if not state.own_device_id_published() or anydup(
                     state.own_devices):
@@ -318,27 +596,51 @@ class OmemoPlugin(GajimPlugin):
                 # Is a Device ID duplicated?
                 self.publish_own_devices_list(account, state)
         else:
-            log.info(account + ' => Received device list for ' +
-                     contact_jid + ':' + str(devices_list))
-            state.set_devices(contact_jid, set(devices_list))
-            state.store.sessionStore.setActiveState(devices_list, contact_jid)
-
-            # remove contact from list, so on send button pressed
-            # we query for bundle and build a session
-            if contact_jid in self.query_for_bundles:
-                self.query_for_bundles.remove(contact_jid)
-
-            # Enable Encryption on receiving first Device List
-            if not state.encryption.exist(contact_jid):
-                if account in self.ui_list and \
-                        contact_jid in self.ui_list[account]:
-                    log.debug(account +
-                              ' => Switch encryption ON automatically ...')
-                    self.ui_list[account][contact_jid].activate_omemo()
-                else:
-                    log.debug(account +
-                              ' => Switch encryption ON automatically ...')
-                    self.omemo_enable_for(contact_jid, account)
+            log.debug(account + ' => Received device list for ' +
+                      contact_jid + ':' + str(devices_list))
+            # Saved together with the other lists received meanwhile by
+            # apply_device_lists()
+            self.device_list_buffer.add(account, contact_jid,
+                                        set(devices_list))
+
+        return True
+
+    @log_calls('OmemoPlugin')
+    def apply_device_lists(self, account, device_lists):
+        """ Save the device lists gathered by the DeviceListBuffer in one
+            transaction.
+
+            Parameters
+            ----------
+            account : str
+                the account name
+            device_lists : dict
+                contact jid => set of device ids
+        """
+        state = self.get_omemo_state(account)
+        if state is None:
+            self.when_ready(account, self.apply_device_lists, account,
+                            device_lists)
+            return
+        uis = self.ui_list.get(account, {})
+
+        # Enable Encryption on receiving first Device List
+        new_jids = [jid for jid in device_lists
+                    if not state.encryption.exist(jid)]
+        if new_jids:
+            log.debug(account + ' => Switch encryption ON automatically for ' +
+                      str(len(new_jids)) + ' contacts ...')
+        state.set_device_lists(device_lists,
+                               [jid for jid in new_jids if jid not in uis])
+        for jid in new_jids:
+            if jid in uis:
+                uis[jid].activate_omemo()
+
+        fetcher = self.get_bundle_fetcher(account)
+        for contact_jid in device_lists:
+            # on send button pressed we query again for bundles of devices
+            # we gave up on and build a session
+            fetcher.forget(contact_jid)
 
             if account in self.ui_list and \
                     contact_jid not in self.ui_list[account]:
@@ -349,7 +651,25 @@ class OmemoPlugin(GajimPlugin):
                 if chat_control:
                     self.connect_ui(chat_control)
 
-        return True
+        if self.config['prefetch_bundles']:
+            self.prefetch_bundles(account, device_lists)
+
+    def prefetch_bundles(self, account, jids):
+        """ Queue the devices without session of the contacts with OMEMO
+            enabled for prefetching.
+
+            Parameters
+            ----------
+            account : str
+                the account name
+            jids : iterable
+                the contact jids
+        """
+        state = self.get_omemo_state(account)
+        prefetcher = self.get_bundle_prefetcher(account)
+        for jid in jids:
+            if state.encryption.is_active(jid):
+                prefetcher.add(jid, state.devices_without_sessions(jid))
 
     @log_calls('OmemoPlugin')
     def publish_own_devices_list(self, account_name, state):
@@ -370,9 +690,14 @@ class OmemoPlugin(GajimPlugin):
     def connect_ui(self, chat_control):
         account = chat_control.contact.account.name
         contact_jid = chat_control.contact.jid
+        state = self.get_omemo_state(account)
+        if state is None:
+            # The chat was opened before the OmemoState was loaded
+            self.when_ready(account, self.connect_ui_when_open, chat_control)
+            return
         if account not in self.ui_list:
             self.ui_list[account] = {}
-        state = self.get_omemo_state(account)
+        self.device_list_buffer.flush(account)
         my_jid = gajim.get_jid_from_account(account)
         omemo_enabled = state.encryption.is_active(contact_jid)
         if omemo_enabled:
@@ -389,46 +714,38 @@ class OmemoPlugin(GajimPlugin):
         else:
             log.warn(account + " => No devices for " + contact_jid)
 
+    def connect_ui_when_open(self, chat_control):
+        """ Connect the ui of a chat which was opened while the OmemoState
+            was loaded, unless it was closed meanwhile.
+        """
+        contact = chat_control.contact
+        if gajim.interface.msg_win_mgr.get_control(
+                contact.jid, contact.account.name) is chat_control:
+            self.connect_ui(chat_control)
+
     @log_calls('OmemoPlugin')
     def disconnect_ui(self, chat_control):
         contact_jid = chat_control.contact.jid
         account_name = chat_control.contact.account.name
-        self.ui_list[account_name][contact_jid].removeUi()
+        ui = self.ui_list.get(account_name, {}).get(contact_jid)
+        if ui is not None:
+            # No Ui was added if the chat was closed before the OmemoState
+            # was loaded
+            ui.removeUi()
 
     def are_keys_missing(self, account, contact_jid):
         """ Check DB if keys are missing and query them """
+        self.device_list_buffer.flush(account)
         state = self.get_omemo_state(account)
         my_jid = gajim.get_jid_from_account(account)
+        fetcher = self.get_bundle_fetcher(account)
 
-        # Fetch Bundles of own other Devices
-        if my_jid not in self.query_for_bundles:
-
-            devices_without_session = state \
-                    .devices_without_sessions(my_jid)
-
-            self.query_for_bundles.append(my_jid)
-
-            if devices_without_session:
-                for device_id in devices_without_session:
-                    self.fetch_device_bundle_information(account,
-                                                         state,
-                                                         my_jid,
-                                                         device_id)
-
-        # Fetch Bundles of contacts devices
-        if contact_jid not in self.query_for_bundles:
-
-            devices_without_session = state \
-                .devices_without_sessions(contact_jid)
-
-            self.query_for_bundles.append(contact_jid)
-
-            if devices_without_session:
-                for device_id in devices_without_session:
-                    self.fetch_device_bundle_information(account,
-                                                         state,
-                                                         contact_jid,
-                                                         device_id)
+        # Fetch Bundles of own other Devices and of the contacts devices.
+        # The fetcher skips devices which are already queried, or were
+        # fetched since sign in and the last device list of their jid.
+        for jid in (my_jid, contact_jid):
+            for device_id in state.devices_without_sessions(jid):
+                fetcher.fetch(jid, device_id)
 
         if state.getTrustedFingerprints(contact_jid):
             return False
@@ -449,12 +766,40 @@ class OmemoPlugin(GajimPlugin):
             finally:
                 del iq_ids_to_callbacks[id_]
 
+    def get_bundle_fetcher(self, account):
+        """ Returns the BundleFetcher for specified account. Creates the
+            BundleFetcher if it does not exist yet.
+        """
+        if account not in self.bundle_fetchers:
+            self.bundle_fetchers[account] = BundleFetcher(
+                lambda jid, device_id: self.fetch_device_bundle_information(
+                    account, self.get_omemo_state(account), jid, device_id),
+                lambda iq_id: iq_ids_to_callbacks.pop(iq_id, None),
+                gobject.timeout_add, gobject.source_remove,
+                gave_up=lambda jid, device_id: self.get_omemo_state(account).
+                store.bundleFailureStore.add(jid, device_id, time.time()))
+        return self.bundle_fetchers[account]
+
+    def get_bundle_prefetcher(self, account):
+        """ Returns the BundlePrefetcher for specified account. Creates the
+            BundlePrefetcher if it does not exist yet.
+        """
+        if account not in self.bundle_prefetchers:
+            self.bundle_prefetchers[account] = BundlePrefetcher(
+                self.get_bundle_fetcher(account),
+                self.get_omemo_state(account).store.bundleFailureStore,
+                gobject.timeout_add, gobject.source_remove)
+        return self.bundle_prefetchers[account]
+
     @log_calls('OmemoPlugin')
     def fetch_device_bundle_information(self, account_name, state, jid,
                                         device_id):
         """ Fetch bundle information for specified jid, key, and create axolotl
             session on success.
 
+            Use :py:meth:`BundleFetcher.fetch` instead of calling this
+            directly, so queries are deduplicated and retried.
+
             Parameters
             ----------
             account_name : str
@@ -465,6 +810,11 @@ class OmemoPlugin(GajimPlugin):
                 The jid to query for bundle information
             device_id : int
                 The device_id for which we are missing an axolotl session
+
+            Returns
+            -------
+            str
+                The id of the query iq
         """
         log.info(account_name + ' => Fetch bundle device ' + str(device_id) +
                  '#' + jid)
@@ -475,6 +825,7 @@ class OmemoPlugin(GajimPlugin):
                                                            stanza, jid,
                                                            device_id)
         gajim.connections[account_name].connection.send(iq)
+        return iq_id
 
     @log_calls('OmemoPlugin')
     def session_from_prekey_bundle(self, account_name, state, stanza,
@@ -511,11 +862,33 @@ class OmemoPlugin(GajimPlugin):
 
         """
         bundle_dict = unpack_device_bundle(stanza, device_id)
+        fetcher = self.get_bundle_fetcher(account_name)
+        fetcher.result(recipient_id, device_id, bool(bundle_dict))
         if not bundle_dict:
             log.warn('Failed requesting a bundle')
             return
+        log.debug(account_name + ' => Bundle fetch stats: ' +
+                  str(fetcher.stats()))
+
+        self.get_crypto_executor(account_name).submit(
+            'build_session',
+            lambda success: self.session_built(account_name, recipient_id,
+                                               success),
+            recipient_id, device_id, bundle_dict)
 
-        if state.build_session(recipient_id, device_id, bundle_dict):
+    def session_built(self, account_name, recipient_id, success):
+        """ Called by the crypto executor after a session was built.
+
+            Parameters
+            ----------
+            account_name : str
+                The account name
+            recipient_id : str
+                The recipient jid
+            success : bool
+                True if the session was created
+        """
+        if success:
             log.info(account_name + ' => session created for: ' + recipient_id)
             # Warn User about new Fingerprints in DB if Chat Window is Open
             if account_name in self.ui_list and \
@@ -535,6 +908,22 @@ class OmemoPlugin(GajimPlugin):
 
     @log_calls('OmemoPlugin')
     def publish_bundle(self, account):
+        """ Request publishing our bundle information.
+
+            Requests within the bundle_publish_window are coalesced into one
+            publish, see :py:class:`omemo.publish.PublishScheduler`.
+
+            Parameters
+            ----------
+            account : str
+                the account name
+        """
+        # Can be called from the MAM decryption thread
+        gobject.idle_add(self.when_ready, account,
+                         self.publish_scheduler.request, account)
+
+    @log_calls('OmemoPlugin')
+    def send_bundle(self, account):
         """ Publish our bundle information to the PEP node.
 
             Parameters
@@ -542,6 +931,11 @@ class OmemoPlugin(GajimPlugin):
             account : str
                 the account name
 
+            Returns
+            -------
+            str
+                The id of the publish iq
+
             See also
             --------
             4.3 Announcing bundle information:
@@ -554,6 +948,7 @@ class OmemoPlugin(GajimPlugin):
         log.info(account + " => Publishing bundle ...")
         iq_ids_to_callbacks[id_] = lambda stanza: \
             self.handle_publish_result(account, stanza)
+        return id_
 
     @log_calls('OmemoPlugin')
     def handle_publish_result(self, account, stanza):
@@ -566,6 +961,7 @@ class OmemoPlugin(GajimPlugin):
             stanza
                 The stanza object received from callback
         """
+        self.publish_scheduler.finished(account)
         if successful(stanza):
             log.info(account + ' => Publishing bundle was successful')
         else:
@@ -596,10 +992,9 @@ class OmemoPlugin(GajimPlugin):
                 state.set_own_devices(devices_list)
                 state.store.sessionStore.setActiveState(devices_list, my_jid)
 
-                # remove contact from list, so on send button pressed
-                # we query for bundle and build a session
-                if contact_jid in self.query_for_bundles:
-                    self.query_for_bundles.remove(contact_jid)
+                # on send button pressed we query again for bundles of
+                # devices we gave up on and build a session
+                self.get_bundle_fetcher(account).forget(contact_jid)
 
                 if not state.own_device_id_published() or anydup(
                         state.own_devices):
@@ -614,6 +1009,9 @@ class OmemoPlugin(GajimPlugin):
     @log_calls('OmemoPlugin')
     def clear_device_list(self, account):
         state = self.get_omemo_state(account)
+        if state is None:
+            self.when_ready(account, self.clear_device_list, account)
+            return
         devices_list = [state.own_device_id]
         state.set_own_devices(devices_list)
 
@@ -632,6 +1030,9 @@ class OmemoPlugin(GajimPlugin):
         # and allows us to remove every xhtml before it even gets
         # pressed into a stanza
         account = event.account
+        if self.queue_until_loaded(account, event, self.resume_outgoing_event,
+                                   self.handle_outgoing_event):
+            return True
         state = self.get_omemo_state(account)
 
         if not state.encryption.is_active(event.jid):
@@ -654,6 +1055,10 @@ class OmemoPlugin(GajimPlugin):
                 return
 
             account = event.conn.name
+            if self.queue_until_loaded(account, event,
+                                       self.resume_outgoing_event,
+                                       self.handle_outgoing_stanza):
+                return True
             state = self.get_omemo_state(account)
             full_jid = str(event.msg_iq.getAttr('to'))
             to_jid = gajim.get_jid_without_resource(full_jid)
@@ -666,11 +1071,33 @@ class OmemoPlugin(GajimPlugin):
 
             plaintext = event.msg_iq.getBody().encode('utf8')
 
-            msg_dict = state.create_msg(
+            # Block the stanza, it continues after the message was
+            # encrypted by the crypto executor
+            self.get_crypto_executor(account).submit(
+                'create_msg',
+                lambda msg_dict: self.message_encrypted(event, msg_dict),
                 gajim.get_jid_from_account(account), to_jid, plaintext)
-            if not msg_dict:
-                return True
+            return True
+        except Exception as e:
+            log.debug(e)
+            return True
+
+    def message_encrypted(self, event, msg_dict):
+        """ Replace the body of a blocked outgoing stanza with the encrypted
+            message and continue the event.
 
+            Parameters
+            ----------
+            event : StanzaMessageOutgoingEvent
+                the blocked event
+            msg_dict : dict
+                the encrypted message, None if it could not be encrypted
+        """
+        if not msg_dict:
+            # The stanza stays blocked, nothing is sent unencrypted
+            return
+
+        try:
             encrypted_node = OmemoMessage(msg_dict)
             event.msg_iq.delChild('body')
             event.msg_iq.addChild(node=encrypted_node)
@@ -679,7 +1106,10 @@ class OmemoPlugin(GajimPlugin):
             self.print_msg_to_log(event.msg_iq)
         except Exception as e:
             log.debug(e)
-            return True
+            return
+
+        event.omemo_encrypted = True
+        self.resume_outgoing_event(event, self.handle_outgoing_stanza)
 
     @log_calls('OmemoPlugin')
     def omemo_enable_for(self, jid, account):
@@ -0,0 +1,64 @@
+""" Measure AES-GCM throughput of the pure python fallback and the native
+    cryptography backend.
+
+    Pass a path to an old checkout of aes_gcm_fallback.py with --compare to
+    measure it as well.
+"""
+from __future__ import print_function
+
+import argparse
+import imp
+import os
+
+from common import timed
+
+from omemo import aes_gcm_fallback
+
+SIZES = (64, 1024, 16 * 1024, 256 * 1024)
+# Bytes encrypted and decrypted per size and backend
+VOLUME = 1024 * 1024
+
+
+def backends(compare):
+    result = [('fallback', aes_gcm_fallback)]
+    try:
+        from omemo import aes_gcm_native
+        result.append(('native', aes_gcm_native))
+    except ImportError:
+        print('Native backend not available')
+    if compare:
+        result.append(('compare', imp.load_source('compare', compare)))
+    return result
+
+
+def throughput(backend, size, volume):
+    key, iv = os.urandom(16), os.urandom(16)
+    plaintext = os.urandom(size)
+    rounds = max(volume // size, 1)
+
+    def run():
+        for _ in range(rounds):
+            backend.aes_decrypt(key, iv,
+                                backend.aes_encrypt(key, iv, plaintext))
+
+    _, seconds = timed(run)
+    return 2.0 * rounds * size / seconds / (1024 * 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--compare', metavar='FILE')
+    parser.add_argument('--volume', type=int, default=VOLUME)
+    args = parser.parse_args()
+
+    names = backends(args.compare)
+    print('%10s' % 'bytes' + ''.join('%12s' % name for name, _ in names) +
+          '  (MB/s)')
+    for size in SIZES:
+        print('%10d' % size + ''.join(
+            '%12.2f' % throughput(backend, size, args.volume)
+            for _, backend in names))
+
+
+if __name__ == '__main__':
+    main()
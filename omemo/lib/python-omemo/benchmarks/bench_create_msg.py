@@ -0,0 +1,45 @@
+""" Measure OmemoState.create_msg throughput for growing device counts.
+
+    Every device shares the same bundle, only the sender side is measured.
+    The sender uses a file backed database, so commits hit the disk.
+"""
+from __future__ import print_function
+
+import sys
+
+from common import TempDir, bundle_dict, create_state, timed, trust_all
+
+ALICE = 'alice@example.com'
+BOB = 'bob@example.com'
+DEVICE_COUNTS = (1, 10, 100, 500)
+MESSAGES = 2000
+
+
+def run(device_count, tmp):
+    alice = create_state(ALICE, conn=tmp.db('alice-%d' % device_count))
+    alice.set_own_devices([alice.own_device_id])
+    bundle = bundle_dict(create_state(BOB))
+
+    device_ids = range(1, device_count + 1)
+    for device_id in device_ids:
+        alice.build_session(BOB, device_id, bundle)
+    alice.set_devices(BOB, device_ids)
+    trust_all(alice, BOB)
+
+    count = max(MESSAGES // device_count, 5)
+    _, seconds = timed(
+        lambda: [alice.create_msg(ALICE, BOB, b'Hello') for _ in range(count)])
+    return count / seconds
+
+
+def main(device_counts):
+    print('%8s %12s %14s' % ('devices', 'messages/s', 'encryptions/s'))
+    with TempDir() as tmp:
+        for device_count in device_counts:
+            rate = run(device_count, tmp)
+            print('%8d %12.1f %14.1f' % (device_count, rate,
+                                         rate * device_count))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or DEVICE_COUNTS)
@@ -0,0 +1,132 @@
+""" Replay a mix of session and trust queries against the omemo db.
+
+    The same recorded workload runs against a database with the default
+    SQLite settings and without the user_version 6 indexes, and against one
+    set up like the plugin does it. A workload can be written with
+    ``--record FILE`` and replayed later with ``--replay FILE``.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+
+from common import TempDir, timed
+
+from omemo.db_helpers import tune_connection
+from omemo.sql import SQLDatabase
+
+CONTACTS = 300
+DEVICES_PER_CONTACT = 3
+RECORD_SIZE = 1500
+OPERATIONS = 20000
+
+# Relative frequency of the operations in a generated workload
+MIX = (('load_session', 40), ('store_session', 25), ('trust', 20),
+       ('active_sessions', 10), ('set_trust', 5))
+
+QUERIES = {
+    'load_session': "SELECT record FROM sessions "
+                    "WHERE recipient_id = ? AND device_id = ?",
+    'store_session': "INSERT OR REPLACE INTO sessions("
+                     "recipient_id, device_id, record) VALUES(?,?,?)",
+    'trust': "SELECT _id, public_key, trust FROM identities "
+             "WHERE recipient_id = ?",
+    'active_sessions': "SELECT record FROM sessions "
+                       "WHERE active = 1 AND recipient_id = ?",
+    'set_trust': "UPDATE identities SET trust = ? WHERE _id = ?",
+}
+
+
+def jid(contact):
+    return 'contact%d@example.com' % contact
+
+
+def generate(count, seed=0):
+    """ Return a list of (operation, args) tuples. """
+    rand = random.Random(seed)
+    ops = [op for op, weight in MIX for _ in range(weight)]
+    workload = []
+    for _ in range(count):
+        op = rand.choice(ops)
+        contact = rand.randrange(CONTACTS)
+        if op in ('load_session', 'store_session'):
+            args = [jid(contact), rand.randrange(DEVICES_PER_CONTACT)]
+        elif op == 'set_trust':
+            args = [rand.randrange(3),
+                    contact * DEVICES_PER_CONTACT + 1 +
+                    rand.randrange(DEVICES_PER_CONTACT)]
+        else:
+            args = [jid(contact)]
+        workload.append((op, args))
+    return workload
+
+
+def populate(conn):
+    rows = [(jid(contact), device_id, os.urandom(RECORD_SIZE))
+            for contact in range(CONTACTS)
+            for device_id in range(DEVICES_PER_CONTACT)]
+    conn.executemany(QUERIES['store_session'], rows)
+    conn.executemany("INSERT INTO identities (recipient_id, public_key, "
+                     "trust) VALUES(?,?,?)",
+                     [(recipient_id, os.urandom(33), 2)
+                      for recipient_id, _, _ in rows])
+    conn.commit()
+
+
+def open_db(tmp, name, tuned):
+    conn = tmp.db(name)
+    conn.text_factory = bytes
+    SQLDatabase(conn)
+    if tuned:
+        tune_connection(conn)
+    else:
+        conn.executescript("DROP INDEX sessions_identity_index;"
+                           "DROP INDEX identities_trust_index;")
+    populate(conn)
+    return conn
+
+
+def replay(conn, workload):
+    record = os.urandom(RECORD_SIZE)
+    for op, args in workload:
+        if op == 'store_session':
+            conn.execute(QUERIES[op], args + [record])
+            conn.commit()
+        elif op == 'set_trust':
+            conn.execute(QUERIES[op], args)
+            conn.commit()
+        else:
+            conn.execute(QUERIES[op], args).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--operations', type=int, default=OPERATIONS)
+    parser.add_argument('--record', metavar='FILE',
+                        help='write the generated workload to FILE')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='replay the workload from FILE')
+    args = parser.parse_args()
+
+    if args.replay:
+        with open(args.replay) as file_:
+            workload = [tuple(line) for line in json.load(file_)]
+    else:
+        workload = generate(args.operations)
+    if args.record:
+        with open(args.record, 'w') as file_:
+            json.dump(workload, file_)
+
+    print('%8s %12s' % ('setup', 'queries/s'))
+    with TempDir() as tmp:
+        for name, tuned in (('default', False), ('tuned', True)):
+            conn = open_db(tmp, name, tuned)
+            _, seconds = timed(replay, conn, workload)
+            conn.close()
+            print('%8s %12.1f' % (name, len(workload) / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+""" Measure MAM catch-up decryption throughput.
+
+    Builds a synthetic archive of messages sent to alice by several of bobs
+    devices after a session was established, then decrypts it once message
+    by message with a commit per message, like the main loop did before,
+    and once through the MamDecryptionPipeline.
+"""
+from __future__ import print_function
+
+import shutil
+import sys
+
+from common import TempDir, bundle_dict, create_state, timed, trust_all
+
+from omemo.mam import MAX_BATCH_SIZE, MamDecryptionPipeline
+
+ALICE = 'alice@example.com'
+BOB = 'bob@example.com'
+MESSAGES = 10000
+SENDERS = 10
+
+
+def build_archive(tmp, count, senders):
+    alice = create_state(ALICE, conn=tmp.db('alice'))
+    alice.set_own_devices([alice.own_device_id])
+    bobs = [create_state(BOB) for _ in range(senders)]
+    for i, bob in enumerate(bobs):
+        bob.set_own_devices([bob.own_device_id])
+        bob.build_session(ALICE, alice.own_device_id, bundle_dict(alice, i))
+        bob.set_devices(ALICE, [alice.own_device_id])
+        trust_all(bob, ALICE)
+
+    # Answer every device once, so the archive holds WhisperMessages
+    for bob in bobs:
+        alice.decrypt_msg(dict(bob.create_msg(BOB, ALICE, b'Hi'),
+                               sender_jid=BOB))
+    trust_all(alice, BOB)
+    alice.set_devices(BOB, [bob.own_device_id for bob in bobs])
+    reply = dict(alice.create_msg(ALICE, BOB, b'Hi'), sender_jid=ALICE)
+    for bob in bobs:
+        bob.decrypt_msg(reply)
+    alice.store.sessionStore.flush()
+
+    archive = [dict(bobs[i % senders].create_msg(BOB, ALICE,
+                                                 b'Message %d' % i),
+                    sender_jid=BOB)
+               for i in range(count)]
+    return archive
+
+
+def copy_state(tmp, name):
+    shutil.copy(tmp.path + '/alice.db', tmp.path + '/' + name + '.db')
+    return create_state(ALICE, conn=tmp.db(name))
+
+
+def sequential(state, archive):
+    for msg_dict in archive:
+        state.decrypt_msg(msg_dict)
+        state.store.sessionStore.flush()
+
+
+def pipelined(state, archive):
+    delivered = []
+    pipeline = MamDecryptionPipeline(
+        state, delivered.extend, lambda callback, *args: callback(*args))
+    items = [(msg_dict, None) for msg_dict in archive]
+    for start in range(0, len(items), MAX_BATCH_SIZE):
+        pipeline.process(items[start:start + MAX_BATCH_SIZE])
+    assert pipeline.failed == 0
+    return delivered
+
+
+def main(count=MESSAGES, senders=SENDERS):
+    with TempDir() as tmp:
+        print('Building archive of %d messages from %d devices ...' %
+              (count, senders))
+        archive = build_archive(tmp, count, senders)
+
+        print('%12s %12s' % ('mode', 'messages/s'))
+        for name, run in (('sequential', sequential),
+                          ('pipeline', pipelined)):
+            state = copy_state(tmp, name)
+            _, seconds = timed(run, state, archive)
+            print('%12s %12.1f' % (name, count / seconds))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
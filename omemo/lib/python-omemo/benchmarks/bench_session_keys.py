@@ -0,0 +1,69 @@
+""" Measure reading the identity keys of stored sessions.
+
+    Compares the identity_key column with deserializing every
+    SessionRecord, like the session store did before. All sessions share
+    the same bundle, so only the number of rows matters.
+"""
+from __future__ import print_function
+
+import sys
+
+from axolotl.state.sessionrecord import SessionRecord
+
+from common import TempDir, bundle_dict, create_state, timed
+
+ALICE = 'alice@example.com'
+SESSIONS = 5000
+DEVICES_PER_CONTACT = 5
+ROUNDS = 20
+
+
+def keys_from_records(conn, recipient_id=None):
+    q = "SELECT record FROM sessions WHERE active = 1"
+    args = ()
+    if recipient_id is not None:
+        q += " AND recipient_id = ?"
+        args = (recipient_id, )
+    return [SessionRecord(serialized=row[0]).getSessionState().
+            getRemoteIdentityKey().getPublicKey().serialize()
+            for row in conn.execute(q, args)]
+
+
+def main(sessions):
+    with TempDir() as tmp:
+        conn = tmp.db('alice')
+        alice = create_state(ALICE, conn=conn)
+        bundle = bundle_dict(create_state('bob@example.com'))
+        contacts = sessions // DEVICES_PER_CONTACT
+        store = alice.store.sessionStore
+        store.cacheSize = sessions
+        for i in range(sessions):
+            alice.build_session('contact%d@example.com' % (i % contacts),
+                                i + 1, bundle)
+        store.flush()
+        print('%d sessions, %d contacts' % (sessions, contacts))
+
+        assert sorted(store.getAllActiveSessionsKeys()) == \
+            sorted(keys_from_records(conn))
+
+        print('%-28s %12s %12s' % ('query', 'record ms', 'column ms'))
+        _, old = timed(lambda: [keys_from_records(conn)
+                                for _ in range(ROUNDS)])
+        _, new = timed(lambda: [store.getAllActiveSessionsKeys()
+                                for _ in range(ROUNDS)])
+        print('%-28s %12.2f %12.2f' % ('getAllActiveSessionsKeys',
+                                       old * 1000 / ROUNDS,
+                                       new * 1000 / ROUNDS))
+
+        jids = ['contact%d@example.com' % i for i in range(contacts)]
+        _, old = timed(lambda: [keys_from_records(conn, jid)
+                                for jid in jids])
+        _, new = timed(lambda: [store.getActiveSessionsKeys(jid)
+                                for jid in jids])
+        print('%-28s %12.3f %12.3f' % ('getActiveSessionsKeys',
+                                       old * 1000 / contacts,
+                                       new * 1000 / contacts))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else SESSIONS)
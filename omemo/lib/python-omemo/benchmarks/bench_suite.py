@@ -0,0 +1,206 @@
+""" Run a synthetic load against OmemoState and report JSON results.
+
+    Creates a number of accounts with several devices each, all in memory.
+    Every device sends a first message to every other account, which
+    builds the sessions through OmemoState.build_session, then the devices
+    exchange messages. Reported are the time to the first message, the
+    create_msg and decrypt_msg throughput, the PreKey refill time and the
+    growth of the databases. The results are written as JSON, to compare
+    them across store and crypto changes.
+"""
+from __future__ import division, print_function
+
+import argparse
+import json
+import platform
+import random
+import sys
+
+from common import bundle_dict, create_state, timed, trust_all
+
+ACCOUNTS = 4
+DEVICES = 3
+MESSAGES = 500
+
+
+def jid(account):
+    return 'account%d@example.com' % account
+
+
+def db_size(state):
+    db = state.store.sessionStore.dbConn
+    page_count = db.execute('PRAGMA page_count').fetchone()[0]
+    page_size = db.execute('PRAGMA page_size').fetchone()[0]
+    return page_count * page_size
+
+
+def total_size(accounts):
+    return sum(db_size(device) for devices in accounts for device in devices)
+
+
+def create_accounts(count, devices):
+    accounts = []
+    for account in range(count):
+        states = [create_state(jid(account)) for _ in range(devices)]
+        for state in states:
+            state.set_own_devices([state.own_device_id])
+        accounts.append(states)
+    return accounts
+
+
+def first_message(sender, recipients):
+    """ Build the sessions to all recipient devices, send a message and
+        decrypt it on every device.
+    """
+    recipient_jid = recipients[0].own_jid
+    for recipient in recipients:
+        # The first PreKey is always unused, decrypting consumes it
+        sender.build_session(recipient_jid, recipient.own_device_id,
+                             bundle_dict(recipient))
+    sender.set_devices(recipient_jid,
+                       [recipient.own_device_id for recipient in recipients])
+    trust_all(sender, recipient_jid)
+
+    msg = sender.create_msg(sender.own_jid, recipient_jid, b'Hello')
+    msg['sender_jid'] = sender.own_jid
+    for recipient in recipients:
+        assert recipient.decrypt_msg(msg) == 'Hello'
+
+
+def establish_sessions(accounts):
+    latencies = []
+    for account, senders in enumerate(accounts):
+        for sender in senders:
+            for other, recipients in enumerate(accounts):
+                if other != account:
+                    _, seconds = timed(first_message, sender, recipients)
+                    latencies.append(seconds)
+    return {
+        'first_messages': len(latencies),
+        'time_to_first_message_avg_ms': 1000 * sum(latencies) /
+        len(latencies),
+        'time_to_first_message_max_ms': 1000 * max(latencies),
+    }
+
+
+def exchange_messages(accounts, count, rng):
+    """ Let random devices send count messages to random other accounts,
+        then decrypt them all.
+    """
+    plan = []
+    for i in range(count):
+        account = rng.randrange(len(accounts))
+        other = rng.choice([other for other in range(len(accounts))
+                            if other != account])
+        plan.append((rng.choice(accounts[account]), other, b'msg %d' % i))
+
+    def create():
+        return [(sender.own_jid, other,
+                 sender.create_msg(sender.own_jid, jid(other), plaintext))
+                for sender, other, plaintext in plan]
+
+    messages, create_seconds = timed(create)
+
+    def decrypt():
+        decrypted = 0
+        for sender_jid, other, msg in messages:
+            for recipient in accounts[other]:
+                if recipient.decrypt_msg(dict(msg, sender_jid=sender_jid)):
+                    decrypted += 1
+        return decrypted
+
+    decrypted, decrypt_seconds = timed(decrypt)
+    keys = sum(len(msg['keys']) for _, _, msg in messages)
+    return {
+        'messages': count,
+        'create_msg_per_s': count / create_seconds,
+        'encrypted_keys_per_s': keys / create_seconds,
+        'decrypt_msg_per_s': decrypted / decrypt_seconds,
+    }
+
+
+def refill_prekeys(accounts):
+    """ Consume PreKeys until a refill is due and time the refill and the
+        bundle rebuild.
+    """
+    refills, bundles, generated = [], [], 0
+    for devices in accounts:
+        for state in devices:
+            store = state.store.preKeyStore
+            # Build the cached bundle, so only the new PreKeys are encoded
+            state.bundle
+            while store.getPreKeyCount() >= 80:
+                store.removePreKey(state.store.loadPreKeys()[0].getId())
+            before = store.getPreKeyCount()
+            _, seconds = timed(state.checkPreKeyAmount)
+            refills.append(seconds)
+            generated += store.getPreKeyCount() - before
+            _, seconds = timed(lambda: state.bundle)
+            bundles.append(seconds)
+    return {
+        'refills': len(refills),
+        'prekeys_generated': generated,
+        'refill_avg_ms': 1000 * sum(refills) / len(refills),
+        'prekeys_per_s': generated / sum(refills),
+        'bundle_rebuild_avg_ms': 1000 * sum(bundles) / len(bundles),
+    }
+
+
+def run(accounts, devices, messages, seed=0):
+    rng = random.Random(seed)
+    results = {}
+
+    states, seconds = timed(create_accounts, accounts, devices)
+    results['setup'] = {'devices': accounts * devices,
+                        'create_device_avg_ms':
+                        1000 * seconds / (accounts * devices)}
+    sizes = {'initial': total_size(states)}
+
+    results['sessions'] = establish_sessions(states)
+    sizes['after_sessions'] = total_size(states)
+
+    results['messages'] = exchange_messages(states, messages, rng)
+    sizes['after_messages'] = total_size(states)
+
+    results['prekeys'] = refill_prekeys(states)
+
+    sessions = accounts * devices * (accounts - 1) * devices
+    results['db_size'] = dict(sizes, **{
+        'bytes_per_session':
+        (sizes['after_sessions'] - sizes['initial']) / sessions,
+        'bytes_per_message':
+        (sizes['after_messages'] - sizes['after_sessions']) / messages,
+    })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--accounts', type=int, default=ACCOUNTS)
+    parser.add_argument('--devices', type=int, default=DEVICES,
+                        help='devices per account')
+    parser.add_argument('--messages', type=int, default=MESSAGES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', metavar='FILE',
+                        help='write the results to FILE instead of stdout')
+    args = parser.parse_args()
+    if args.accounts < 2:
+        parser.error('at least two accounts are needed')
+
+    report = {
+        'python': platform.python_version(),
+        'params': {'accounts': args.accounts, 'devices': args.devices,
+                   'messages': args.messages, 'seed': args.seed},
+        'results': run(args.accounts, args.devices, args.messages,
+                       args.seed),
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+""" Helpers shared by the benchmarks.
+
+    The benchmarks import the plugin's omemo package, run them from the
+    plugin directory with ``PYTHONPATH=. python lib/python-omemo/benchmarks/``.
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+# The OmemoState helpers are shared with the tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'tests'))
+
+from helpers import (FakePlugin, bundle_dict,  # noqa: E402,F401
+                     create_state, trust_all)
+
+
+class TempDir(object):
+    """ Context manager for a temporary directory holding benchmark dbs. """
+
+    def __enter__(self):
+        self.path = tempfile.mkdtemp(prefix='omemo-bench-')
+        return self
+
+    def __exit__(self, *args):
+        shutil.rmtree(self.path)
+
+    def db(self, name):
+        path = os.path.join(self.path, name + '.db')
+        return sqlite3.connect(path, check_same_thread=False)
+
+
+def timed(func, *args, **kwargs):
+    """ Return the result of func and the seconds it took. """
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
@@ -0,0 +1,72 @@
+""" Helpers shared by the tests and the benchmarks. """
+import sqlite3
+
+from omemo.state import OmemoState
+
+
+class FakeLoop(object):
+    """ Collects timeouts, fire() runs them like gobject would and keeps
+        those whose callback returned True.
+    """
+
+    def __init__(self):
+        self.sources = {}
+        self.next_id = 1
+
+    def timeout_add(self, interval, callback, *args):
+        self.sources[self.next_id] = (callback, args)
+        self.next_id += 1
+        return self.next_id - 1
+
+    def source_remove(self, source_id):
+        del self.sources[source_id]
+
+    def fire(self):
+        sources, self.sources = self.sources, {}
+        for source_id, (callback, args) in sources.items():
+            if callback(*args):
+                self.sources[source_id] = (callback, args)
+
+
+class FakePlugin(object):
+    """ Stands in for the OmemoPlugin and records published bundles. """
+
+    def __init__(self):
+        self.published = []
+
+    def publish_bundle(self, account):
+        self.published.append(account)
+
+
+def create_state(jid, account=None, plugin=None, conn=None):
+    """ Create an OmemoState, backed by an in memory sqlite db unless a
+        connection is given.
+    """
+    if conn is None:
+        conn = sqlite3.connect(':memory:', check_same_thread=False)
+    return OmemoState(jid, conn, account or jid, plugin or FakePlugin())
+
+
+def bundle_dict(state, prekey_index=0):
+    """ Build the bundle dict of state, the way unpack_device_bundle()
+        returns it.
+    """
+    store = state.store
+    prekey = store.loadPreKeys()[prekey_index]
+    signed_prekey = store.loadSignedPreKey(store.getCurrentSignedPreKeyId())
+    return {
+        'preKeyId': prekey.getId(),
+        'preKeyPublic': prekey.getKeyPair().getPublicKey().serialize(),
+        'signedPreKeyId': signed_prekey.getId(),
+        'signedPreKeyPublic':
+        signed_prekey.getKeyPair().getPublicKey().serialize(),
+        'signedPreKeySignature': signed_prekey.getSignature(),
+        'identityKey': store.getIdentityKeyPair().getPublicKey().serialize()
+    }
+
+
+def trust_all(state, jid):
+    """ Mark all known identities of jid as trusted. """
+    identity_store = state.store.identityKeyStore
+    for _id, _, _, _ in identity_store.getFingerprints(jid):
+        identity_store.setTrust(_id, 1)
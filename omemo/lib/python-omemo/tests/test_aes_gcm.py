@@ -0,0 +1,83 @@
+from binascii import unhexlify
+
+import pytest
+from Crypto.Cipher import AES
+
+from omemo import aes_gcm_fallback
+from omemo.aes_gcm_fallback import gcm_decrypt, gcm_encrypt, gctr, ghash
+
+K = unhexlify('feffe9928665731c6d6a8f9467308308')
+P = unhexlify('d9313225f88406e5a55909c5aff5269a86a7a9531534f7da2e4c303d'
+              '8a318a721c3c0c95956809532fcf0e2449a6b525b16aedf5aa0de657'
+              'ba637b391aafd255')
+A = unhexlify('feedfacedeadbeeffeedfacedeadbeefabaddad2')
+C = unhexlify('42831ec2217774244b7221b784d0d49ce3aa212f2c02a4e035c17e23'
+              '29aca12e21d514b25466931c7d8f6a5aac84aa051ba30b396a0aac97'
+              '3d58e091473f5985')
+
+# Test cases 2, 3, 4 and 6 of the GCM specification
+VECTORS = [
+    (b'\0' * 16, b'\0' * 12, b'\0' * 16, b'',
+     unhexlify('0388dace60b6a392f328c2b971b2fe78'),
+     unhexlify('ab6e47d42cec13bdf53a67b21257bddf')),
+    (K, unhexlify('cafebabefacedbaddecaf888'), P, b'', C,
+     unhexlify('4d5c2af327cd64a62cf35abd2ba6fab4')),
+    (K, unhexlify('cafebabefacedbaddecaf888'), P[:60], A, C[:60],
+     unhexlify('5bc94fbc3221a5db94fae95ae7121a47')),
+    (K, unhexlify('9313225df88406e555909c5aff5269aa6a7a9538534f7da1e4c303d2'
+                  'a318a728c3c0c95156809539fcf0e2429a6b525416aedbf5a0de6a57'
+                  'a637b39b'), P[:60], A,
+     unhexlify('8ce24998625615b603a033aca13fb894be9112a5c3a211a8ba262a3c'
+               'ca7e2ca701e4a9a4fba43c90ccdcb281d48c7c6fd62875d2aca41703'
+               '4c34aee5'),
+     unhexlify('619cc5aefffe0bfa462af43c1699d050')),
+]
+
+
+@pytest.mark.parametrize('key,iv,plaintext,auth_data,ciphertext,tag',
+                         VECTORS)
+def test_vectors(key, iv, plaintext, auth_data, ciphertext, tag):
+    assert gcm_encrypt(key, iv, plaintext, auth_data) == (ciphertext, tag)
+    assert gcm_decrypt(key, iv, ciphertext, auth_data, tag) == plaintext
+
+
+def test_invalid_tag_is_rejected():
+    key, iv, _, auth_data, ciphertext, tag = VECTORS[1]
+    with pytest.raises(ValueError):
+        gcm_decrypt(key, iv, ciphertext, auth_data, b'\0' * 16)
+
+
+def test_ghash_matches_bitwise_multiplication():
+    def mult(x, y):
+        z = 0
+        for i in range(127, -1, -1):
+            if (y >> i) & 1:
+                z ^= x
+            x = aes_gcm_fallback._times_x(x)
+        return z
+
+    h = unhexlify('66e94bd4ef8a2c3b884cfa59ca342b2e')
+    block = unhexlify('0388dace60b6a392f328c2b971b2fe78')
+    expected = mult(aes_gcm_fallback.bytes_to_int(block),
+                    aes_gcm_fallback.bytes_to_int(h))
+    lengths = aes_gcm_fallback.bytes_to_int(b'\0' * 15 + b'\x80')
+    expected = mult(expected ^ lengths, aes_gcm_fallback.bytes_to_int(h))
+    assert ghash(h, b'', block) == aes_gcm_fallback.int_to_bytes(expected)
+
+
+def test_gctr_counter_wraps_around():
+    key = b'k' * 16
+    aes = AES.new(key)
+    icb = b'\0' * 12 + b'\xff\xff\xff\xfe'
+    expected = aes.encrypt(b'\0' * 12 + b'\xff' * 4) + \
+        aes.encrypt(b'\0' * 16) + aes.encrypt(b'\0' * 15 + b'\x01')
+    assert gctr(key, icb, b'\0' * 40) == expected[:40]
+
+
+def test_matches_native_backend():
+    native = pytest.importorskip('omemo.aes_gcm_native')
+    key, iv = b'k' * 16, b'i' * 16
+    plaintext = b'Hello OMEMO' * 100
+    payload = aes_gcm_fallback.aes_encrypt(key, iv, plaintext)
+    assert payload == native.aes_encrypt(key, iv, plaintext)
+    assert native.aes_decrypt(key, iv, payload) == plaintext
@@ -0,0 +1,50 @@
+from helpers import create_state
+
+from omemo.liteaxolotlstore import DEFAULT_PREKEY_AMOUNT, MIN_PREKEY_AMOUNT
+
+
+def prekey_ids(bundle):
+    return [prekey_id for prekey_id, _ in bundle['prekeys']]
+
+
+def test_bundle_is_cached():
+    state = create_state('alice@example.com')
+    bundle = state.bundle
+    assert len(bundle['prekeys']) == DEFAULT_PREKEY_AMOUNT
+    assert state.bundle is bundle
+
+
+def test_bundle_drops_consumed_prekeys():
+    state = create_state('alice@example.com')
+    bundle = state.bundle
+    consumed = prekey_ids(bundle)[0]
+
+    state.store.removePreKey(consumed)
+    new_bundle = state.bundle
+    assert new_bundle is not bundle
+    assert prekey_ids(new_bundle) == prekey_ids(bundle)[1:]
+
+
+def test_bundle_refills_prekeys():
+    state = create_state('alice@example.com')
+    for prekey_id in prekey_ids(state.bundle)[MIN_PREKEY_AMOUNT - 1:]:
+        state.store.removePreKey(prekey_id)
+
+    bundle = state.bundle
+    assert len(bundle['prekeys']) == DEFAULT_PREKEY_AMOUNT
+    public_keys = dict(bundle['prekeys'])
+    for record in state.store.loadPreKeys():
+        assert record.getId() in public_keys
+
+
+def test_generate_prekeys_updates_cache():
+    state = create_state('alice@example.com')
+    prekey_store = state.store.preKeyStore
+    conn = prekey_store.dbConn
+    changes = conn.total_changes
+
+    prekey_store.generateNewPreKeys(20)
+    assert conn.total_changes - changes == 20
+    assert prekey_store.getPreKeyCount() == DEFAULT_PREKEY_AMOUNT + 20
+    assert conn.execute('SELECT COUNT(*) FROM prekeys').fetchone()[0] == \
+        DEFAULT_PREKEY_AMOUNT + 20
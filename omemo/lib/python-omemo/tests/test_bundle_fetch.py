@@ -0,0 +1,192 @@
+import sqlite3
+
+import pytest
+
+from helpers import FakeLoop
+from omemo.bundlefailures import BundleFailureStore
+from omemo.bundlefetch import (FAILED_EXPIRY, PREFETCH_FAILED_EXPIRY,
+                               BundleFetcher, BundlePrefetcher)
+from omemo.sql import SQLDatabase
+
+ROMEO = 'romeo@example.com'
+
+
+class Clock(object):
+    def __init__(self):
+        self.time = 1000.0
+
+    def __call__(self):
+        return self.time
+
+
+@pytest.fixture
+def loop():
+    return FakeLoop()
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def sent():
+    return []
+
+
+@pytest.fixture
+def forgotten():
+    return []
+
+
+@pytest.fixture
+def given_up():
+    return []
+
+
+@pytest.fixture
+def fetcher(loop, clock, sent, forgotten, given_up):
+    def send_query(jid, device_id):
+        sent.append((jid, device_id))
+        return 'iq%d' % len(sent)
+
+    return BundleFetcher(send_query, forgotten.append, loop.timeout_add,
+                         loop.source_remove, now=clock, max_in_flight=2,
+                         timeout=30, max_attempts=2, backoff=5,
+                         gave_up=lambda *key: given_up.append(key))
+
+
+@pytest.fixture
+def failures():
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    conn.text_factory = bytes
+    SQLDatabase(conn)
+    return BundleFailureStore(conn)
+
+
+@pytest.fixture
+def prefetcher(fetcher, failures, loop, clock):
+    return BundlePrefetcher(fetcher, failures, loop.timeout_add,
+                            loop.source_remove, now=clock, rate=2)
+
+
+def test_fetch_is_deduplicated(fetcher, sent):
+    assert fetcher.fetch(ROMEO, 1)
+    assert not fetcher.fetch(ROMEO, 1)
+    assert sent == [(ROMEO, 1)]
+
+
+def test_in_flight_is_bounded(fetcher, clock, sent):
+    for device_id in range(4):
+        fetcher.fetch(ROMEO, device_id)
+    assert len(sent) == 2
+
+    clock.time += 0.5
+    fetcher.result(ROMEO, 0, True)
+    assert len(sent) == 3
+    stats = fetcher.stats()
+    assert stats['fetched'] == 1
+    assert stats['queued'] == 1
+    assert stats['latency_max'] == 0.5
+
+
+def test_timeout_retries_then_gives_up(fetcher, loop, clock, sent,
+                                       forgotten, given_up):
+    fetcher.fetch(ROMEO, 1)
+    clock.time += 30
+    loop.fire()
+    assert forgotten == ['iq1']
+    assert fetcher.stats()['timeouts'] == 1
+
+    # The retry timeout fires and sends the query again
+    loop.fire()
+    assert sent == [(ROMEO, 1), (ROMEO, 1)]
+
+    fetcher.result(ROMEO, 1, False)
+    assert fetcher.stats()['failed'] == 1
+    assert given_up == [(ROMEO, 1)]
+    assert not fetcher.fetch(ROMEO, 1)
+
+    clock.time += FAILED_EXPIRY
+    assert fetcher.fetch(ROMEO, 1)
+
+
+def test_forget_allows_new_fetch(fetcher, loop, sent):
+    fetcher.fetch(ROMEO, 1)
+    fetcher.result(ROMEO, 1, False)
+    loop.fire()
+    fetcher.result(ROMEO, 1, False)
+    assert not fetcher.fetch(ROMEO, 1)
+
+    fetcher.forget(ROMEO)
+    assert fetcher.fetch(ROMEO, 1)
+    assert len(sent) == 3
+
+
+def test_fetched_device_is_not_queried_again(fetcher, sent):
+    fetcher.fetch(ROMEO, 1)
+    fetcher.result(ROMEO, 1, True)
+    assert not fetcher.fetch(ROMEO, 1)
+
+    fetcher.forget(ROMEO)
+    assert fetcher.fetch(ROMEO, 1)
+    fetcher.result(ROMEO, 1, True)
+    fetcher.reset()
+    assert fetcher.fetch(ROMEO, 1)
+    assert len(sent) == 3
+
+
+def test_reset_drops_pending_queries(fetcher, loop, forgotten):
+    fetcher.fetch(ROMEO, 1)
+    fetcher.reset()
+    assert forgotten == ['iq1']
+    assert loop.sources == {}
+    assert fetcher.fetch(ROMEO, 1)
+
+
+def test_prefetch_is_rate_limited(prefetcher, fetcher, loop, sent):
+    prefetcher.add(ROMEO, [1, 2, 3])
+    prefetcher.add(ROMEO, [1])
+    assert sent == []
+
+    loop.fire()
+    # The fetcher allows two queries, the prefetch only uses half of them
+    assert sent == [(ROMEO, 1)]
+    fetcher.result(ROMEO, 1, True)
+    loop.fire()
+    assert sent == [(ROMEO, 1), (ROMEO, 2)]
+    fetcher.result(ROMEO, 2, True)
+    loop.fire()
+    assert len(sent) == 3
+    assert prefetcher.stats() == {'prefetched': 3, 'skipped': 0,
+                                  'queued': 0}
+    assert prefetcher.timeout_id is None
+
+
+def test_prefetch_waits_for_interactive_fetches(prefetcher, fetcher, loop,
+                                                sent):
+    prefetcher.add(ROMEO, [1])
+    fetcher.fetch('juliet@example.com', 1)
+    loop.fire()
+    assert sent == [('juliet@example.com', 1)]
+
+    fetcher.result('juliet@example.com', 1, True)
+    loop.fire()
+    assert sent[-1] == (ROMEO, 1)
+
+
+def test_prefetch_skips_persisted_failures(prefetcher, failures, loop,
+                                           clock, sent):
+    failures.add(ROMEO, 1, clock())
+    reloaded = BundleFailureStore(failures.dbConn)
+    assert reloaded.get(ROMEO, 1) == clock()
+
+    prefetcher.add(ROMEO, [1])
+    assert prefetcher.stats()['skipped'] == 1
+    assert not loop.sources
+
+    clock.time += PREFETCH_FAILED_EXPIRY
+    prefetcher.add(ROMEO, [1])
+    assert failures.get(ROMEO, 1) is None
+    loop.fire()
+    assert sent == [(ROMEO, 1)]
@@ -0,0 +1,78 @@
+import pytest
+from axolotl.state.sessionrecord import SessionRecord
+
+from helpers import bundle_dict, create_state, trust_all
+
+ALICE = 'alice@example.com'
+BOB = 'bob@example.com'
+
+
+@pytest.fixture
+def alice():
+    state = create_state(ALICE)
+    state.set_own_devices([state.own_device_id])
+    return state
+
+
+@pytest.fixture
+def bobs():
+    return [create_state(BOB) for _ in range(3)]
+
+
+def connect(alice, bobs):
+    for bob in bobs:
+        alice.build_session(BOB, bob.own_device_id, bundle_dict(bob))
+    alice.set_devices(BOB, [bob.own_device_id for bob in bobs])
+
+
+def test_create_msg_encrypts_for_trusted_devices(alice, bobs):
+    connect(alice, bobs)
+    trust_all(alice, BOB)
+
+    msg = alice.create_msg(ALICE, BOB, b'Hello')
+    assert set(msg['keys']) == set(bob.own_device_id for bob in bobs)
+
+    for bob in bobs:
+        msg_dict = dict(msg, sender_jid=ALICE)
+        assert bob.decrypt_msg(msg_dict) == 'Hello'
+
+
+def test_create_msg_skips_undecided_devices(alice, bobs):
+    connect(alice, bobs)
+    identity_store = alice.store.identityKeyStore
+    fingerprints = identity_store.getFingerprints(BOB)
+    identity_store.setTrust(fingerprints[0][0], 1)
+
+    msg = alice.create_msg(ALICE, BOB, b'Hello')
+    assert len(msg['keys']) == 1
+
+
+def test_create_msg_persists_sessions(alice, bobs):
+    connect(alice, bobs)
+    trust_all(alice, BOB)
+    session_store = alice.store.sessionStore
+    session_store.flush()
+    before = dict(session_store.dbConn.execute(
+        'SELECT device_id, record FROM sessions'))
+
+    alice.create_msg(ALICE, BOB, b'Hello')
+    assert not session_store.dirtySessions
+
+    after = dict(session_store.dbConn.execute(
+        'SELECT device_id, record FROM sessions'))
+    for bob in bobs:
+        device_id = bob.own_device_id
+        assert before[device_id] != after[device_id]
+        assert SessionRecord(serialized=after[device_id]).serialize() == \
+            session_store.loadSession(BOB, device_id).serialize()
+
+
+def test_load_recipient_fills_session_cache(alice, bobs):
+    connect(alice, bobs)
+    session_store = alice.store.sessionStore
+    session_store.flush()
+    session_store.sessionCache.clear()
+
+    trust_states = alice.load_recipient(BOB)
+    assert len(session_store.sessionCache) == len(bobs)
+    assert set(trust_states.values()) == set([2])
@@ -17,3 +17,14 @@ def test_user_version():
     db.execute('PRAGMA user_version=1')
     assert db_helpers.user_version(db) == 1
 
+
+
+def test_tune_connection(tmpdir):
+    db = sqlite3.connect(str(tmpdir.join('omemo.db')),
+                         check_same_thread=False)
+    db_helpers.tune_connection(db, cache_kib=1024)
+
+    assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    assert db.execute('PRAGMA synchronous').fetchone()[0] == 1
+    assert db.execute('PRAGMA cache_size').fetchone()[0] == -1024
+    assert db.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
@@ -0,0 +1,91 @@
+import sqlite3
+
+import pytest
+
+from helpers import FakeLoop, FakePlugin, bundle_dict, create_state
+from omemo.devicelist import DeviceListBuffer
+from omemo.state import OmemoState
+
+ALICE = 'alice@example.com'
+BOB = 'bob@example.com'
+
+
+class CountingConnection(sqlite3.Connection):
+    commits = 0
+
+    def commit(self):
+        self.commits += 1
+        return sqlite3.Connection.commit(self)
+
+
+@pytest.fixture
+def loop():
+    return FakeLoop()
+
+
+@pytest.fixture
+def applied():
+    return []
+
+
+@pytest.fixture
+def buffer(loop, applied):
+    return DeviceListBuffer(lambda *args: applied.append(args),
+                            loop.timeout_add, loop.source_remove)
+
+
+def test_lists_are_applied_per_account_after_window(loop, applied, buffer):
+    buffer.add('alice', BOB, set([1]))
+    buffer.add('alice', BOB, set([1, 2]))
+    buffer.add('alice', 'carol@example.com', set([3]))
+    buffer.add('other', BOB, set([4]))
+    assert applied == []
+
+    loop.fire()
+    assert sorted(applied) == [
+        ('alice', {BOB: set([1, 2]), 'carol@example.com': set([3])}),
+        ('other', {BOB: set([4])})]
+    assert buffer.stats() == {'received': 4, 'batches': 2}
+    assert not loop.sources
+
+
+def test_flush_applies_immediately(loop, applied, buffer):
+    buffer.flush('alice')
+    assert applied == []
+
+    buffer.add('alice', BOB, set([1]))
+    buffer.flush('alice')
+    assert applied == [('alice', {BOB: set([1])})]
+    assert not loop.sources
+
+
+def test_set_device_lists_uses_one_transaction():
+    conn = sqlite3.connect(':memory:', check_same_thread=False,
+                           factory=CountingConnection)
+    alice = OmemoState(ALICE, conn, ALICE, FakePlugin())
+    bob = create_state(BOB)
+    for device_id in (1, 2, 3):
+        alice.build_session(BOB, device_id, bundle_dict(bob))
+    alice.store.sessionStore.flush()
+    contacts = ['contact%d@example.com' % i for i in range(100)]
+
+    conn.commits = 0
+    device_lists = dict((jid, set([1])) for jid in contacts)
+    device_lists[BOB] = set([1, 3])
+    changed = alice.set_device_lists(device_lists, contacts)
+    assert conn.commits == 1
+    assert set(changed) == set(device_lists)
+    assert sorted(alice.store.getActiveDeviceTuples()) == \
+        [(BOB, 1), (BOB, 3)]
+    assert all(alice.encryption.is_active(jid) for jid in contacts)
+    assert not alice.encryption.exist(BOB)
+
+    device_lists[BOB] = set([3])
+    assert alice.set_device_lists(device_lists) == {BOB: set([3])}
+    assert sorted(alice.store.getActiveDeviceTuples()) == [(BOB, 3)]
+
+    # A session built meanwhile is deactivated by an unchanged list
+    alice.build_session(BOB, 2, bundle_dict(bob))
+    alice.store.sessionStore.flush()
+    assert alice.set_device_lists(device_lists) == {}
+    assert sorted(alice.store.getActiveDeviceTuples()) == [(BOB, 3)]
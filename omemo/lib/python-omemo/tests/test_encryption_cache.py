@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+
+import pytest
+
+from omemo.encryption import EncryptionState
+from omemo.sql import SQLDatabase
+
+ROMEO = u'romeo@example.com'
+JULIET = u'jülïet@example.com'
+
+
+@pytest.fixture
+def db():
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    conn.text_factory = bytes
+    SQLDatabase(conn)
+    return conn
+
+
+def test_reads_are_served_from_memory(db):
+    EncryptionState(db).activate(ROMEO)
+    state = EncryptionState(db)
+
+    for _ in range(10):
+        assert state.is_active(ROMEO)
+        assert not state.is_active(JULIET)
+        assert state.exist(ROMEO)
+        assert not state.exist(JULIET)
+    assert state.stats() == {'lookups': 40, 'queries': 1, 'jids': 1}
+
+
+def test_changes_write_through(db):
+    state = EncryptionState(db)
+    assert not state.is_active(JULIET)
+
+    state.activate(JULIET)
+    assert state.is_active(JULIET)
+    state.deactivate(ROMEO)
+    assert state.exist(ROMEO)
+    assert not state.is_active(ROMEO)
+
+    reloaded = EncryptionState(db)
+    assert reloaded.is_active(JULIET)
+    assert reloaded.exist(ROMEO)
+    assert not reloaded.is_active(ROMEO)
+
+
+def test_stored_jids_match_unicode_jids(db):
+    EncryptionState(db).activate(JULIET)
+    assert EncryptionState(db).is_active(JULIET)
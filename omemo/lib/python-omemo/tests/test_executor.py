@@ -0,0 +1,105 @@
+from helpers import bundle_dict, create_state, trust_all
+
+from omemo.executor import CryptoExecutor
+
+ALICE = 'alice@example.com'
+BOB = 'bob@example.com'
+
+
+def immediate(callback, *args):
+    callback(*args)
+
+
+class Clock(object):
+    """ Advances one second every time it is read. """
+
+    def __init__(self):
+        self.time = 0
+
+    def __call__(self):
+        self.time += 1
+        return self.time
+
+
+def connected():
+    alice, bob = create_state(ALICE), create_state(BOB)
+    alice.set_own_devices([alice.own_device_id])
+    alice.build_session(BOB, bob.own_device_id, bundle_dict(bob))
+    alice.set_devices(BOB, [bob.own_device_id])
+    trust_all(alice, BOB)
+    return alice, bob
+
+
+def run_all(executor):
+    thread = executor.thread
+    executor.stop()
+    assert executor.thread is None
+    thread.join(10)
+    assert not thread.is_alive()
+
+
+def test_operations_run_in_submit_order():
+    alice, bob = connected()
+    sender = CryptoExecutor(alice, immediate)
+    receiver = CryptoExecutor(bob, immediate)
+    received = []
+
+    def send(msg_dict):
+        receiver.submit('decrypt_msg', received.append,
+                        dict(msg_dict, sender_jid=ALICE))
+
+    for i in range(5):
+        sender.submit('create_msg', send, ALICE, BOB, b'msg %d' % i)
+    run_all(sender)
+    run_all(receiver)
+    assert received == ['msg %d' % i for i in range(5)]
+
+
+def test_results_are_delivered_through_idle_add():
+    alice, bob = connected()
+    idle = []
+    results = []
+    executor = CryptoExecutor(alice, lambda *args: idle.append(args))
+
+    executor.run('create_msg', results.append, (ALICE, BOB, b'Hello'), 0)
+    assert results == []
+    callback, args = idle[0][0], idle[0][1:]
+    assert callback(*args) is False
+    assert results[0]['keys'].keys() == [bob.own_device_id]
+
+
+def test_results_are_delivered_after_stop():
+    alice, bob = connected()
+    idle = []
+    results = []
+    executor = CryptoExecutor(alice, lambda *args: idle.append(args))
+
+    executor.submit('create_msg', results.append, ALICE, BOB, b'Hello')
+    run_all(executor)
+    callback, args = idle[0][0], idle[0][1:]
+    assert callback(*args) is False
+    assert results[0]['keys'].keys() == [bob.own_device_id]
+
+
+def test_failed_operation_yields_none():
+    alice, bob = connected()
+    results = []
+    executor = CryptoExecutor(alice, immediate)
+
+    executor.run('build_session', results.append, (BOB, 2, None), 0)
+    assert results == [None]
+    assert executor.stats()['operations']['build_session']['failed'] == 1
+
+
+def test_stats_record_latency_per_operation():
+    alice, bob = connected()
+    executor = CryptoExecutor(alice, immediate, now=Clock())
+
+    submitted = executor.now()
+    executor.run('create_msg', lambda result: None,
+                 (ALICE, BOB, b'Hello'), submitted)
+    stats = executor.stats()
+    assert stats['queued'] == 0
+    assert stats['operations'] == {'create_msg': {
+        'count': 1, 'failed': 0,
+        'latency_avg': 2, 'latency_max': 2, 'run_avg': 1}}
@@ -0,0 +1,86 @@
+import os
+import sqlite3
+
+import pytest
+
+from helpers import FakePlugin, bundle_dict, create_state
+from omemo.db_helpers import tune_connection
+from omemo.maintenance import DatabaseMaintenance
+from omemo.state import OmemoState
+
+ALICE = 'alice@example.com'
+BOB = 'bob@example.com'
+
+
+class IdleLoop(object):
+    """ Runs idle callbacks until they return False. """
+
+    def __init__(self):
+        self.idle = []
+        self.calls = 0
+
+    def idle_add(self, callback):
+        self.idle.append(callback)
+        return len(self.idle)
+
+    def run(self):
+        while self.idle:
+            callback = self.idle.pop(0)
+            self.calls += 1
+            if callback():
+                self.idle.append(callback)
+
+
+@pytest.fixture
+def alice(tmpdir):
+    conn = sqlite3.connect(os.path.join(str(tmpdir), 'alice.db'),
+                           check_same_thread=False)
+    tune_connection(conn)
+    return OmemoState(ALICE, conn, ALICE, FakePlugin())
+
+
+def test_new_db_uses_incremental_vacuum(alice):
+    db = alice.store.sessionStore.dbConn
+    assert db.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+
+def test_run_skips_vacuum_without_incremental_auto_vacuum(tmpdir):
+    conn = sqlite3.connect(os.path.join(str(tmpdir), 'old.db'),
+                           check_same_thread=False)
+    conn.execute('CREATE TABLE old (id INTEGER)')
+    tune_connection(conn)
+    state = OmemoState(ALICE, conn, ALICE, FakePlugin())
+    loop = IdleLoop()
+
+    DatabaseMaintenance(state, None, None, loop.idle_add).run()
+    assert loop.idle == []
+    assert conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 0
+
+
+def test_run_archives_and_reclaims_space(alice):
+    loop = IdleLoop()
+    maintenance = DatabaseMaintenance(alice, None, None, loop.idle_add,
+                                      now=lambda: 2 ** 31, vacuum_step=10)
+    maintenance.run()
+    loop.run()
+
+    bundle = bundle_dict(create_state(BOB))
+    for device_id in range(1, 201):
+        alice.build_session(BOB, device_id, bundle)
+    alice.set_devices(BOB, [1])
+    alice.store.sessionStore.setActiveState([1], BOB)
+
+    loop.calls = 0
+    maintenance.run()
+    loop.run()
+    assert loop.calls > 1
+
+    db = alice.store.sessionStore.dbConn
+    assert db.execute('PRAGMA freelist_count').fetchone()[0] == 0
+    stats = maintenance.stats()
+    assert stats['runs'] == 2
+    assert stats['archived'] == 199
+    assert stats['reclaimed'] > 0
+    assert alice.store.getActiveDeviceTuples() == [(BOB, 1)]
+    assert alice.store.containsSession(BOB, 200)
+
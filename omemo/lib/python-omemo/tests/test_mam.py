@@ -0,0 +1,68 @@
+from helpers import bundle_dict, create_state, trust_all
+
+from omemo.mam import MamDecryptionPipeline
+
+ALICE = 'alice@example.com'
+BOB = 'bob@example.com'
+
+
+def archive(count, senders=2):
+    """ Return alices state and count messages sent to her by senders of
+        bobs devices, in the order they were sent.
+    """
+    alice = create_state(ALICE)
+    bobs = [create_state(BOB) for _ in range(senders)]
+    messages = []
+    for i, bob in enumerate(bobs):
+        bob.set_own_devices([bob.own_device_id])
+        bob.build_session(ALICE, alice.own_device_id, bundle_dict(alice, i))
+        bob.set_devices(ALICE, [alice.own_device_id])
+        trust_all(bob, ALICE)
+    for i in range(count):
+        msg = bobs[i % senders].create_msg(BOB, ALICE, b'msg %d' % i)
+        messages.append(dict(msg, sender_jid=BOB))
+    trust_all(alice, BOB)
+    return alice, messages
+
+
+def immediate(callback, *args):
+    callback(*args)
+
+
+def test_results_are_delivered_in_order_and_chunked():
+    alice, messages = archive(7)
+    chunks = []
+    pipeline = MamDecryptionPipeline(alice, chunks.append, immediate,
+                                     chunk_size=3)
+
+    pipeline.process([(msg, i) for i, msg in enumerate(messages)])
+    assert [len(chunk) for chunk in chunks] == [3, 3, 1]
+    results = [result for chunk in chunks for result in chunk]
+    assert results == [(i, 'msg %d' % i) for i in range(7)]
+    assert not alice.store.sessionStore.dirtySessions
+
+
+def test_broken_message_yields_none():
+    alice, messages = archive(2)
+    broken = dict(messages[1], keys={alice.own_device_id: b'garbage'})
+    chunks = []
+    pipeline = MamDecryptionPipeline(alice, chunks.append, immediate)
+
+    pipeline.process([(messages[0], 0), (broken, 1)])
+    assert chunks == [[(0, 'msg 0'), (1, None)]]
+    assert pipeline.decrypted == 1
+    assert pipeline.failed == 1
+
+
+def test_worker_thread_decrypts_queue():
+    alice, messages = archive(4)
+    chunks = []
+    pipeline = MamDecryptionPipeline(alice, chunks.append, immediate)
+    for i, msg in enumerate(messages):
+        pipeline.put(msg, i)
+    thread = pipeline.thread
+    pipeline.stop()
+    thread.join(10)
+
+    results = [result for chunk in chunks for result in chunk]
+    assert results == [(i, 'msg %d' % i) for i in range(4)]
@@ -0,0 +1,81 @@
+import pytest
+
+from helpers import FakeLoop
+from omemo.publish import PublishScheduler
+
+
+@pytest.fixture
+def loop():
+    return FakeLoop()
+
+
+@pytest.fixture
+def sent():
+    return []
+
+
+@pytest.fixture
+def forgotten():
+    return []
+
+
+@pytest.fixture
+def scheduler(loop, sent, forgotten):
+    def publish(account):
+        sent.append(account)
+        return 'iq%d' % len(sent)
+
+    return PublishScheduler(publish, loop.timeout_add, loop.source_remove,
+                            forget_query=forgotten.append)
+
+
+def test_requests_are_coalesced(loop, sent, scheduler):
+    for _ in range(20):
+        scheduler.request('alice')
+    scheduler.request('bob')
+    assert sent == []
+
+    loop.fire()
+    assert sorted(sent) == ['alice', 'bob']
+    assert scheduler.stats() == {'requested': 21, 'published': 2,
+                                 'suppressed': 19, 'timeouts': 0}
+
+
+def test_requests_in_flight_publish_once_after_result(loop, sent, scheduler):
+    scheduler.request('alice')
+    loop.fire()
+    for _ in range(5):
+        scheduler.request('alice')
+    assert sent == ['alice']
+
+    scheduler.finished('alice')
+    loop.fire()
+    assert sent == ['alice', 'alice']
+    assert scheduler.stats()['suppressed'] == 4
+
+
+def test_reset_drops_lost_publish(loop, sent, scheduler):
+    scheduler.request('alice')
+    loop.fire()
+    scheduler.request('alice')
+    scheduler.reset('alice')
+
+    scheduler.request('alice')
+    loop.fire()
+    assert sent == ['alice', 'alice']
+
+
+def test_lost_publish_times_out(loop, sent, forgotten, scheduler):
+    scheduler.request('alice')
+    loop.fire()
+    scheduler.request('alice')
+
+    # The timeout of the publish fires and schedules the pending one
+    loop.fire()
+    assert forgotten == ['iq1']
+    loop.fire()
+    assert sent == ['alice', 'alice']
+    assert scheduler.stats()['timeouts'] == 1
+
+    scheduler.finished('alice')
+    assert loop.sources == {}
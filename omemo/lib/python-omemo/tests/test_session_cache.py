@@ -0,0 +1,143 @@
+import sqlite3
+
+import pytest
+from axolotl.state.sessionrecord import SessionRecord
+
+from omemo.litesessionstore import LiteSessionStore
+from omemo.sql import SQLDatabase
+
+ROMEO = 'romeo@example.com'
+
+
+@pytest.fixture
+def db():
+    """ Open in memory sqlite db and create the omemo tables. """
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    conn.text_factory = bytes
+    SQLDatabase(conn)
+    return conn
+
+
+@pytest.fixture
+def store(db):
+    return LiteSessionStore(db, cacheSize=2)
+
+
+def session_rows(db):
+    return db.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+
+def test_store_is_written_on_flush(db, store):
+    store.storeSession(ROMEO, 1, SessionRecord())
+    store.storeSession(ROMEO, 2, SessionRecord())
+    assert session_rows(db) == 0
+    assert store.containsSession(ROMEO, 1)
+
+    assert store.flush() == 2
+    assert session_rows(db) == 2
+    assert store.flush() == 0
+
+
+def test_load_returns_cached_record(store):
+    record = SessionRecord()
+    store.storeSession(ROMEO, 1, record)
+    assert store.loadSession(ROMEO, 1) is record
+
+    store.flush()
+    assert store.loadSession(ROMEO, 1) is record
+
+
+def test_unknown_session_is_not_cached(store):
+    store.loadSession(ROMEO, 1)
+    assert not store.containsSession(ROMEO, 1)
+    assert len(store.sessionCache) == 0
+
+
+def test_eviction_writes_dirty_sessions(db, store):
+    for device_id in range(3):
+        store.storeSession(ROMEO, device_id, SessionRecord())
+
+    assert len(store.sessionCache) == 2
+    assert (ROMEO, 0) not in store.sessionCache
+    assert session_rows(db) == 3
+    assert store.containsSession(ROMEO, 0)
+
+
+def test_eviction_is_least_recently_used(store):
+    store.storeSession(ROMEO, 1, SessionRecord())
+    store.storeSession(ROMEO, 2, SessionRecord())
+    store.loadSession(ROMEO, 1)
+    store.storeSession(ROMEO, 3, SessionRecord())
+    assert list(store.sessionCache) == [(ROMEO, 1), (ROMEO, 3)]
+
+
+def test_invalidate_restores_flushed_state(db, store):
+    store.storeSession(ROMEO, 1, SessionRecord())
+    store.flush()
+    store.storeSession(ROMEO, 2, SessionRecord())
+
+    store.invalidateSession(ROMEO, 1)
+    store.invalidateSession(ROMEO, 2)
+    assert store.flush() == 0
+    assert store.containsSession(ROMEO, 1)
+    assert not store.containsSession(ROMEO, 2)
+
+
+def test_set_active_state_flushes_first(db, store):
+    store.storeSession(ROMEO, 1, SessionRecord())
+    store.storeSession(ROMEO, 2, SessionRecord())
+    store.setActiveState([1], ROMEO)
+    assert store.flush() == 0
+    assert store.getActiveDeviceTuples() == [(ROMEO, 1)]
+
+
+def test_identity_keys_are_read_from_column(db, store):
+    store.storeSession(ROMEO, 1, SessionRecord())
+    store.flush()
+    # A session without remote identity has no key
+    assert store.getAllActiveSessionsKeys() == []
+
+    db.execute("UPDATE sessions SET identity_key = ?", (b'key', ))
+    db.execute("INSERT INTO sessions (recipient_id, device_id, active, "
+               "identity_key) VALUES (?, 2, 0, ?)", (ROMEO, b'old'))
+    assert store.getActiveSessionsKeys(ROMEO) == [b'key']
+    assert store.getInactiveSessionsKeys(ROMEO) == [b'old']
+
+
+def test_inactive_sessions_are_archived_and_restored(db, store):
+    store.storeSession(ROMEO, 1, SessionRecord())
+    store.storeSession(ROMEO, 2, SessionRecord())
+    store.setActiveState([1], ROMEO)
+    serialized = store.loadSession(ROMEO, 2).serialize()
+
+    assert store.archiveSessions(0) == 0
+    assert store.archiveSessions(2 ** 31) == 1
+    assert session_rows(db) == 1
+    assert store.containsSession(ROMEO, 2)
+    db.execute("UPDATE archived_sessions SET identity_key = 'key'")
+    assert store.getInactiveSessionsKeys(ROMEO) == ['key']
+
+    # Loading restores the session as inactive
+    assert store.loadSession(ROMEO, 2).serialize() == serialized
+    assert session_rows(db) == 2
+    assert store.getInactiveSessionsKeys(ROMEO) == ['key']
+
+    # A device list containing the device makes it active again
+    store.archiveSessions(2 ** 31)
+    store.setActiveState([1, 2], ROMEO)
+    assert sorted(store.getActiveDeviceTuples()) == [(ROMEO, 1), (ROMEO, 2)]
+    assert db.execute('SELECT COUNT(*) FROM archived_sessions').fetchone() \
+        == (0, )
+
+
+def test_removed_archived_session_is_skipped(db, store):
+    store.storeSession(ROMEO, 1, SessionRecord())
+    store.storeSession(ROMEO, 2, SessionRecord())
+    store.setActiveState([1], ROMEO)
+    store.archiveSessions(2 ** 31)
+    assert store.containsSession(ROMEO, 2)
+
+    db.execute('DELETE FROM archived_sessions')
+    store.setActiveState([1, 2], ROMEO)
+    assert store.getActiveDeviceTuples() == [(ROMEO, 1)]
+    assert not store.containsSession(ROMEO, 2)
@@ -0,0 +1,102 @@
+import sqlite3
+
+import pytest
+
+from helpers import bundle_dict, create_state
+from omemo.db_helpers import user_version
+from omemo.sql import SQLDatabase
+
+INDEXES = set(['sessions_identity_index', 'identities_trust_index'])
+
+
+@pytest.fixture
+def db():
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    conn.text_factory = bytes
+    return conn
+
+
+def create_v5(db):
+    """ Create the tables changed by later migrations like version 5 did """
+    db.executescript("""
+        CREATE TABLE identities (
+            _id INTEGER PRIMARY KEY AUTOINCREMENT, recipient_id TEXT,
+            registration_id INTEGER, public_key BLOB, private_key BLOB,
+            next_prekey_id INTEGER, timestamp INTEGER, trust INTEGER,
+            shown INTEGER DEFAULT 0);
+        CREATE TABLE sessions (
+            _id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recipient_id TEXT, device_id INTEGER,
+            record BLOB, timestamp INTEGER, active INTEGER DEFAULT 1,
+            UNIQUE(recipient_id, device_id));
+        PRAGMA user_version=5;
+    """)
+
+
+def indexes(db):
+    q = "SELECT name FROM sqlite_master WHERE type = 'index'"
+    return set(row[0] for row in db.execute(q))
+
+
+def test_fresh_install_has_indexes(db):
+    SQLDatabase(db)
+    assert user_version(db) == 9
+    assert INDEXES <= indexes(db)
+
+
+def test_migrate_adds_indexes(db):
+    create_v5(db)
+
+    SQLDatabase(db)
+    assert user_version(db) == 9
+    assert INDEXES <= indexes(db)
+    assert 'sessions_active_index' not in indexes(db)
+    assert db.execute("SELECT * FROM bundle_failures").fetchall() == []
+    assert db.execute("SELECT * FROM archived_sessions").fetchall() == []
+
+
+def test_migrate_starts_aging_inactive_sessions(db):
+    create_v5(db)
+    db.execute("INSERT INTO sessions (recipient_id, device_id, active) "
+               "VALUES ('bob@x.org', 1, 1), ('bob@x.org', 2, 0)")
+    db.commit()
+
+    SQLDatabase(db)
+    rows = db.execute("SELECT device_id, inactive_since IS NOT NULL "
+                      "FROM sessions ORDER BY device_id").fetchall()
+    assert rows == [(1, 0), (2, 1)]
+
+
+def test_migrate_backfills_identity_key(db):
+    alice, bob = create_state('alice@example.com'), create_state('bob@x.org')
+    alice.build_session('bob@x.org', bob.own_device_id, bundle_dict(bob))
+    record = alice.store.loadSession('bob@x.org', bob.own_device_id)
+
+    create_v5(db)
+    db.execute("INSERT INTO sessions (recipient_id, device_id, record) "
+               "VALUES (?, ?, ?)", ('bob@x.org', 1, record.serialize()))
+    db.commit()
+
+    SQLDatabase(db)
+    identity_key = db.execute("SELECT identity_key FROM sessions").fetchone()
+    assert bytes(identity_key[0]) == \
+        bob.store.getIdentityKeyPair().getPublicKey().serialize()
+
+
+def test_backfill_and_flush_write_the_same_type(db):
+    alice, bob = create_state('alice@example.com'), create_state('bob@x.org')
+    alice.build_session('bob@x.org', bob.own_device_id, bundle_dict(bob))
+    record = alice.store.loadSession('bob@x.org', bob.own_device_id)
+
+    create_v5(db)
+    db.execute("INSERT INTO sessions (recipient_id, device_id, record) "
+               "VALUES (?, ?, ?)", ('bob@x.org', 1, record.serialize()))
+    db.commit()
+    SQLDatabase(db)
+
+    alice.store.sessionStore.flush()
+    migrated = db.execute("SELECT typeof(identity_key) FROM sessions") \
+        .fetchone()
+    flushed = alice.store.sessionStore.dbConn.execute(
+        "SELECT typeof(identity_key) FROM sessions").fetchone()
+    assert migrated == flushed == ('blob', )
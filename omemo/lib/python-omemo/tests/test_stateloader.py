@@ -0,0 +1,112 @@
+import threading
+
+from helpers import create_state
+from omemo.stateloader import StateLoader
+
+ALICE = 'alice@example.com'
+
+
+class Idle(object):
+    """ Collects idle callbacks, run() calls them like the main loop. """
+
+    def __init__(self):
+        self.callbacks = []
+
+    def idle_add(self, callback, *args):
+        self.callbacks.append((callback, args))
+
+    def run(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback, args in callbacks:
+            callback(*args)
+
+
+def load(loader, idle, account):
+    loader.threads[account].join(10)
+    idle.run()
+
+
+def test_state_is_created_in_worker():
+    threads = []
+
+    def create(account, jid):
+        threads.append(threading.current_thread())
+        return create_state(jid, account)
+
+    idle, states = Idle(), {}
+    loader = StateLoader(create, idle.idle_add, states)
+    assert loader.start('alice', ALICE)
+    assert not loader.start('alice', ALICE)
+    load(loader, idle, 'alice')
+
+    assert threads[0] is not threading.current_thread()
+    assert states['alice'].own_jid == ALICE
+    assert loader.get('alice') is states['alice']
+    assert not loader.start('alice', ALICE)
+
+
+def test_queued_callbacks_run_in_order_once_ready():
+    idle, called = Idle(), []
+    loader = StateLoader(lambda account: create_state(ALICE, account),
+                         idle.idle_add, {})
+    loader.start('alice')
+    loader.when_ready('alice', called.append, 1)
+    loader.when_ready('alice', called.append, 2)
+    loader.threads['alice'].join(10)
+    # Nothing runs before the main loop got the state
+    assert called == []
+
+    idle.run()
+    loader.when_ready('alice', called.append, 3)
+    assert called == [1, 2, 3]
+    assert loader.stats()['queued'] == 2
+
+
+def test_failing_callback_does_not_stop_the_replay():
+    idle, called = Idle(), []
+
+    def broken(value):
+        raise ValueError(value)
+
+    loader = StateLoader(lambda account: create_state(ALICE, account),
+                         idle.idle_add, {})
+    loader.start('alice')
+    loader.when_ready('alice', called.append, 1)
+    loader.when_ready('alice', broken, 2)
+    loader.when_ready('alice', called.append, 3)
+    load(loader, idle, 'alice')
+    assert called == [1, 3]
+
+
+def test_failed_creation_can_be_retried():
+    attempts = []
+
+    def create(account):
+        attempts.append(account)
+        if len(attempts) == 1:
+            raise ValueError('broken db')
+        return create_state(ALICE, account)
+
+    idle, called = Idle(), []
+    loader = StateLoader(create, idle.idle_add, {})
+    loader.start('alice')
+    loader.when_ready('alice', called.append, 1)
+    load(loader, idle, 'alice')
+    assert called == []
+    assert loader.get('alice') is None
+
+    assert loader.start('alice')
+    load(loader, idle, 'alice')
+    assert called == [1]
+
+
+def test_timings_are_recorded_per_account():
+    idle = Idle()
+    loader = StateLoader(lambda account: create_state(ALICE, account),
+                         idle.idle_add, {})
+    loader.start('alice')
+    load(loader, idle, 'alice')
+
+    timings = loader.stats()['timings']['alice']
+    assert set(timings) == set(['store', 'trust_cache', 'devices', 'total'])
+    assert timings['total'] >= timings['store']
@@ -0,0 +1,73 @@
+import sqlite3
+
+import pytest
+from axolotl.util.keyhelper import KeyHelper
+
+from omemo.liteidentitykeystore import LiteIdentityKeyStore
+from omemo.sql import SQLDatabase
+
+ROMEO = u'romeo@example.com'
+UNTRUSTED, TRUSTED, UNDECIDED = 0, 1, 2
+
+
+@pytest.fixture
+def db():
+    """ Open in memory sqlite db and create the omemo tables. """
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    conn.text_factory = bytes
+    SQLDatabase(conn)
+    return conn
+
+
+@pytest.fixture
+def store(db):
+    return LiteIdentityKeyStore(db)
+
+
+def identity_key():
+    return KeyHelper.generateIdentityKeyPair().getPublicKey()
+
+
+def test_trust_is_loaded_once_per_recipient(store):
+    key = identity_key()
+    store.saveIdentity(ROMEO, key)
+    assert store.isTrustedIdentity(ROMEO, key) == UNDECIDED
+    assert store.isTrustedIdentity(ROMEO, identity_key()) is True
+
+    stats = store.trustCacheStats()
+    assert stats['misses'] == 1
+    assert stats['recipients'] == 1
+
+
+def test_set_trust_updates_cache(store):
+    key = identity_key()
+    store.saveIdentity(ROMEO, key)
+    _id = store.getFingerprints(ROMEO)[0][0]
+
+    store.setTrust(_id, TRUSTED)
+    assert store.isTrustedIdentity(ROMEO, key) == TRUSTED
+    assert store.getTrustedFingerprints(ROMEO) == \
+        [key.getPublicKey().serialize()]
+    assert store.getUndecidedFingerprints(ROMEO) == []
+
+    store.setTrust(_id, UNTRUSTED)
+    assert store.isTrustedIdentity(ROMEO, key) == UNTRUSTED
+
+
+def test_cache_matches_db_after_warm_up(db, store):
+    keys = [identity_key() for _ in range(3)]
+    for key in keys:
+        store.saveIdentity(ROMEO, key)
+    store.setTrust(store.getFingerprints(ROMEO)[0][0], TRUSTED)
+
+    fresh = LiteIdentityKeyStore(db)
+    fresh.warmTrustCache()
+    assert fresh.getTrustStates(ROMEO) == store.getTrustStates(ROMEO)
+    assert fresh.trustCacheStats()['misses'] == 0
+
+
+def test_bytes_recipient_shares_cache_entry(store):
+    key = identity_key()
+    store.saveIdentity(ROMEO, key)
+    assert store.getIdentity(ROMEO.encode('utf-8'), key)
+    assert store.trustCacheStats()['recipients'] == 1
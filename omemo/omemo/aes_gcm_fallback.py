@@ -32,32 +32,73 @@
 from struct import pack, unpack
 
 from Crypto.Cipher import AES
-from Crypto.Util import strxor
+from Crypto.Util import Counter, strxor
 
+MASK64 = (1 << 64) - 1
+# x^128 + x^7 + x^2 + x + 1 in GCMs bit order, where the most significant
+# bit of the 128 bit integer is the coefficient of x^0
+POLY = 0xe1 << 120
 
-def gcm_rightshift(vec):
-    for x in range(15, 0, -1):
-        c = vec[x] >> 1
-        c |= (vec[x - 1] << 7) & 0x80
-        vec[x] = c
-    vec[0] >>= 1
-    return vec
 
+def _times_x(v):
+    """ Multiply the field element v by x. """
+    if v & 1:
+        return (v >> 1) ^ POLY
+    return v >> 1
 
-def gcm_gf_mult(a, b):
-    mask = [0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01]
-    poly = [0x00, 0xe1]
 
-    Z = [0] * 16
-    V = [c for c in a]
+def _reduction_table():
+    """ REDUCE[b] is the reduction of the low byte b after shifting it
+        out of an element by 8 bits.
+    """
+    table = []
+    for b in range(256):
+        v = b
+        for _ in range(8):
+            v = _times_x(v)
+        table.append(v)
+    return table
 
-    for x in range(128):
-        if b[x >> 3] & mask[x & 7]:
-            Z = [V[y] ^ Z[y] for y in range(16)]
-        bit = V[15] & 1
-        V = gcm_rightshift(V)
-        V[0] ^= poly[bit]
-    return Z
+REDUCE = _reduction_table()
+
+
+def gcm_key_table(h):
+    """ Precompute the 8 bit Shoup table for the hash key h.
+
+        table[b] is the product of h and the byte b, placed in the first
+        byte of a block.
+    """
+    h_int = bytes_to_int(h)
+    table = [0] * 256
+    # The most significant bit of a byte is the lowest power of x
+    bit = 0x80
+    while bit:
+        table[bit] = h_int
+        h_int = _times_x(h_int)
+        bit >>= 1
+    for b in range(1, 256):
+        low = b & -b
+        if low != b:
+            table[b] = table[low] ^ table[b ^ low]
+    return table
+
+
+def gcm_gf_mult(x, table):
+    """ Multiply the field element x with the hash key of table. """
+    z = 0
+    # Horner's method over the bytes of x, starting with the last one
+    for shift in range(0, 128, 8):
+        z = (z >> 8) ^ REDUCE[z & 0xff] ^ table[(x >> shift) & 0xff]
+    return z
+
+
+def bytes_to_int(block):
+    high, low = unpack('>QQ', block)
+    return (high << 64) | low
+
+
+def int_to_bytes(v):
+    return pack('>QQ', v >> 64, v & MASK64)
 
 
 def ghash(h, auth_data, data):
@@ -67,21 +108,19 @@ def ghash(h, auth_data, data):
     x = auth_data + chr(0) * v + data + chr(0) * u
     x += pack('>QQ', len(auth_data) * 8, len(data) * 8)
 
-    y = [0] * 16
-    vec_h = [ord(c) for c in h]
+    table = gcm_key_table(h)
+    words = unpack('>%dQ' % (len(x) // 8), x)
 
-    for i in range(0, len(x), 16):
-        block = [ord(c) for c in x[i:i + 16]]
-        y = [y[j] ^ block[j] for j in range(16)]
-        y = gcm_gf_mult(y, vec_h)
+    y = 0
+    for i in range(0, len(words), 2):
+        y = gcm_gf_mult(y ^ (words[i] << 64) ^ words[i + 1], table)
 
-    return ''.join(chr(c) for c in y)
+    return int_to_bytes(y)
 
 
 def inc32(block):
     counter, = unpack('>L', block[12:])
-    counter += 1
-    return block[:12] + pack('>L', counter)
+    return block[:12] + pack('>L', (counter + 1) & 0xffffffff)
 
 
 def gctr(k, icb, plaintext):
@@ -89,6 +128,13 @@ def gctr(k, icb, plaintext):
     if len(plaintext) == 0:
         return y
 
+    counter, = unpack('>L', icb[12:])
+    blocks = (len(plaintext) + AES.block_size - 1) // AES.block_size
+    if counter + blocks < 1 << 32:
+        # The 32 bit counter does not wrap, so CTR mode computes the same
+        ctr = Counter.new(32, prefix=icb[:12], initial_value=counter + 1)
+        return AES.new(k, AES.MODE_CTR, counter=ctr).encrypt(plaintext)
+
     aes = AES.new(k)
     cb = icb
 
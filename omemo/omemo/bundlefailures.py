@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Gajim-OMEMO plugin.
+#
+# The Gajim-OMEMO plugin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gajim-OMEMO is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import threading
+
+from .db_helpers import jid_key, synchronized
+
+
+class BundleFailureStore():
+    """ Remembers when fetching the bundle of a device failed for good.
+
+        The table is read into memory on first use.
+    """
+
+    def __init__(self, dbConn, lock=None):
+        """
+        :type dbConn: Connection
+        :param lock: RLock shared by all stores of the connection
+        """
+        self.dbConn = dbConn
+        self.lock = lock if lock is not None else threading.RLock()
+        # (jid, device_id) => failed_at, None until the table was loaded
+        self.failures = None
+
+    def _load(self):
+        q = 'SELECT recipient_id, device_id, failed_at FROM bundle_failures'
+        c = self.dbConn.cursor()
+        self.failures = dict(((jid_key(jid), device_id), failed_at)
+                             for jid, device_id, failed_at in c.execute(q))
+
+    @synchronized
+    def get(self, jid, device_id):
+        """ Return the time fetching the bundle failed, or None. """
+        if self.failures is None:
+            self._load()
+        return self.failures.get((jid_key(jid), device_id))
+
+    @synchronized
+    def add(self, jid, device_id, failed_at):
+        q = """INSERT OR REPLACE INTO bundle_failures
+               (recipient_id, device_id, failed_at) VALUES (?, ?, ?)"""
+
+        c = self.dbConn.cursor()
+        c.execute(q, (jid, device_id, int(failed_at)))
+        self.dbConn.commit()
+        if self.failures is not None:
+            self.failures[(jid_key(jid), device_id)] = int(failed_at)
+
+    @synchronized
+    def remove(self, jid, device_id):
+        q = """DELETE FROM bundle_failures
+               WHERE recipient_id = ? AND device_id = ?"""
+
+        c = self.dbConn.cursor()
+        c.execute(q, (jid, device_id))
+        self.dbConn.commit()
+        if self.failures is not None:
+            self.failures.pop((jid_key(jid), device_id), None)
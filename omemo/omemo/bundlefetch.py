@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Gajim-OMEMO plugin.
+#
+# The Gajim-OMEMO plugin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gajim-OMEMO is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import time
+from collections import deque
+
+log = logging.getLogger('gajim.plugin_system.omemo')
+
+# Bundle queries an account has on the wire at the same time
+DEFAULT_MAX_IN_FLIGHT = 8
+# Seconds until an unanswered query counts as failed
+DEFAULT_TIMEOUT = 30
+# Attempts per device before giving up
+DEFAULT_MAX_ATTEMPTS = 3
+# Seconds to wait before the first retry, doubled on every further retry
+DEFAULT_BACKOFF = 5
+# Seconds a device we gave up on is not queried again
+FAILED_EXPIRY = 3600
+# Seconds a device we gave up on is not prefetched again
+PREFETCH_FAILED_EXPIRY = 7 * 86400
+# Bundles the prefetch hands to the fetcher per interval
+DEFAULT_PREFETCH_RATE = 2
+# Milliseconds between two prefetch rounds
+DEFAULT_PREFETCH_INTERVAL = 1000
+
+
+class BundleFetcher(object):
+    """ Fetches the bundles of one account.
+
+        Queries are deduplicated by (jid, device_id) and at most
+        max_in_flight of them are sent at the same time, the rest waits in a
+        queue. Unanswered queries time out, failed ones are retried with
+        exponential backoff. A device whose bundle was fetched is not
+        queried again until forget() or reset() is called, even if
+        building its session failed.
+
+        The fetcher does not send anything itself, send_query builds and
+        sends the iq and returns its id. forget_query is called with the id
+        of a timed out query, so its result callback can be dropped.
+        gave_up, if given, is called with (jid, device_id) when a device
+        failed max_attempts times.
+    """
+
+    def __init__(self, send_query, forget_query, timeout_add, source_remove,
+                 now=time.time, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 timeout=DEFAULT_TIMEOUT, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 backoff=DEFAULT_BACKOFF, gave_up=None):
+        self.send_query = send_query
+        self.forget_query = forget_query
+        self.timeout_add = timeout_add
+        self.source_remove = source_remove
+        self.now = now
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.gave_up = gave_up
+
+        self.queue = deque()
+        # (jid, device_id) => attempts made so far
+        self.attempts = {}
+        # (jid, device_id) => (iq_id, time the query was sent)
+        self.in_flight = {}
+        # (jid, device_id) => source id of the retry timeout
+        self.retries = {}
+        # (jid, device_id) => time we gave up
+        self.failed = {}
+        # (jid, device_id) of the bundles fetched since the last reset
+        self.done = set()
+        self.timeout_id = None
+
+        self.fetched = 0
+        self.timeouts = 0
+        self.latencies = deque(maxlen=100)
+
+    def fetch(self, jid, device_id):
+        """ Queue a bundle query for the device, unless one is pending.
+
+            Returns
+            -------
+            bool
+                True if a new query was queued
+        """
+        key = (jid, device_id)
+        if key in self.attempts or key in self.done:
+            return False
+        gave_up = self.failed.get(key)
+        if gave_up is not None:
+            if self.now() - gave_up < FAILED_EXPIRY:
+                return False
+            del self.failed[key]
+
+        self.attempts[key] = 0
+        self.queue.append(key)
+        self._send_queued()
+        return True
+
+    def result(self, jid, device_id, success):
+        """ Called with the result of a bundle query. """
+        key = (jid, device_id)
+        if key not in self.in_flight:
+            return
+        _, sent = self.in_flight.pop(key)
+        self.latencies.append(self.now() - sent)
+        if success:
+            self.fetched += 1
+            del self.attempts[key]
+            self.done.add(key)
+        else:
+            self._failed(key)
+        self._send_queued()
+
+    def forget(self, jid):
+        """ Allow querying all devices of jid again, e.g. after a new device
+            list was received.
+        """
+        for key in list(self.failed):
+            if key[0] == jid:
+                del self.failed[key]
+        self.done = set(key for key in self.done if key[0] != jid)
+
+    def reset(self):
+        """ Drop all pending queries and fetched devices, e.g. after a
+            reconnect.
+        """
+        for iq_id, _ in self.in_flight.values():
+            self.forget_query(iq_id)
+        for source_id in self.retries.values():
+            self.source_remove(source_id)
+        if self.timeout_id is not None:
+            self.source_remove(self.timeout_id)
+            self.timeout_id = None
+        self.queue.clear()
+        self.attempts.clear()
+        self.in_flight.clear()
+        self.retries.clear()
+        self.done.clear()
+
+    def stats(self):
+        latencies = list(self.latencies)
+        return {
+            'fetched': self.fetched,
+            'failed': len(self.failed),
+            'timeouts': self.timeouts,
+            'in_flight': len(self.in_flight),
+            'queued': len(self.queue),
+            'latency_avg':
+            sum(latencies) / len(latencies) if latencies else None,
+            'latency_max': max(latencies) if latencies else None,
+        }
+
+    def _send_queued(self):
+        while self.queue and len(self.in_flight) < self.max_in_flight:
+            key = self.queue.popleft()
+            self.attempts[key] += 1
+            iq_id = self.send_query(*key)
+            self.in_flight[key] = (iq_id, self.now())
+
+        if self.in_flight and self.timeout_id is None:
+            self.timeout_id = self.timeout_add(1000, self._check_timeouts)
+
+    def _failed(self, key):
+        attempts = self.attempts[key]
+        if attempts >= self.max_attempts:
+            log.warn('Giving up fetching bundle of device ' +
+                     str(key[1]) + '#' + key[0])
+            del self.attempts[key]
+            self.failed[key] = self.now()
+            if self.gave_up is not None:
+                self.gave_up(*key)
+            return
+        delay = self.backoff * 2 ** (attempts - 1)
+        self.retries[key] = self.timeout_add(int(delay * 1000),
+                                             self._retry, key)
+
+    def _retry(self, key):
+        del self.retries[key]
+        self.queue.append(key)
+        self._send_queued()
+        # Do not repeat the timeout
+        return False
+
+    def _check_timeouts(self):
+        now = self.now()
+        for key, (iq_id, sent) in list(self.in_flight.items()):
+            if now - sent >= self.timeout:
+                log.debug('Bundle query of device ' + str(key[1]) + '#' +
+                          key[0] + ' timed out')
+                del self.in_flight[key]
+                self.forget_query(iq_id)
+                self.timeouts += 1
+                self._failed(key)
+        self._send_queued()
+
+        if self.in_flight:
+            return True
+        self.timeout_id = None
+        return False
+
+
+class BundlePrefetcher(object):
+    """ Fetches the bundles of devices without sessions in the background,
+        so opening a chat does not wait for the network.
+
+        Devices are handed to the BundleFetcher at most rate per interval
+        and only while the fetcher has no queue and less than half of
+        max_in_flight queries on the wire, so fetches for an open chat
+        always go first. Devices whose bundle failed within
+        PREFETCH_FAILED_EXPIRY, according to the failure store, are
+        skipped.
+    """
+
+    def __init__(self, fetcher, failures, timeout_add, source_remove,
+                 now=time.time, rate=DEFAULT_PREFETCH_RATE,
+                 interval=DEFAULT_PREFETCH_INTERVAL):
+        """
+            Parameters
+            ----------
+            fetcher : BundleFetcher
+                The fetcher of the account
+            failures : BundleFailureStore
+                The failures of the account
+            timeout_add : callable
+                Called with (milliseconds, callback), returns a source id
+            source_remove : callable
+                Removes a source id returned by timeout_add
+            now : callable
+                Returns the current time in seconds
+            rate : int
+                Bundles handed to the fetcher per interval
+            interval : int
+                Milliseconds between two rounds
+        """
+        self.fetcher = fetcher
+        self.failures = failures
+        self.timeout_add = timeout_add
+        self.source_remove = source_remove
+        self.now = now
+        self.rate = rate
+        self.interval = interval
+        self.queue = deque()
+        self.queued = set()
+        self.timeout_id = None
+        self.prefetched = 0
+        self.skipped = 0
+
+    def add(self, jid, device_ids):
+        """ Queue the devices of jid for prefetching. """
+        for device_id in device_ids:
+            key = (jid, device_id)
+            if key in self.queued:
+                continue
+            failed_at = self.failures.get(jid, device_id)
+            if failed_at is not None:
+                if self.now() - failed_at < PREFETCH_FAILED_EXPIRY:
+                    self.skipped += 1
+                    continue
+                self.failures.remove(jid, device_id)
+            self.queued.add(key)
+            self.queue.append(key)
+
+        if self.queue and self.timeout_id is None:
+            self.timeout_id = self.timeout_add(self.interval, self._prefetch)
+
+    def reset(self):
+        """ Drop all queued devices. """
+        if self.timeout_id is not None:
+            self.source_remove(self.timeout_id)
+            self.timeout_id = None
+        self.queue.clear()
+        self.queued.clear()
+
+    def stats(self):
+        return {'prefetched': self.prefetched,
+                'skipped': self.skipped,
+                'queued': len(self.queue)}
+
+    def _prefetch(self):
+        fetcher = self.fetcher
+        limit = max(1, fetcher.max_in_flight // 2)
+        sent = 0
+        while self.queue and sent < self.rate and not fetcher.queue and \
+                len(fetcher.in_flight) < limit:
+            key = self.queue.popleft()
+            self.queued.discard(key)
+            if fetcher.fetch(*key):
+                sent += 1
+                self.prefetched += 1
+
+        if self.queue:
+            return True
+        log.debug('Bundle prefetch finished: ' + str(self.stats()))
+        self.timeout_id = None
+        return False
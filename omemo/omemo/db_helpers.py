@@ -1,5 +1,7 @@
 ''' Database helper functions '''
 
+from functools import wraps
+
 
 def table_exists(db, name):
     """ Check if the specified table exists in the db. """
@@ -13,3 +15,41 @@ def table_exists(db, name):
 def user_version(db):
     """ Return the value of PRAGMA user_version. """
     return db.execute('PRAGMA user_version').fetchone()[0]
+
+
+def jid_key(jid):
+    """ Return jid as unicode, for use as key of in-memory caches.
+
+        jids are returned as bytes because of the connections text_factory,
+        but the jids passed in are unicode.
+    """
+    if isinstance(jid, bytes):
+        return jid.decode('utf-8')
+    return jid
+
+
+def tune_connection(db, cache_kib=8192):
+    """ Switch the connection to WAL mode and set up the page cache.
+
+        With WAL, synchronous=NORMAL only syncs on checkpoints. A commit can
+        get lost on power failure but the db can not get corrupted.
+
+        A new db gets incremental auto_vacuum, so the DatabaseMaintenance
+        can give free pages back without a full VACUUM. It has to be set
+        before anything is written, existing dbs are not changed.
+    """
+    db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.execute('PRAGMA cache_size=-%d' % cache_kib)
+    db.execute('PRAGMA temp_store=MEMORY')
+
+
+def synchronized(method):
+    """ Decorator running method with the RLock in self.lock held. """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Gajim-OMEMO plugin.
+#
+# The Gajim-OMEMO plugin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gajim-OMEMO is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+
+log = logging.getLogger('gajim.plugin_system.omemo')
+
+# Milliseconds to gather device lists before they are saved
+DEFAULT_DEVICE_LIST_WINDOW = 1000
+
+
+class DeviceListBuffer(object):
+    """ Gathers the device lists of contacts per account.
+
+        After sign in the server pushes the device list of every contact
+        with OMEMO support. Instead of saving each list on its own, the
+        first list of an account starts a timer and all lists received until
+        it fires are handed to apply at once. A later list of the same
+        contact replaces the earlier one.
+
+        The buffer does not depend on gobject, the plugin passes in
+        gobject.timeout_add and gobject.source_remove.
+    """
+
+    def __init__(self, apply, timeout_add, source_remove,
+                 window=DEFAULT_DEVICE_LIST_WINDOW):
+        """
+            Parameters
+            ----------
+            apply : callable
+                Called with the account name and a dict jid => device list
+            timeout_add : callable
+                Called with (milliseconds, callback, account), returns a
+                source id
+            source_remove : callable
+                Removes a source id returned by timeout_add
+            window : int
+                Milliseconds to wait for more device lists
+        """
+        self.apply = apply
+        self.timeout_add = timeout_add
+        self.source_remove = source_remove
+        self.window = window
+        # account => {jid: device list}
+        self.pending = {}
+        self.timers = {}
+        self.received = 0
+        self.batches = 0
+
+    def add(self, account, jid, devices):
+        """ Buffer the device list of jid. """
+        self.received += 1
+        self.pending.setdefault(account, {})[jid] = devices
+        if account not in self.timers:
+            self.timers[account] = self.timeout_add(self.window, self._apply,
+                                                    account)
+
+    def flush(self, account):
+        """ Apply the buffered device lists of account now, e.g. before
+            they are needed to encrypt a message.
+        """
+        if account in self.timers:
+            self.source_remove(self.timers[account])
+            self._apply(account)
+
+    def cancel_all(self):
+        """ Drop all buffered device lists. """
+        for source_id in self.timers.values():
+            self.source_remove(source_id)
+        self.timers.clear()
+        self.pending.clear()
+
+    def stats(self):
+        return {'received': self.received, 'batches': self.batches}
+
+    def _apply(self, account):
+        del self.timers[account]
+        device_lists = self.pending.pop(account, {})
+        self.batches += 1
+        log.debug(account + ' => Applying ' + str(len(device_lists)) +
+                  ' buffered device lists')
+        self.apply(account, device_lists)
+        # Do not repeat the timeout
+        return False
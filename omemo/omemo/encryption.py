@@ -18,47 +18,100 @@
 # the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import threading
+
+from .db_helpers import jid_key, synchronized
+
 
 class EncryptionState():
-    """ Used to store if OMEMO is enabled or not between gajim restarts """
+    """ Used to store if OMEMO is enabled or not between gajim restarts
+
+        The whole encryption_state table is read into memory on first use,
+        so is_active() and exist() never query the db. activate() and
+        deactivate() write through.
+    """
 
-    def __init__(self, dbConn):
+    def __init__(self, dbConn, lock=None):
         """
         :type dbConn: Connection
+        :param lock: RLock shared by all stores of the connection
         """
         self.dbConn = dbConn
+        self.lock = lock if lock is not None else threading.RLock()
+        # jid => encryption, None until the table was loaded
+        self.states = None
+        self.queries = 0
+        self.lookups = 0
 
-    def activate(self, jid):
+    def _load(self):
+        q = 'SELECT jid, encryption FROM encryption_state'
+        c = self.dbConn.cursor()
+        self.queries += 1
+        self.states = dict((jid_key(jid), bool(encryption))
+                           for jid, encryption in c.execute(q))
+
+    def _set(self, jid, encryption):
         q = """INSERT OR REPLACE INTO encryption_state (jid, encryption)
-               VALUES (?, 1) """
+               VALUES (?, ?) """
 
         c = self.dbConn.cursor()
-        c.execute(q, (jid, ))
+        c.execute(q, (jid, int(encryption)))
         self.dbConn.commit()
+        self.queries += 1
+        if self.states is not None:
+            self.states[jid_key(jid)] = encryption
 
-    def deactivate(self, jid):
+    @synchronized
+    def activate(self, jid):
+        self._set(jid, True)
+
+    @synchronized
+    def activate_all(self, jids, commit=True):
+        """ Activate encryption for many jids with one statement.
+
+            Parameters
+            ----------
+            jids : iterable
+                The jids to activate
+            commit : bool
+                False to leave the transaction open for more changes of the
+                caller
+        """
+        jids = list(jids)
         q = """INSERT OR REPLACE INTO encryption_state (jid, encryption)
-               VALUES (?, 0)"""
+               VALUES (?, 1) """
 
         c = self.dbConn.cursor()
-        c.execute(q, (jid, ))
-        self.dbConn.commit()
+        c.executemany(q, [(jid, ) for jid in jids])
+        if commit:
+            self.dbConn.commit()
+        self.queries += 1
+        if self.states is not None:
+            for jid in jids:
+                self.states[jid_key(jid)] = True
+
+    @synchronized
+    def deactivate(self, jid):
+        self._set(jid, False)
 
+    def _lookup(self, jid):
+        if self.states is None:
+            self._load()
+        self.lookups += 1
+        return self.states.get(jid_key(jid))
+
+    @synchronized
     def is_active(self, jid):
-        q = 'SELECT encryption FROM encryption_state where jid = ?;'
-        c = self.dbConn.cursor()
-        c.execute(q, (jid, ))
-        result = c.fetchone()
-        if result is None:
-            return False
-        return result[0]
+        return bool(self._lookup(jid))
 
+    @synchronized
     def exist(self, jid):
-        q = 'SELECT encryption FROM encryption_state where jid = ?;'
-        c = self.dbConn.cursor()
-        c.execute(q, (jid, ))
-        result = c.fetchone()
-        if result is None:
-            return False
-        else:
-            return True
+        return self._lookup(jid) is not None
+
+    def stats(self):
+        """ Return how often the state was looked up and how many queries
+            ran, to check that the message path does not touch the db.
+        """
+        return {'lookups': self.lookups,
+                'queries': self.queries,
+                'jids': len(self.states or ())}
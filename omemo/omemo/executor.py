@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Gajim-OMEMO plugin.
+#
+# The Gajim-OMEMO plugin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gajim-OMEMO is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import threading
+import time
+from collections import deque
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+log = logging.getLogger('gajim.plugin_system.omemo')
+
+# Latencies kept per operation for the stats
+LATENCY_SAMPLES = 100
+
+_STOP = object()
+
+
+class CryptoExecutor(object):
+    """ Runs the crypto operations of one account in a worker thread.
+
+        Operations are OmemoState methods like decrypt_msg, create_msg and
+        build_session. They run one after the other in the order they were
+        submitted, so the messages of every peer stay in order. The result
+        of each operation is handed back through idle_add, the main loop
+        only waits for the state lock, never for the ratchet.
+    """
+
+    def __init__(self, state, idle_add, now=time.time):
+        """
+            Parameters
+            ----------
+            state : OmemoState
+                The state of the account
+            idle_add : callable
+                gobject.idle_add or a replacement
+            now : callable
+                Returns the current time in seconds
+        """
+        self.state = state
+        self.idle_add = idle_add
+        self.now = now
+        self.queue = Queue()
+        self.thread = None
+        self.max_queued = 0
+        # operation => counters and latencies, see stats()
+        self.operations = {}
+        self.stats_lock = threading.Lock()
+
+    def submit(self, operation, callback, *args):
+        """ Run an OmemoState method in the worker.
+
+            Parameters
+            ----------
+            operation : str
+                The name of the OmemoState method
+            callback : callable
+                Called in the main loop with the result, or with None if the
+                operation raised an exception
+            *args
+                Passed to the method
+        """
+        self.queue.put((operation, callback, args, self.now()))
+        self.max_queued = max(self.max_queued, self.queue.qsize())
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run,
+                                           name='omemo-crypto-' +
+                                           self.state.account)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """ Stop the worker after the queued operations ran. Their results
+            are still delivered, so no blocked event gets lost.
+        """
+        if self.thread is not None:
+            self.queue.put(_STOP)
+            self.thread = None
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is _STOP:
+                return
+            self.run(*job)
+
+    def run(self, operation, callback, args, submitted):
+        """ Run one operation and hand back its result. """
+        started = self.now()
+        failed = False
+        try:
+            result = getattr(self.state, operation)(*args)
+        except Exception:
+            log.exception(self.state.account + ' => ' + operation +
+                          ' failed')
+            result = None
+            failed = True
+        self._record(operation, submitted, started, failed)
+        self.idle_add(self._deliver, callback, result)
+
+    def stats(self):
+        """ Return the queue depth and the latencies per operation.
+
+            latency is the time from submit() until the result was ready,
+            run the time the operation itself took, both in seconds.
+        """
+        with self.stats_lock:
+            operations = {}
+            for operation, op in self.operations.items():
+                latencies = list(op['latencies'])
+                runs = list(op['runs'])
+                operations[operation] = {
+                    'count': op['count'],
+                    'failed': op['failed'],
+                    'latency_avg': sum(latencies) / len(latencies),
+                    'latency_max': max(latencies),
+                    'run_avg': sum(runs) / len(runs),
+                }
+        return {'queued': self.queue.qsize(),
+                'max_queued': self.max_queued,
+                'operations': operations}
+
+    def _record(self, operation, submitted, started, failed):
+        finished = self.now()
+        with self.stats_lock:
+            op = self.operations.setdefault(operation, {
+                'count': 0, 'failed': 0,
+                'latencies': deque(maxlen=LATENCY_SAMPLES),
+                'runs': deque(maxlen=LATENCY_SAMPLES)})
+            op['count'] += 1
+            op['failed'] += failed
+            op['latencies'].append(finished - submitted)
+            op['runs'].append(finished - started)
+
+    def _deliver(self, callback, result):
+        callback(result)
+        # Do not repeat the idle callback
+        return False
@@ -18,6 +18,7 @@
 #
 
 import logging
+import threading
 
 from axolotl.state.axolotlstore import AxolotlStore
 from axolotl.util.keyhelper import KeyHelper
@@ -26,6 +27,7 @@ from .liteidentitykeystore import LiteIdentityKeyStore
 from .liteprekeystore import LitePreKeyStore
 from .litesessionstore import LiteSessionStore
 from .litesignedprekeystore import LiteSignedPreKeyStore
+from .bundlefailures import BundleFailureStore
 from .encryption import EncryptionState
 from .sql import SQLDatabase
 
@@ -38,7 +40,13 @@ SPK_CYCLE_TIME = 86400         # 24 Hours
 
 
 class LiteAxolotlStore(AxolotlStore):
-    def __init__(self, connection):
+    def __init__(self, connection, lock=None):
+        """
+            :param connection: an :py:class:`sqlite3.Connection`
+            :param lock: RLock held by every access to the connection, so
+                         the connection can be used by several threads
+        """
+        self.lock = lock if lock is not None else threading.RLock()
         try:
             connection.text_factory = bytes
         except(AttributeError):
@@ -46,11 +54,15 @@ class LiteAxolotlStore(AxolotlStore):
                                  str(connection))
 
         self.sql = SQLDatabase(connection)
-        self.identityKeyStore = LiteIdentityKeyStore(connection)
-        self.preKeyStore = LitePreKeyStore(connection)
-        self.signedPreKeyStore = LiteSignedPreKeyStore(connection)
-        self.sessionStore = LiteSessionStore(connection)
-        self.encryptionStore = EncryptionState(connection)
+        self.identityKeyStore = LiteIdentityKeyStore(connection,
+                                                     lock=self.lock)
+        self.preKeyStore = LitePreKeyStore(connection, lock=self.lock)
+        self.signedPreKeyStore = LiteSignedPreKeyStore(connection,
+                                                       lock=self.lock)
+        self.sessionStore = LiteSessionStore(connection, lock=self.lock)
+        self.encryptionStore = EncryptionState(connection, lock=self.lock)
+        self.bundleFailureStore = BundleFailureStore(connection,
+                                                     lock=self.lock)
 
         if not self.getLocalRegistrationId():
             log.info("Generating Axolotl keys")
@@ -67,9 +79,7 @@ class LiteAxolotlStore(AxolotlStore):
             identityKeyPair, KeyHelper.getRandomSequence(65536))
 
         self.storeSignedPreKey(signedPreKey.getId(), signedPreKey)
-
-        for preKey in preKeys:
-            self.storePreKey(preKey.getId(), preKey)
+        self.preKeyStore.storePreKeys(preKeys)
 
     def getIdentityKeyPair(self):
         return self.identityKeyStore.getIdentityKeyPair()
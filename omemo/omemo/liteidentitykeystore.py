@@ -17,23 +17,40 @@
 # the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import threading
+
 from axolotl.ecc.djbec import DjbECPrivateKey, DjbECPublicKey
 from axolotl.identitykey import IdentityKey
 from axolotl.identitykeypair import IdentityKeyPair
 from axolotl.state.identitykeystore import IdentityKeyStore
 
+from .db_helpers import jid_key, synchronized
+
 UNDECIDED = 2
 TRUSTED = 1
 UNTRUSTED = 0
 
 
 class LiteIdentityKeyStore(IdentityKeyStore):
-    def __init__(self, dbConn):
+    """ Identity store with an in-process trust cache.
+
+        The trust of all identities of a recipient is loaded with one query
+        on first use and kept up to date by saveIdentity() and setTrust().
+    """
+
+    def __init__(self, dbConn, lock=None):
         """
         :type dbConn: Connection
+        :param lock: RLock shared by all stores of the connection
         """
         self.dbConn = dbConn
+        self.lock = lock if lock is not None else threading.RLock()
+        self.trustCache = {}
+        self.trustIds = {}
+        self.trustCacheHits = 0
+        self.trustCacheMisses = 0
 
+    @synchronized
     def getIdentityKeyPair(self):
         q = "SELECT public_key, private_key FROM identities " + \
             "WHERE recipient_id = -1"
@@ -46,6 +63,7 @@ class LiteIdentityKeyStore(IdentityKeyStore):
             IdentityKey(DjbECPublicKey(publicKey[1:])),
             DjbECPrivateKey(privateKey))
 
+    @synchronized
     def getLocalRegistrationId(self):
         q = "SELECT registration_id FROM identities WHERE recipient_id = -1"
         c = self.dbConn.cursor()
@@ -53,6 +71,7 @@ class LiteIdentityKeyStore(IdentityKeyStore):
         result = c.fetchone()
         return result[0] if result else None
 
+    @synchronized
     def storeLocalData(self, registrationId, identityKeyPair):
         q = "INSERT INTO identities( " + \
             "recipient_id, registration_id, public_key, private_key) " + \
@@ -65,42 +84,103 @@ class LiteIdentityKeyStore(IdentityKeyStore):
 
         self.dbConn.commit()
 
+    @synchronized
     def saveIdentity(self, recipientId, identityKey):
         q = "INSERT INTO identities (recipient_id, public_key, trust) " \
             "VALUES(?, ?, ?)"
         c = self.dbConn.cursor()
 
         if not self.getIdentity(recipientId, identityKey):
-            c.execute(q, (recipientId,
-                          identityKey.getPublicKey().serialize(),
-                          UNDECIDED))
+            public_key = identityKey.getPublicKey().serialize()
+            c.execute(q, (recipientId, public_key, UNDECIDED))
             self.dbConn.commit()
+            self._cacheIdentity(recipientId, public_key, c.lastrowid,
+                                UNDECIDED)
 
+    @synchronized
     def getIdentity(self, recipientId, identityKey):
-        q = "SELECT * FROM identities WHERE recipient_id = ? " \
-            "AND public_key = ?"
-        c = self.dbConn.cursor()
-
-        c.execute(q, (recipientId, identityKey.getPublicKey().serialize()))
-        result = c.fetchone()
-
-        return result is not None
+        public_key = identityKey.getPublicKey().serialize()
+        return public_key in self._loadTrust(recipientId)
 
+    @synchronized
     def isTrustedIdentity(self, recipientId, identityKey):
-        q = "SELECT trust FROM identities WHERE recipient_id = ? " \
-            "AND public_key = ?"
-        c = self.dbConn.cursor()
-
-        c.execute(q, (recipientId, identityKey.getPublicKey().serialize()))
-        result = c.fetchone()
+        public_key = identityKey.getPublicKey().serialize()
+        result = self._loadTrust(recipientId).get(public_key)
 
         states = [UNTRUSTED, TRUSTED, UNDECIDED]
 
-        if result and result[0] in states:
-            return result[0]
+        if result and result[1] in states:
+            return result[1]
         else:
             return True
 
+    @synchronized
+    def getTrustStates(self, recipientId):
+        """ Return the trust of all identities of recipientId.
+
+            Returns
+            -------
+            dict
+                Maps the serialized public key to the value
+                isTrustedIdentity() returns for it
+        """
+        states = [UNTRUSTED, TRUSTED, UNDECIDED]
+
+        result = {}
+        for public_key, (_, trust) in self._loadTrust(recipientId).items():
+            result[public_key] = trust if trust in states else True
+        return result
+
+    def _loadTrust(self, recipientId):
+        """ Return the identities of recipientId from the trust cache, load
+            them with one query on a cache miss.
+
+            Returns
+            -------
+            dict
+                Maps the serialized public key to a (_id, trust) tuple
+        """
+        recipientId = jid_key(recipientId)
+        identities = self.trustCache.get(recipientId)
+        if identities is not None:
+            self.trustCacheHits += 1
+            return identities
+
+        self.trustCacheMisses += 1
+        q = "SELECT _id, public_key, trust FROM identities " \
+            "WHERE recipient_id = ?"
+        c = self.dbConn.cursor()
+
+        identities = self.trustCache[recipientId] = {}
+        for _id, public_key, trust in c.execute(q, (recipientId, )):
+            self._cacheIdentity(recipientId, bytes(public_key), _id, trust)
+        return identities
+
+    def _cacheIdentity(self, recipientId, public_key, _id, trust):
+        recipientId = jid_key(recipientId)
+        if recipientId not in self.trustCache:
+            # Unknown recipients are loaded completely on first use
+            return
+        self.trustCache[recipientId][public_key] = (_id, trust)
+        self.trustIds[_id] = (recipientId, public_key)
+
+    @synchronized
+    def warmTrustCache(self):
+        """ Fill the trust cache for all recipients with one query. """
+        self.trustCache.clear()
+        self.trustIds.clear()
+        for _id, recipientId, public_key, trust in self.getAllFingerprints():
+            self.trustCache.setdefault(jid_key(recipientId), {})
+            self._cacheIdentity(recipientId, bytes(public_key), _id, trust)
+
+    def trustCacheStats(self):
+        """ Return counters to check how often trust decisions hit the db.
+        """
+        return {'hits': self.trustCacheHits,
+                'misses': self.trustCacheMisses,
+                'recipients': len(self.trustCache)}
+
+    @synchronized
     def getAllFingerprints(self):
         q = "SELECT _id, recipient_id, public_key, trust FROM identities " \
             "WHERE recipient_id != -1 ORDER BY recipient_id ASC"
@@ -111,6 +191,7 @@ class LiteIdentityKeyStore(IdentityKeyStore):
             result.append((row[0], row[1], row[2], row[3]))
         return result
 
+    @synchronized
     def getFingerprints(self, jid):
         q = "SELECT _id, recipient_id, public_key, trust FROM identities " \
             "WHERE recipient_id =? ORDER BY trust ASC"
@@ -123,27 +204,19 @@ class LiteIdentityKeyStore(IdentityKeyStore):
             result.append((row[0], row[1], row[2], row[3]))
         return result
 
+    @synchronized
     def getTrustedFingerprints(self, jid):
-        q = "SELECT public_key FROM identities WHERE recipient_id = ? AND trust = ?"
-        c = self.dbConn.cursor()
-
-        result = []
-        c.execute(q, (jid, TRUSTED))
-        rows = c.fetchall()
-        for row in rows:
-            result.append(row[0])
-        return result
+        return [public_key
+                for public_key, (_, trust) in self._loadTrust(jid).items()
+                if trust == TRUSTED]
 
+    @synchronized
     def getUndecidedFingerprints(self, jid):
-        q = "SELECT trust FROM identities WHERE recipient_id = ? AND trust = ?"
-        c = self.dbConn.cursor()
-
-        result = []
-        c.execute(q, (jid, UNDECIDED))
-        result = c.fetchall()
-
-        return result
+        return [(trust, )
+                for _, trust in self._loadTrust(jid).values()
+                if trust == UNDECIDED]
 
+    @synchronized
     def getNewFingerprints(self, jid):
         q = "SELECT _id FROM identities WHERE shown = 0 AND " \
             "recipient_id = ?"
@@ -153,6 +226,7 @@ class LiteIdentityKeyStore(IdentityKeyStore):
             result.append(row[0])
         return result
 
+    @synchronized
     def setShownFingerprints(self, fingerprints):
         q = "UPDATE identities SET shown = 1 WHERE _id IN ({})" \
             .format(', '.join(['?'] * len(fingerprints)))
@@ -160,8 +234,13 @@ class LiteIdentityKeyStore(IdentityKeyStore):
         c.execute(q, fingerprints)
         self.dbConn.commit()
 
+    @synchronized
     def setTrust(self, _id, trust):
         q = "UPDATE identities SET trust = ? WHERE _id = ?"
         c = self.dbConn.cursor()
         c.execute(q, (trust, _id))
         self.dbConn.commit()
+
+        if _id in self.trustIds:
+            recipientId, public_key = self.trustIds[_id]
+            self._cacheIdentity(recipientId, public_key, _id, trust)
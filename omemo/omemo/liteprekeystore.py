@@ -17,18 +17,29 @@
 # the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import threading
+
 from axolotl.state.prekeyrecord import PreKeyRecord
 from axolotl.state.prekeystore import PreKeyStore
 from axolotl.util.keyhelper import KeyHelper
 
+from .db_helpers import synchronized
+
 
 class LitePreKeyStore(PreKeyStore):
-    def __init__(self, dbConn):
+    def __init__(self, dbConn, lock=None):
         """
         :type dbConn: Connection
+        :param lock: RLock shared by all stores of the connection
         """
         self.dbConn = dbConn
+        self.lock = lock if lock is not None else threading.RLock()
+        # Serialized public keys by prekey id, loaded on first use
+        self.publicPreKeys = None
+        # Increased on every change, so the published bundle can be cached
+        self.version = 0
 
+    @synchronized
     def loadPreKey(self, preKeyId):
         q = "SELECT record FROM prekeys WHERE prekey_id = ?"
 
@@ -41,6 +52,7 @@ class LitePreKeyStore(PreKeyStore):
 
         return PreKeyRecord(serialized=result[0])
 
+    @synchronized
     def loadPendingPreKeys(self):
         q = "SELECT record FROM prekeys"
         cursor = self.dbConn.cursor()
@@ -49,39 +61,76 @@ class LitePreKeyStore(PreKeyStore):
 
         return [PreKeyRecord(serialized=r[0]) for r in result]
 
+    @synchronized
+    def getPublicPreKeys(self):
+        """ Return the public keys of all prekeys.
+
+            Returns
+            -------
+            dict
+                Maps the prekey id to the serialized public key
+        """
+        if self.publicPreKeys is None:
+            self.publicPreKeys = {}
+            for preKey in self.loadPendingPreKeys():
+                self._cachePublicKey(preKey)
+        return self.publicPreKeys
+
+    def _cachePublicKey(self, preKeyRecord):
+        self.version += 1
+        if self.publicPreKeys is not None:
+            self.publicPreKeys[preKeyRecord.getId()] = \
+                preKeyRecord.getKeyPair().getPublicKey().serialize()
+
+    @synchronized
     def storePreKey(self, preKeyId, preKeyRecord):
         q = "INSERT INTO prekeys (prekey_id, record) VALUES(?,?)"
         cursor = self.dbConn.cursor()
         cursor.execute(q, (preKeyId, preKeyRecord.serialize()))
         self.dbConn.commit()
+        self._cachePublicKey(preKeyRecord)
+
+    @synchronized
+    def storePreKeys(self, preKeyRecords):
+        """ Store many prekeys in one transaction. """
+        q = "INSERT INTO prekeys (prekey_id, record) VALUES(?,?)"
+        cursor = self.dbConn.cursor()
+        cursor.executemany(q, [(preKey.getId(), preKey.serialize())
+                               for preKey in preKeyRecords])
+        self.dbConn.commit()
+        for preKey in preKeyRecords:
+            self._cachePublicKey(preKey)
 
+    @synchronized
     def containsPreKey(self, preKeyId):
         q = "SELECT record FROM prekeys WHERE prekey_id = ?"
         cursor = self.dbConn.cursor()
         cursor.execute(q, (preKeyId, ))
         return cursor.fetchone() is not None
 
+    @synchronized
     def removePreKey(self, preKeyId):
         q = "DELETE FROM prekeys WHERE prekey_id = ?"
         cursor = self.dbConn.cursor()
         cursor.execute(q, (preKeyId, ))
         self.dbConn.commit()
+        self.version += 1
+        if self.publicPreKeys is not None:
+            self.publicPreKeys.pop(preKeyId, None)
 
+    @synchronized
     def getCurrentPreKeyId(self):
         q = "SELECT MAX(prekey_id) FROM prekeys"
         cursor = self.dbConn.cursor()
         cursor.execute(q)
         return cursor.fetchone()[0]
 
+    @synchronized
     def getPreKeyCount(self):
-        q = "SELECT COUNT(prekey_id) FROM prekeys"
-        cursor = self.dbConn.cursor()
-        cursor.execute(q)
-        return cursor.fetchone()[0]
+        return len(self.getPublicPreKeys())
 
+    @synchronized
     def generateNewPreKeys(self, count):
         startId = self.getCurrentPreKeyId() + 1
         preKeys = KeyHelper.generatePreKeys(startId, count)
-
-        for preKey in preKeys:
-            self.storePreKey(preKey.getId(), preKey)
+        self.storePreKeys(preKeys)
@@ -17,29 +17,136 @@
 # the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
 from axolotl.state.sessionrecord import SessionRecord
 from axolotl.state.sessionstore import SessionStore
 
+from .db_helpers import jid_key, synchronized
+from .sql import identity_key_column
+
+DEFAULT_CACHE_SIZE = 1000
+
 
 class LiteSessionStore(SessionStore):
-    def __init__(self, dbConn):
+    """ Session store with an in-memory write-back cache.
+
+        Deserialized SessionRecords are kept in a LRU cache keyed by
+        (recipient_id, device_id). storeSession() only marks a record dirty,
+        all dirty records are written in one transaction by flush(). The
+        owner of the store is responsible for calling flush() periodically
+        and on shutdown.
+
+        The cache is guarded by a lock, so the store can be flushed while
+        another thread decrypts messages.
+
+        Sessions which are inactive for long are moved zlib compressed to
+        the archived_sessions table by archiveSessions(). They are restored
+        transparently when they are loaded or become active again.
+    """
+
+    def __init__(self, dbConn, cacheSize=DEFAULT_CACHE_SIZE, lock=None):
         """
         :type dbConn: Connection
+        :type cacheSize: int
+        :param lock: RLock shared by all stores of the connection
         """
         self.dbConn = dbConn
+        self.cacheSize = cacheSize
+        self.sessionCache = OrderedDict()
+        self.dirtySessions = set()
+        self.lock = lock if lock is not None else threading.RLock()
+        # (recipient_id, device_id) of archived sessions, None until loaded
+        self.archived = None
 
+    @synchronized
     def loadSession(self, recipientId, deviceId):
+        key = (recipientId, deviceId)
+        if key in self.sessionCache:
+            # Move the record to the end, so it is evicted last
+            record = self.sessionCache.pop(key)
+            self.sessionCache[key] = record
+            return record
+
         q = "SELECT record FROM sessions WHERE recipient_id = ? AND device_id = ?"
         c = self.dbConn.cursor()
         c.execute(q, (recipientId, deviceId))
         result = c.fetchone()
 
         if result:
-            return SessionRecord(serialized=result[0])
+            record = SessionRecord(serialized=result[0])
+            self._cacheSession(key, record)
+            return record
+        elif self._restoreSessions([key]):
+            return self.loadSession(recipientId, deviceId)
         else:
             return SessionRecord()
 
+    @synchronized
+    def loadSessions(self, recipientId):
+        """ Load all sessions of recipientId into the cache with one query.
+
+            Sessions which are already cached are kept, as they may contain
+            changes which are not flushed yet.
+        """
+        q = "SELECT device_id, record FROM sessions WHERE recipient_id = ?"
+        c = self.dbConn.cursor()
+        for deviceId, serialized in c.execute(q, (recipientId, )):
+            key = (recipientId, deviceId)
+            if key not in self.sessionCache:
+                self._cacheSession(key, SessionRecord(serialized=serialized))
+
+    def _cacheSession(self, key, record):
+        self.sessionCache.pop(key, None)
+        self.sessionCache[key] = record
+
+        while len(self.sessionCache) > self.cacheSize:
+            oldest = next(iter(self.sessionCache))
+            if oldest in self.dirtySessions:
+                self.flush()
+            del self.sessionCache[oldest]
+
+    @synchronized
+    def flush(self):
+        """ Write all dirty sessions to the database in one transaction.
+
+            Returns
+            -------
+            int
+                The number of written sessions
+        """
+        if not self.dirtySessions:
+            return 0
+
+        # INSERT OR REPLACE deletes the old row, like deleteSession() does,
+        # so a stored session is always active again
+        q = "INSERT OR REPLACE INTO sessions(" \
+            "recipient_id, device_id, record, identity_key) VALUES(?,?,?,?)"
+        rows = []
+        for recipientId, deviceId in self.dirtySessions:
+            record = self.sessionCache[(recipientId, deviceId)]
+            rows.append((recipientId, deviceId, record.serialize(),
+                         identity_key_column(record)))
+        self.dbConn.cursor().executemany(q, rows)
+        self.dbConn.commit()
+        self.dirtySessions.clear()
+        return len(rows)
+
+    @synchronized
+    def invalidateSession(self, recipientId, deviceId):
+        """ Drop a session from the cache without writing it.
+
+            The next loadSession() returns the last flushed state.
+        """
+        key = (recipientId, deviceId)
+        self.sessionCache.pop(key, None)
+        self.dirtySessions.discard(key)
+
     def getSubDeviceSessions(self, recipientId):
+        self.flush()
         q = "SELECT device_id from sessions WHERE recipient_id = ?"
         c = self.dbConn.cursor()
         c.execute(q, (recipientId, ))
@@ -49,6 +156,7 @@ class LiteSessionStore(SessionStore):
         return deviceIds
 
     def getActiveDeviceTuples(self):
+        self.flush()
         q = "SELECT recipient_id, device_id FROM sessions WHERE active = 1"
         c = self.dbConn.cursor()
         result = []
@@ -56,75 +164,192 @@ class LiteSessionStore(SessionStore):
             result.append((row[0], row[1]))
         return result
 
+    @synchronized
     def storeSession(self, recipientId, deviceId, sessionRecord):
-        self.deleteSession(recipientId, deviceId)
-
-        q = "INSERT INTO sessions(recipient_id, device_id, record) VALUES(?,?,?)"
-        c = self.dbConn.cursor()
-        c.execute(q, (recipientId, deviceId, sessionRecord.serialize()))
-        self.dbConn.commit()
+        key = (recipientId, deviceId)
+        self.dirtySessions.add(key)
+        self._cacheSession(key, sessionRecord)
 
+    @synchronized
     def containsSession(self, recipientId, deviceId):
+        # Only stored or persisted sessions are cached
+        if (recipientId, deviceId) in self.sessionCache:
+            return True
+
         q = "SELECT record FROM sessions WHERE recipient_id = ? AND device_id = ?"
         c = self.dbConn.cursor()
         c.execute(q, (recipientId, deviceId))
         result = c.fetchone()
 
-        return result is not None
+        return result is not None or self._isArchived(recipientId, deviceId)
 
+    @synchronized
     def deleteSession(self, recipientId, deviceId):
+        self.invalidateSession(recipientId, deviceId)
         q = "DELETE FROM sessions WHERE recipient_id = ? AND device_id = ?"
         self.dbConn.cursor().execute(q, (recipientId, deviceId))
+        q = "DELETE FROM archived_sessions " \
+            "WHERE recipient_id = ? AND device_id = ?"
+        self.dbConn.cursor().execute(q, (recipientId, deviceId))
         self.dbConn.commit()
+        if self.archived is not None:
+            self.archived.discard((jid_key(recipientId), deviceId))
 
+    @synchronized
     def deleteAllSessions(self, recipientId):
+        for key in list(self.sessionCache):
+            if key[0] == recipientId:
+                self.invalidateSession(*key)
         q = "DELETE FROM sessions WHERE recipient_id = ?"
         self.dbConn.cursor().execute(q, (recipientId, ))
+        q = "DELETE FROM archived_sessions WHERE recipient_id = ?"
+        self.dbConn.cursor().execute(q, (recipientId, ))
         self.dbConn.commit()
+        if self.archived is not None:
+            jid = jid_key(recipientId)
+            self.archived = set(key for key in self.archived
+                                if key[0] != jid)
 
+    @synchronized
     def setActiveState(self, deviceList, jid):
+        self.setActiveStates({jid: deviceList})
+
+    @synchronized
+    def setActiveStates(self, deviceLists, commit=True):
+        """ Mark the sessions of the listed devices active and all other
+            sessions of the same jids inactive. Archived sessions of listed
+            devices are restored.
+
+            :param deviceLists: jid => list of device ids
+            :type deviceLists: dict
+            :param commit: False to leave the transaction open for more
+                           changes of the caller
+        """
+        # Write pending sessions first, a later flush would reset them active
+        self.flush()
+        devices = [(jid, deviceId)
+                   for jid, deviceList in deviceLists.items()
+                   for deviceId in deviceList]
+        self._restoreSessions(devices, commit=False)
         c = self.dbConn.cursor()
 
-        q = "UPDATE sessions SET active = {} " \
-            "WHERE recipient_id = '{}' AND device_id IN ({})" \
-            .format(1, jid, ', '.join(['?'] * len(deviceList)))
-        c.execute(q, deviceList)
+        q = "UPDATE sessions SET active = 0, inactive_since = ? " \
+            "WHERE recipient_id = ? AND active = 1"
+        now = int(time.time())
+        c.executemany(q, [(now, jid) for jid in deviceLists])
+
+        q = "UPDATE sessions SET active = 1, inactive_since = NULL " \
+            "WHERE recipient_id = ? AND device_id = ?"
+        c.executemany(q, devices)
+        if commit:
+            self.dbConn.commit()
+
+    @synchronized
+    def archiveSessions(self, before):
+        """ Move the sessions which are inactive since before to the
+            archive.
+
+            Parameters
+            ----------
+            before : int
+                Unix timestamp
 
-        q = "UPDATE sessions SET active = {} " \
-            "WHERE recipient_id = '{}' AND device_id NOT IN ({})" \
-            .format(0, jid, ', '.join(['?'] * len(deviceList)))
-        c.execute(q, deviceList)
+            Returns
+            -------
+            int
+                The number of archived sessions
+        """
+        self.flush()
+        q = "SELECT recipient_id, device_id, record, identity_key " \
+            "FROM sessions WHERE active = 0 AND inactive_since < ?"
+        c = self.dbConn.cursor()
+        rows = c.execute(q, (before, )).fetchall()
+        if not rows:
+            return 0
+
+        now = int(time.time())
+        q = "INSERT OR REPLACE INTO archived_sessions(recipient_id, " \
+            "device_id, record, identity_key, archived_at) VALUES(?,?,?,?,?)"
+        c.executemany(q, [(jid, deviceId, zlib.compress(bytes(record)),
+                           identity_key, now)
+                          for jid, deviceId, record, identity_key in rows])
+        q = "DELETE FROM sessions WHERE recipient_id = ? AND device_id = ?"
+        c.executemany(q, [(jid, deviceId) for jid, deviceId, _, _ in rows])
         self.dbConn.commit()
 
+        for jid, deviceId, _, _ in rows:
+            for key in ((jid, deviceId), (jid_key(jid), deviceId)):
+                self.sessionCache.pop(key, None)
+            if self.archived is not None:
+                self.archived.add((jid_key(jid), deviceId))
+        return len(rows)
+
+    def _isArchived(self, recipientId, deviceId):
+        if self.archived is None:
+            q = "SELECT recipient_id, device_id FROM archived_sessions"
+            self.archived = set((jid_key(jid), deviceId)
+                                for jid, deviceId in self.dbConn.execute(q))
+        return (jid_key(recipientId), deviceId) in self.archived
+
+    def _restoreSessions(self, keys, commit=True):
+        """ Move the archived sessions of keys back as inactive sessions.
+
+            Returns
+            -------
+            int
+                The number of restored sessions
+        """
+        keys = [key for key in keys if self._isArchived(*key)]
+        if not keys:
+            return 0
+
+        c = self.dbConn.cursor()
+        q = "SELECT record, identity_key FROM archived_sessions " \
+            "WHERE recipient_id = ? AND device_id = ?"
+        rows = []
+        for jid, deviceId in keys:
+            # The set of archived keys can be stale, skip removed rows
+            self.archived.discard((jid_key(jid), deviceId))
+            row = c.execute(q, (jid, deviceId)).fetchone()
+            if row is None:
+                continue
+            record, identity_key = row
+            rows.append((jid, deviceId, zlib.decompress(bytes(record)),
+                         identity_key, int(time.time())))
+        if not rows:
+            return 0
+
+        q = "INSERT OR REPLACE INTO sessions(recipient_id, device_id, " \
+            "record, identity_key, active, inactive_since) " \
+            "VALUES(?,?,?,?,0,?)"
+        c.executemany(q, rows)
+        q = "DELETE FROM archived_sessions " \
+            "WHERE recipient_id = ? AND device_id = ?"
+        c.executemany(q, [(jid, deviceId) for jid, deviceId, _, _, _ in rows])
+        if commit:
+            self.dbConn.commit()
+        return len(rows)
+
     def getActiveSessionsKeys(self, recipientId):
-        q = "SELECT record FROM sessions WHERE active = 1 AND recipient_id = ?"
+        self.flush()
+        q = "SELECT identity_key FROM sessions WHERE active = 1 " \
+            "AND recipient_id = ? AND identity_key IS NOT NULL"
         c = self.dbConn.cursor()
-        result = []
-        for row in c.execute(q, (recipientId,)):
-            public_key = (SessionRecord(serialized=row[0]).
-                          getSessionState().getRemoteIdentityKey().
-                          getPublicKey())
-            result.append(public_key.serialize())
-        return result
+        return [bytes(row[0]) for row in c.execute(q, (recipientId,))]
 
     def getAllActiveSessionsKeys(self):
-        q = "SELECT record FROM sessions WHERE active = 1"
+        self.flush()
+        q = "SELECT identity_key FROM sessions WHERE active = 1 " \
+            "AND identity_key IS NOT NULL"
         c = self.dbConn.cursor()
-        result = []
-        for row in c.execute(q):
-            public_key = (SessionRecord(serialized=row[0]).
-                          getSessionState().getRemoteIdentityKey().
-                          getPublicKey())
-            result.append(public_key.serialize())
-        return result
+        return [bytes(row[0]) for row in c.execute(q)]
 
     def getInactiveSessionsKeys(self, recipientId):
-        q = "SELECT record FROM sessions WHERE active = 0 AND recipient_id = ?"
+        self.flush()
+        q = "SELECT identity_key FROM sessions WHERE active = 0 " \
+            "AND recipient_id = ? AND identity_key IS NOT NULL " \
+            "UNION ALL SELECT identity_key FROM archived_sessions " \
+            "WHERE recipient_id = ? AND identity_key IS NOT NULL"
         c = self.dbConn.cursor()
-        result = []
-        for row in c.execute(q, (recipientId,)):
-            public_key = (SessionRecord(serialized=row[0]).
-                          getSessionState().getRemoteIdentityKey().
-                          getPublicKey())
-            result.append(public_key.serialize())
-        return result
+        return [bytes(row[0]) for row in c.execute(q, (recipientId,
+                                                       recipientId))]
@@ -17,19 +17,26 @@
 # the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import threading
+
 from axolotl.invalidkeyidexception import InvalidKeyIdException
 from axolotl.state.signedprekeyrecord import SignedPreKeyRecord
 from axolotl.state.signedprekeystore import SignedPreKeyStore
 from axolotl.util.medium import Medium
 
+from .db_helpers import synchronized
+
 
 class LiteSignedPreKeyStore(SignedPreKeyStore):
-    def __init__(self, dbConn):
+    def __init__(self, dbConn, lock=None):
         """
         :type dbConn: Connection
+        :param lock: RLock shared by all stores of the connection
         """
         self.dbConn = dbConn
+        self.lock = lock if lock is not None else threading.RLock()
 
+    @synchronized
     def loadSignedPreKey(self, signedPreKeyId):
         q = "SELECT record FROM signed_prekeys WHERE prekey_id = ?"
 
@@ -43,6 +50,7 @@ class LiteSignedPreKeyStore(SignedPreKeyStore):
 
         return SignedPreKeyRecord(serialized=result[0])
 
+    @synchronized
     def loadSignedPreKeys(self):
         q = "SELECT record FROM signed_prekeys"
 
@@ -55,24 +63,28 @@ class LiteSignedPreKeyStore(SignedPreKeyStore):
 
         return results
 
+    @synchronized
     def storeSignedPreKey(self, signedPreKeyId, signedPreKeyRecord):
         q = "INSERT INTO signed_prekeys (prekey_id, record) VALUES(?,?)"
         cursor = self.dbConn.cursor()
         cursor.execute(q, (signedPreKeyId, signedPreKeyRecord.serialize()))
         self.dbConn.commit()
 
+    @synchronized
     def containsSignedPreKey(self, signedPreKeyId):
         q = "SELECT record FROM signed_prekeys WHERE prekey_id = ?"
         cursor = self.dbConn.cursor()
         cursor.execute(q, (signedPreKeyId, ))
         return cursor.fetchone() is not None
 
+    @synchronized
     def removeSignedPreKey(self, signedPreKeyId):
         q = "DELETE FROM signed_prekeys WHERE prekey_id = ?"
         cursor = self.dbConn.cursor()
         cursor.execute(q, (signedPreKeyId, ))
         self.dbConn.commit()
 
+    @synchronized
     def getNextSignedPreKeyId(self):
         result = self.getCurrentSignedPreKeyId()
         if not result:
@@ -80,6 +92,7 @@ class LiteSignedPreKeyStore(SignedPreKeyStore):
         else:
             return (result % (Medium.MAX_VALUE - 1)) + 1
 
+    @synchronized
     def getCurrentSignedPreKeyId(self):
         q = "SELECT MAX(prekey_id) FROM signed_prekeys"
 
@@ -91,6 +104,7 @@ class LiteSignedPreKeyStore(SignedPreKeyStore):
         else:
             return result[0]
 
+    @synchronized
     def getSignedPreKeyTimestamp(self, signedPreKeyId):
         q = "SELECT strftime('%s', timestamp) FROM " \
             "signed_prekeys WHERE prekey_id = ?"
@@ -105,6 +119,7 @@ class LiteSignedPreKeyStore(SignedPreKeyStore):
 
         return result[0]
 
+    @synchronized
     def removeOldSignedPreKeys(self, timestamp):
         q = "DELETE FROM signed_prekeys " \
             "WHERE timestamp < datetime(?, 'unixepoch')"
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Gajim-OMEMO plugin.
+#
+# The Gajim-OMEMO plugin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gajim-OMEMO is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import time
+
+log = logging.getLogger('gajim.plugin_system.omemo')
+
+# Days a session has to be inactive before it is archived
+DEFAULT_ARCHIVE_DAYS = 30
+# Seconds after sign in until the first maintenance run
+MAINTENANCE_DELAY = 300
+# Seconds between two maintenance runs
+MAINTENANCE_INTERVAL = 86400
+# Free pages returned to the file system per idle callback
+VACUUM_STEP = 100
+
+# PRAGMA auto_vacuum value of incremental mode
+_INCREMENTAL = 2
+
+
+class DatabaseMaintenance(object):
+    """ Keeps the db of one account small.
+
+        A run archives the sessions which are inactive for archive_days
+        and then gives the free pages back to the file system VACUUM_STEP
+        at a time from idle callbacks, so the main loop is never blocked
+        for long. Only dbs created with incremental
+        auto_vacuum can give pages back, converting an older db needs a
+        full VACUUM which would block the main loop, so their free pages
+        are only reused by sqlite.
+
+        The maintenance does not depend on gobject, the plugin passes in
+        gobject.timeout_add, gobject.source_remove and gobject.idle_add.
+    """
+
+    def __init__(self, state, timeout_add, source_remove, idle_add,
+                 now=time.time, archive_days=DEFAULT_ARCHIVE_DAYS,
+                 vacuum_step=VACUUM_STEP):
+        """
+            Parameters
+            ----------
+            state : OmemoState
+                The state of the account
+            timeout_add : callable
+                Called with (milliseconds, callback), returns a source id
+            source_remove : callable
+                Removes a source id returned by timeout_add or idle_add
+            idle_add : callable
+                Called with a callback, returns a source id
+            now : callable
+                Returns the current time in seconds
+            archive_days : int
+                Days a session has to be inactive before it is archived
+            vacuum_step : int
+                Pages freed per idle callback
+        """
+        self.state = state
+        self.timeout_add = timeout_add
+        self.source_remove = source_remove
+        self.idle_add = idle_add
+        self.now = now
+        self.archive_days = archive_days
+        self.vacuum_step = vacuum_step
+        self.timeout_id = None
+        self.idle_id = None
+        # db size in bytes before the running maintenance
+        self.size_before = None
+
+        self.runs = 0
+        self.archived = 0
+        self.reclaimed = 0
+
+    def start(self, delay=MAINTENANCE_DELAY):
+        """ Run the maintenance after delay seconds and then every
+            MAINTENANCE_INTERVAL.
+        """
+        if self.timeout_id is None:
+            self.timeout_id = self.timeout_add(delay * 1000, self._scheduled)
+
+    def stop(self):
+        if self.timeout_id is not None:
+            self.source_remove(self.timeout_id)
+            self.timeout_id = None
+        if self.idle_id is not None:
+            self.source_remove(self.idle_id)
+            self.idle_id = None
+
+    def run(self):
+        """ Archive sessions, then vacuum in idle callbacks. """
+        if self.idle_id is not None:
+            return
+        db = self.state.store.sessionStore.dbConn
+        now = int(self.now())
+        with self.state.lock:
+            self.size_before = self._size(db)
+            archived = self.state.store.sessionStore.archiveSessions(
+                now - self.archive_days * 86400)
+            incremental = db.execute('PRAGMA auto_vacuum').fetchone()[0] \
+                == _INCREMENTAL
+
+        self.runs += 1
+        self.archived += archived
+        log.debug(self.state.account + ' => Archived ' + str(archived) +
+                  ' sessions')
+        if not incremental:
+            log.debug(self.state.account + ' => No incremental auto_vacuum, '
+                      'free pages are not given back')
+            return
+        self.idle_id = self.idle_add(self._vacuum)
+
+    def stats(self):
+        return {'runs': self.runs,
+                'archived': self.archived,
+                'reclaimed': self.reclaimed}
+
+    def _scheduled(self):
+        self.timeout_id = self.timeout_add(MAINTENANCE_INTERVAL * 1000,
+                                           self._scheduled)
+        self.run()
+        # A new timeout with the interval was added
+        return False
+
+    def _vacuum(self):
+        db = self.state.store.sessionStore.dbConn
+        with self.state.lock:
+            if db.execute('PRAGMA freelist_count').fetchone()[0]:
+                # incremental_vacuum frees one page per step
+                db.execute('PRAGMA incremental_vacuum(%d)' %
+                           self.vacuum_step).fetchall()
+                return True
+            reclaimed = max(0, self.size_before - self._size(db))
+
+        self.idle_id = None
+        self.reclaimed += reclaimed
+        log.info(self.state.account + ' => Database maintenance reclaimed ' +
+                 str(reclaimed // 1024) + ' KiB')
+        return False
+
+    @staticmethod
+    def _size(db):
+        page_count = db.execute('PRAGMA page_count').fetchone()[0]
+        page_size = db.execute('PRAGMA page_size').fetchone()[0]
+        return page_count * page_size
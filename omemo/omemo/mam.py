@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Gajim-OMEMO plugin.
+#
+# The Gajim-OMEMO plugin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gajim-OMEMO is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import threading
+from collections import OrderedDict
+
+try:
+    from Queue import Empty, Queue
+except ImportError:
+    from queue import Empty, Queue
+
+log = logging.getLogger('gajim.plugin_system.omemo')
+
+# Plaintexts handed back to the main loop per idle callback
+DEFAULT_CHUNK_SIZE = 50
+# Messages taken from the queue before they are grouped and decrypted
+MAX_BATCH_SIZE = 500
+
+_STOP = object()
+
+
+class MamDecryptionPipeline(object):
+    """ Decrypts archived OMEMO messages of one account in a worker thread.
+
+        Queued messages are taken in batches and grouped by
+        (sender_jid, sid), so the ratchet of every device advances in archive
+        order. The sessions are written to the db once per group. The
+        results are handed back in archive order, chunk_size at a time,
+        through idle_add, so the main loop never blocks on a whole catch-up.
+    """
+
+    def __init__(self, state, deliver, idle_add,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+            Parameters
+            ----------
+            state : OmemoState
+                The state of the account
+            deliver : callable
+                Called in the main loop with a list of (data, plaintext)
+                tuples, plaintext is None if the message could not be
+                decrypted
+            idle_add : callable
+                gobject.idle_add or a replacement
+            chunk_size : int
+                Maximum number of results per deliver call
+        """
+        self.state = state
+        self.deliver = deliver
+        self.idle_add = idle_add
+        self.chunk_size = chunk_size
+        self.queue = Queue()
+        self.thread = None
+        self.decrypted = 0
+        self.failed = 0
+
+    def put(self, msg_dict, data):
+        """ Queue a message for decryption.
+
+            Parameters
+            ----------
+            msg_dict : dict
+                The unpacked message, as decrypt_msg() expects it
+            data
+                Passed back to deliver with the plaintext, e.g. the event
+        """
+        self.queue.put((msg_dict, data))
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run,
+                                           name='omemo-mam-' +
+                                           self.state.account)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """ Stop the worker after the queued messages are decrypted. """
+        if self.thread is not None:
+            self.queue.put(_STOP)
+            self.thread = None
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            stop = batch and batch[-1] is _STOP
+            if stop:
+                batch.pop()
+            if batch:
+                self.process(batch)
+            if stop:
+                return
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        while batch[-1] is not _STOP and len(batch) < MAX_BATCH_SIZE:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def process(self, batch):
+        """ Decrypt a batch of (msg_dict, data) tuples and hand back the
+            results.
+        """
+        groups = OrderedDict()
+        for index, (msg_dict, data) in enumerate(batch):
+            key = (msg_dict['sender_jid'], msg_dict['sid'])
+            groups.setdefault(key, []).append((index, msg_dict, data))
+
+        results = [None] * len(batch)
+        for key, messages in groups.items():
+            with self.state.lock:
+                for index, msg_dict, data in messages:
+                    results[index] = (data, self._decrypt(msg_dict))
+                self.state.store.sessionStore.flush()
+
+        for start in range(0, len(results), self.chunk_size):
+            self.idle_add(self._deliver, results[start:start +
+                                                 self.chunk_size])
+
+    def _decrypt(self, msg_dict):
+        try:
+            plaintext = self.state.decrypt_msg(msg_dict)
+        except Exception:
+            log.exception(self.state.account +
+                          ' => Failed to decrypt MAM message')
+            plaintext = None
+        if plaintext:
+            self.decrypted += 1
+        else:
+            self.failed += 1
+        return plaintext
+
+    def _deliver(self, results):
+        self.deliver(results)
+        # Do not repeat the idle callback
+        return False
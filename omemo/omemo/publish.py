@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Gajim-OMEMO plugin.
+#
+# The Gajim-OMEMO plugin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gajim-OMEMO is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+
+log = logging.getLogger('gajim.plugin_system.omemo')
+
+# Milliseconds to wait for more publish requests before publishing
+DEFAULT_PUBLISH_WINDOW = 2000
+# Milliseconds until an unanswered publish counts as lost
+DEFAULT_PUBLISH_TIMEOUT = 30000
+
+
+class PublishScheduler(object):
+    """ Coalesces bundle publish requests per account.
+
+        The first request of an account starts a timer, all requests until
+        the timer fires are suppressed. While a publish is in flight, only
+        one more publish is queued and sent after the result came in, so the
+        server always gets the final prekey set. A publish whose result
+        does not come in within timeout counts as lost, the queued publish
+        is sent then.
+
+        The scheduler does not depend on gobject, the plugin passes in
+        gobject.timeout_add and gobject.source_remove.
+    """
+
+    def __init__(self, publish, timeout_add, source_remove,
+                 window=DEFAULT_PUBLISH_WINDOW, forget_query=None,
+                 timeout=DEFAULT_PUBLISH_TIMEOUT):
+        """
+            Parameters
+            ----------
+            publish : callable
+                Sends the bundle of an account, called with the account
+                name, returns the id of the iq
+            timeout_add : callable
+                Called with (milliseconds, callback, account), returns a
+                source id
+            source_remove : callable
+                Removes a source id returned by timeout_add
+            window : int
+                Milliseconds to wait for more requests
+            forget_query : callable
+                Called with the iq id of a lost publish, so its result
+                callback can be dropped
+            timeout : int
+                Milliseconds until an unanswered publish counts as lost
+        """
+        self.publish = publish
+        self.timeout_add = timeout_add
+        self.source_remove = source_remove
+        self.window = window
+        self.forget_query = forget_query
+        self.timeout = timeout
+        self.timers = {}
+        # account => (iq id, source id of the timeout)
+        self.in_flight = {}
+        self.pending = set()
+        self.requested = 0
+        self.published = 0
+        self.suppressed = 0
+        self.timeouts = 0
+
+    def request(self, account):
+        """ Request publishing the bundle of account. """
+        self.requested += 1
+        if account in self.timers:
+            self.suppressed += 1
+        elif account in self.in_flight:
+            if account in self.pending:
+                self.suppressed += 1
+            else:
+                self.pending.add(account)
+        else:
+            self._schedule(account)
+
+    def finished(self, account):
+        """ Called when the result of a publish of account came in. """
+        if account in self.in_flight:
+            _, source_id = self.in_flight.pop(account)
+            self.source_remove(source_id)
+        if account in self.pending:
+            self.pending.discard(account)
+            self._schedule(account)
+
+    def reset(self, account):
+        """ Forget all state of account, e.g. after a reconnect, when no
+            result will arrive for a publish in flight anymore.
+        """
+        if account in self.timers:
+            self.source_remove(self.timers.pop(account))
+        if account in self.in_flight:
+            self._forget(account)
+        self.pending.discard(account)
+
+    def cancel_all(self):
+        for account in set(self.timers) | set(self.in_flight):
+            self.reset(account)
+        self.pending.clear()
+
+    def stats(self):
+        return {'requested': self.requested,
+                'published': self.published,
+                'suppressed': self.suppressed,
+                'timeouts': self.timeouts}
+
+    def _schedule(self, account):
+        self.timers[account] = self.timeout_add(self.window, self._publish,
+                                                account)
+
+    def _publish(self, account):
+        del self.timers[account]
+        self.published += 1
+        iq_id = self.publish(account)
+        self.in_flight[account] = (
+            iq_id, self.timeout_add(self.timeout, self._timed_out, account))
+        log.debug(account + ' => Bundle publish requests: ' +
+                  str(self.stats()))
+        # Do not repeat the timeout
+        return False
+
+    def _forget(self, account):
+        iq_id, source_id = self.in_flight.pop(account)
+        self.source_remove(source_id)
+        if self.forget_query is not None:
+            self.forget_query(iq_id)
+
+    def _timed_out(self, account):
+        log.warn(account + ' => Bundle publish timed out')
+        iq_id, _ = self.in_flight.pop(account)
+        if self.forget_query is not None:
+            self.forget_query(iq_id)
+        self.timeouts += 1
+        if account in self.pending:
+            self.pending.discard(account)
+            self._schedule(account)
+        # Do not repeat the timeout
+        return False
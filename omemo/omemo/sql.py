@@ -16,6 +16,11 @@
 # You should have received a copy of the GNU General Public License along with
 # the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
 #
+import sqlite3
+
+from axolotl.identitykey import IdentityKey
+from axolotl.state.sessionrecord import SessionRecord
+
 from .db_helpers import user_version
 
 
@@ -39,6 +44,7 @@ class SQLDatabase():
             # SignedPreKeyStore
             # SessionStore
             # EncryptionStore
+            # BundleFailureStore
 
             create_tables = '''
                 CREATE TABLE IF NOT EXISTS identities (
@@ -64,20 +70,37 @@ class SQLDatabase():
                     _id INTEGER PRIMARY KEY AUTOINCREMENT,
                     recipient_id TEXT, device_id INTEGER,
                     record BLOB, timestamp INTEGER, active INTEGER DEFAULT 1,
+                    identity_key BLOB, inactive_since INTEGER,
                     UNIQUE(recipient_id, device_id));
 
+                CREATE TABLE IF NOT EXISTS archived_sessions (
+                    recipient_id TEXT, device_id INTEGER,
+                    record BLOB, identity_key BLOB, archived_at INTEGER,
+                    PRIMARY KEY(recipient_id, device_id));
+
+                CREATE INDEX IF NOT EXISTS sessions_identity_index
+                    ON sessions (active, recipient_id, identity_key);
+
+                CREATE INDEX IF NOT EXISTS
+                    identities_trust_index ON identities (recipient_id, trust);
+
                 CREATE TABLE IF NOT EXISTS encryption_state (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     jid TEXT UNIQUE,
                     encryption INTEGER,
                     timestamp NUMERIC DEFAULT CURRENT_TIMESTAMP
                     );
+
+                CREATE TABLE IF NOT EXISTS bundle_failures (
+                    recipient_id TEXT, device_id INTEGER,
+                    failed_at INTEGER,
+                    PRIMARY KEY(recipient_id, device_id));
                 '''
 
             create_db_sql = """
                 BEGIN TRANSACTION;
                 %s
-                PRAGMA user_version=5;
+                PRAGMA user_version=9;
                 END TRANSACTION;
                 """ % (create_tables)
             self.dbConn.executescript(create_db_sql)
@@ -145,3 +168,115 @@ class SQLDatabase():
                                           PRAGMA user_version=5;
                                           END TRANSACTION;
                                       """ % (add_timestamp))
+
+        if user_version(self.dbConn) < 6:
+            # Adds indexes for looking up active sessions and the trust
+            # of a recipients identities
+            add_indexes = """
+                CREATE INDEX IF NOT EXISTS
+                    sessions_active_index ON sessions (active, recipient_id);
+                CREATE INDEX IF NOT EXISTS
+                    identities_trust_index ON identities (recipient_id, trust);
+            """
+
+            self.dbConn.executescript(""" BEGIN TRANSACTION;
+                                          %s
+                                          PRAGMA user_version=6;
+                                          END TRANSACTION;
+                                      """ % (add_indexes))
+
+        if user_version(self.dbConn) < 7:
+            # Adds the remote identity key of the session as column, so it
+            # can be read without deserializing the record. The index
+            # replaces sessions_active_index and covers the key queries.
+            add_identity_key = [
+                "ALTER TABLE sessions ADD COLUMN identity_key BLOB",
+                "DROP INDEX IF EXISTS sessions_active_index",
+                """CREATE INDEX IF NOT EXISTS sessions_identity_index
+                    ON sessions (active, recipient_id, identity_key)"""]
+
+            rows = []
+            q = "SELECT _id, record FROM sessions"
+            for _id, record in self.dbConn.execute(q):
+                identity_key = identity_key_column(
+                    SessionRecord(serialized=record))
+                if identity_key is not None:
+                    rows.append((identity_key, _id))
+
+            # Without implicit transactions, so the ALTER TABLE does not
+            # commit before the UPDATEs ran
+            isolation_level = self.dbConn.isolation_level
+            self.dbConn.isolation_level = None
+            try:
+                self.dbConn.execute("BEGIN TRANSACTION")
+                for statement in add_identity_key:
+                    self.dbConn.execute(statement)
+                self.dbConn.executemany(
+                    "UPDATE sessions SET identity_key = ? WHERE _id = ?",
+                    rows)
+                self.dbConn.execute("PRAGMA user_version=7")
+                self.dbConn.execute("COMMIT")
+            except Exception:
+                self.dbConn.execute("ROLLBACK")
+                raise
+            finally:
+                self.dbConn.isolation_level = isolation_level
+
+        if user_version(self.dbConn) < 8:
+            # Remembers the devices whose bundle could not be fetched, so
+            # the prefetch does not query them on every login
+            add_bundle_failures = """
+                CREATE TABLE IF NOT EXISTS bundle_failures (
+                    recipient_id TEXT, device_id INTEGER,
+                    failed_at INTEGER,
+                    PRIMARY KEY(recipient_id, device_id));
+            """
+
+            self.dbConn.executescript(""" BEGIN TRANSACTION;
+                                          %s
+                                          PRAGMA user_version=8;
+                                          END TRANSACTION;
+                                      """ % (add_bundle_failures))
+
+        if user_version(self.dbConn) < 9:
+            # Remembers since when a session is inactive and adds the table
+            # inactive sessions are moved to, see LiteSessionStore.
+            # Sessions which are already inactive start aging now.
+            add_session_archive = """
+                ALTER TABLE sessions ADD COLUMN inactive_since INTEGER;
+                UPDATE sessions SET inactive_since = strftime('%s', 'now')
+                    WHERE active = 0;
+                CREATE TABLE IF NOT EXISTS archived_sessions (
+                    recipient_id TEXT, device_id INTEGER,
+                    record BLOB, identity_key BLOB, archived_at INTEGER,
+                    PRIMARY KEY(recipient_id, device_id));
+            """
+
+            self.dbConn.executescript(""" BEGIN TRANSACTION;
+                                          %s
+                                          PRAGMA user_version=9;
+                                          END TRANSACTION;
+                                      """ % (add_session_archive))
+
+
+def session_identity_key(session_record):
+    """ Return the serialized remote identity key of a SessionRecord, or
+        None if the session has no remote identity yet.
+    """
+    # getRemoteIdentityKey() fails on an empty field instead of returning None
+    structure = session_record.getSessionState().getStructure()
+    if not structure.remoteIdentityPublic:
+        return None
+    return IdentityKey(structure.remoteIdentityPublic, 0).getPublicKey() \
+        .serialize()
+
+
+def identity_key_column(session_record):
+    """ Return the remote identity key of a SessionRecord as it is written
+        to the identity_key column, so that equality lookups on the column
+        match every row.
+    """
+    identity_key = session_identity_key(session_record)
+    if identity_key is None:
+        return None
+    return sqlite3.Binary(identity_key)
@@ -18,6 +18,7 @@
 #
 
 import logging
+import threading
 import time
 from base64 import b64encode
 
@@ -37,6 +38,7 @@ from axolotl.util.keyhelper import KeyHelper
 from Crypto.Random import get_random_bytes
 
 from .aes_gcm import NoValidSessions, decrypt, encrypt
+from .db_helpers import synchronized
 from .liteaxolotlstore import (LiteAxolotlStore, DEFAULT_PREKEY_AMOUNT,
                                MIN_PREKEY_AMOUNT, SPK_CYCLE_TIME,
                                SPK_ARCHIVE_TIME)
@@ -58,17 +60,35 @@ class OmemoState:
         """
         self.account = account
         self.plugin = plugin
+        # Serializes ratchet operations and db access, the crypto executor
+        # and the MAM pipeline use the state from worker threads. The
+        # stores share it.
+        self.lock = threading.RLock()
         self.session_ciphers = {}
         self.own_jid = own_jid
         self.device_ids = {}
         self.own_devices = []
-        self.store = LiteAxolotlStore(connection)
+        # step => seconds spent on it while booting
+        self.timings = {}
+        started = time.time()
+        self.store = LiteAxolotlStore(connection, self.lock)
         self.encryption = self.store.encryptionStore
+        # (prekey store version, bundle) of the last built bundle
+        self.bundle_cache = None
+        self.bundle_prekeys = {}
+        self.next_spk_cycle = 0
+        # Opening the db, migrations and generating the keys
+        self.timings['store'] = time.time() - started
+        started = time.time()
+        self.store.identityKeyStore.warmTrustCache()
+        self.timings['trust_cache'] = time.time() - started
+        started = time.time()
         for jid, device_id in self.store.getActiveDeviceTuples():
             if jid != own_jid:
                 self.add_device(jid, device_id)
             else:
                 self.add_own_device(device_id)
+        self.timings['devices'] = time.time() - started
 
         log.info(self.account + ' => Roster devices after boot:' +
                  str(self.device_ids))
@@ -78,6 +98,7 @@ class OmemoState:
                   str(self.store.preKeyStore.getPreKeyCount()) +
                   ' PreKeys available')
 
+    @synchronized
     def build_session(self, recipient_id, device_id, bundle_dict):
         sessionBuilder = SessionBuilder(self.store, self.store, self.store,
                                         self.store, recipient_id, device_id)
@@ -114,6 +135,40 @@ class OmemoState:
         self.device_ids[name] = devices
         log.info(self.account + ' => Saved devices for ' + name)
 
+    @synchronized
+    def set_device_lists(self, device_lists, enable_encryption=()):
+        """ Save the device lists of many contacts in one transaction.
+
+            The active state of the sessions of every listed jid is
+            reconciled, even if the list equals
+            :py:attribute:`OmemoState.device_ids`, as sessions built or
+            restored meanwhile are stored active.
+
+            Parameters
+            ----------
+            device_lists : dict
+                jid => list of device ids
+            enable_encryption : iterable
+                jids to activate encryption for, in the same transaction
+
+            Returns
+            -------
+            dict
+                The device lists which differ from the known ones
+        """
+        changed = {}
+        for jid, devices in device_lists.items():
+            if set(self.device_ids.get(jid, ())) != set(devices):
+                changed[jid] = devices
+            self.device_ids[jid] = devices
+
+        self.store.sessionStore.setActiveStates(device_lists, commit=False)
+        self.encryption.activate_all(enable_encryption, commit=False)
+        self.store.sessionStore.dbConn.commit()
+        log.info(self.account + ' => Saved ' + str(len(device_lists)) +
+                 ' device lists, ' + str(len(changed)) + ' changed')
+        return changed
+
     def add_device(self, name, device_id):
         if name not in self.device_ids:
             self.device_ids[name] = [device_id]
@@ -151,17 +206,33 @@ class OmemoState:
         return self.own_device_id in self.own_devices
 
     @property
+    @synchronized
     def bundle(self):
+        """ Return our bundle information for publishing.
+
+            The result is cached and only rebuilt if prekeys were consumed
+            or generated, or the SignedPreKey was cycled. Only new prekeys
+            get encoded on a rebuild.
+        """
         self.checkPreKeyAmount()
-        prekeys = [
-            (k.getId(), b64encode(k.getKeyPair().getPublicKey().serialize()))
-            for k in self.store.loadPreKeys()
-        ]
 
-        identityKeyPair = self.store.getIdentityKeyPair()
+        if time.time() >= self.next_spk_cycle:
+            self.cycleSignedPreKey(self.store.getIdentityKeyPair())
+            self.bundle_cache = None
 
-        self.cycleSignedPreKey(identityKeyPair)
+        prekey_version = self.store.preKeyStore.version
+        if self.bundle_cache is not None and \
+                self.bundle_cache[0] == prekey_version:
+            return self.bundle_cache[1]
 
+        public_prekeys = self.store.preKeyStore.getPublicPreKeys()
+        for prekey_id in set(self.bundle_prekeys) - set(public_prekeys):
+            del self.bundle_prekeys[prekey_id]
+        for prekey_id, public_key in public_prekeys.items():
+            if prekey_id not in self.bundle_prekeys:
+                self.bundle_prekeys[prekey_id] = b64encode(public_key)
+
+        identityKeyPair = self.store.getIdentityKeyPair()
         signedPreKey = self.store.loadSignedPreKey(
             self.store.getCurrentSignedPreKeyId())
 
@@ -172,10 +243,12 @@ class OmemoState:
             'signedPreKeySignature': b64encode(signedPreKey.getSignature()),
             'identityKey':
             b64encode(identityKeyPair.getPublicKey().serialize()),
-            'prekeys': prekeys
+            'prekeys': sorted(self.bundle_prekeys.items())
         }
+        self.bundle_cache = (prekey_version, result)
         return result
 
+    @synchronized
     def decrypt_msg(self, msg_dict):
         own_id = self.own_device_id
         if own_id not in msg_dict['keys']:
@@ -217,6 +290,7 @@ class OmemoState:
         log.debug("Decrypted Message => " + result)
         return result
 
+    @synchronized
     def create_msg(self, from_jid, jid, plaintext):
         key = get_random_bytes(16)
         iv = get_random_bytes(16)
@@ -234,14 +308,19 @@ class OmemoState:
             log.warn('No session ciphers for ' + jid)
             return
 
+        # Load all sessions and trust states with one query each, so the
+        # loop below works on the session cache only
+        trust_states = self.load_recipient(jid)
+
         # Encrypt the message key with for each of receivers devices
         for rid, cipher in session_ciphers.items():
             try:
-                if self.isTrusted(cipher) == TRUSTED:
+                trust = self.cached_trust(cipher, trust_states)
+                if trust == TRUSTED:
                     encrypted_keys[rid] = cipher.encrypt(key).serialize()
                 else:
                     log.debug('Skipped Device because Trust is: ' +
-                              str(self.isTrusted(cipher)))
+                              str(trust))
             except:
                 log.warn('Failed to find key for device ' + str(rid))
 
@@ -251,18 +330,23 @@ class OmemoState:
             raise NoValidSessions(log_msg)
 
         my_other_devices = set(self.own_devices) - set({self.own_device_id})
+        own_trust_states = self.load_recipient(from_jid)
         # Encrypt the message key with for each of our own devices
         for dev in my_other_devices:
             try:
                 cipher = self.get_session_cipher(from_jid, dev)
-                if self.isTrusted(cipher) == TRUSTED:
+                trust = self.cached_trust(cipher, own_trust_states)
+                if trust == TRUSTED:
                     encrypted_keys[dev] = cipher.encrypt(key).serialize()
                 else:
                     log.debug('Skipped own Device because Trust is: ' +
-                              str(self.isTrusted(cipher)))
+                              str(trust))
             except:
                 log.warn('Failed to find key for device ' + str(dev))
 
+        # Persist all advanced sessions in one transaction
+        self.store.sessionStore.flush()
+
         payload = encrypt(key, iv, plaintext)
 
         result = {'sid': self.own_device_id,
@@ -274,6 +358,32 @@ class OmemoState:
         log.debug('Finished encrypting message')
         return result
 
+    def load_recipient(self, jid):
+        """ Load all sessions of the jid into the session cache.
+
+            Parameters
+            ----------
+            jid : string
+                The contacts jid
+
+            Returns
+            -------
+            dict
+                The trust states of the jid, see
+                :py:meth:`LiteIdentityKeyStore.getTrustStates`
+        """
+        self.store.sessionStore.loadSessions(jid)
+        return self.store.identityKeyStore.getTrustStates(jid)
+
+    def cached_trust(self, cipher, trust_states):
+        """ Same as :py:meth:`isTrusted` but looks up the trust in the given
+            trust states instead of the database.
+        """
+        state = self.store.loadSession(cipher.recipientId, cipher.deviceId). \
+            getSessionState()
+        public_key = state.getRemoteIdentityKey().getPublicKey().serialize()
+        return trust_states.get(public_key, True)
+
     def isTrusted(self, cipher):
         self.cipher = cipher
         self.state = self.cipher.sessionStore. \
@@ -347,18 +457,28 @@ class OmemoState:
     def handlePreKeyWhisperMessage(self, recipient_id, device_id, key):
         preKeyWhisperMessage = PreKeyWhisperMessage(serialized=key)
         sessionCipher = self.get_session_cipher(recipient_id, device_id)
+        # Processing a PreKeyWhisperMessage modifies the cached session
+        # before the decryption succeeds. Persist the current state, so it
+        # can be restored if the message turns out to be invalid.
+        self.store.sessionStore.flush()
         try:
             log.debug(self.account +
                       " => Received PreKeyWhisperMessage from " +
                       recipient_id)
             key = sessionCipher.decryptPkmsg(preKeyWhisperMessage)
-            # Publish new bundle after PreKey has been used
-            # for building a new Session
-            self.plugin.publish_bundle(self.account)
-            return key
         except UntrustedIdentityException as e:
+            self.store.sessionStore.invalidateSession(recipient_id, device_id)
             log.info(self.account + " => Received WhisperMessage " +
                      "from Untrusted Fingerprint! => " + e.getName())
+            return
+        except Exception:
+            self.store.sessionStore.invalidateSession(recipient_id, device_id)
+            raise
+
+        # Publish new bundle after PreKey has been used
+        # for building a new Session
+        self.plugin.publish_bundle(self.account)
+        return key
 
     def handleWhisperMessage(self, recipient_id, device_id, key):
         whisperMessage = WhisperMessage(serialized=key)
@@ -408,3 +528,7 @@ class OmemoState:
         # Delete all SignedPreKeys that are older than SPK_ARCHIVE_TIME
         timestamp = now - SPK_ARCHIVE_TIME
         self.store.removeOldSignedPreKeys(timestamp)
+
+        timestamp = self.store.getSignedPreKeyTimestamp(
+            self.store.getCurrentSignedPreKeyId())
+        self.next_spk_cycle = int(timestamp) + SPK_CYCLE_TIME
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Gajim-OMEMO plugin.
+#
+# The Gajim-OMEMO plugin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gajim-OMEMO is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import threading
+import time
+
+log = logging.getLogger('gajim.plugin_system.omemo')
+
+
+class StateLoader(object):
+    """ Creates the OmemoStates of accounts in worker threads.
+
+        Opening and migrating the db, generating keys and loading the
+        devices happens in a thread per account. The state is handed to the
+        main loop through idle_add and put into states, then the callbacks
+        queued with when_ready() run in the order they were queued.
+    """
+
+    def __init__(self, create, idle_add, states, now=time.time):
+        """
+            Parameters
+            ----------
+            create : callable
+                Called in the worker with the account name and the args
+                passed to start(), returns the OmemoState
+            idle_add : callable
+                gobject.idle_add or a replacement
+            states : dict
+                account => OmemoState, ready states are added to it
+            now : callable
+                Returns the current time in seconds
+        """
+        self.create = create
+        self.idle_add = idle_add
+        self.states = states
+        self.now = now
+        self.threads = {}
+        # account => (state, seconds), set by the worker
+        self.results = {}
+        # account => [(callback, args)]
+        self.waiting = {}
+        # account => {step: seconds}
+        self.timings = {}
+        self.queued = 0
+        self.lock = threading.Lock()
+
+    def start(self, account, *args):
+        """ Start creating the state of account, unless it exists or is
+            being created.
+
+            Returns
+            -------
+            bool
+                True if a worker was started
+        """
+        if account in self.states or account in self.threads:
+            return False
+        thread = threading.Thread(target=self._load, args=(account, ) + args,
+                                  name='omemo-load-' + account)
+        thread.daemon = True
+        self.threads[account] = thread
+        thread.start()
+        return True
+
+    def get(self, account):
+        """ Return the state of account, or None if it is not ready. """
+        return self.states.get(account)
+
+    def when_ready(self, account, callback, *args):
+        """ Call callback with args once the state of account is ready,
+            immediately if it already is.
+        """
+        if account in self.states:
+            callback(*args)
+        else:
+            self.queued += 1
+            self.waiting.setdefault(account, []).append((callback, args))
+
+    def stats(self):
+        return {'queued': self.queued,
+                'timings': dict((account, dict(timings))
+                                for account, timings in
+                                self.timings.items())}
+
+    def _load(self, account, *args):
+        started = self.now()
+        try:
+            state = self.create(account, *args)
+        except Exception:
+            log.exception(account + ' => Creating the OmemoState failed')
+            state = None
+        with self.lock:
+            self.results[account] = (state, self.now() - started)
+        self.idle_add(self._ready, account)
+
+    def _ready(self, account):
+        with self.lock:
+            state, seconds = self.results.pop(account)
+        del self.threads[account]
+        if state is None:
+            # start() tries again
+            return False
+
+        self.states[account] = state
+        timings = dict(getattr(state, 'timings', {}), total=seconds)
+        self.timings[account] = timings
+        waiting = self.waiting.pop(account, [])
+        log.info(account + ' => OmemoState ready after %d ms (%s), '
+                 'replaying %d queued events' % (
+                     seconds * 1000,
+                     ', '.join('%s: %d ms' % (step, timings[step] * 1000)
+                               for step in sorted(timings)
+                               if step != 'total'),
+                     len(waiting)))
+
+        for callback, args in waiting:
+            # A failing callback must not lose the events queued after it
+            try:
+                callback(*args)
+            except Exception:
+                log.exception(account + ' => replaying a queued event '
+                              'failed: ' + str(callback))
+        # Do not repeat the idle callback
+        return False
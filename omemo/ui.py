@@ -380,6 +380,10 @@ class OMEMOConfigDialog(GajimPluginConfigDialog):
         active = self.B.get_object('account_combobox').get_active()
         account = self.account_store[active][0]
         state = self.plugin.get_omemo_state(account)
+        if state is None:
+            # Filled in once the OmemoState of the account is loaded
+            self.plugin.when_ready(account, self.update_context_list)
+            return
 
         ownfpr = binascii.hexlify(state.store.getIdentityKeyPair()
                                   .getPublicKey().serialize())